@@ -6,23 +6,26 @@ import re
 import shutil
 import sys
 import tempfile
+import threading
 import time
 from pathlib import Path
-from typing import Any, Optional
+from typing import Optional
 
 import jinja2
 
 import cijoe.core
+from cijoe.core import journal
 from cijoe.core.command import Cijoe, default_output_path
 from cijoe.core.resources import (
     Config,
     Task,
+    default_context,
     dict_from_tomlfile,
     dict_from_yamlfile,
-    dict_substitute,
-    dict_to_tomlfile,
     get_resources,
 )
+from cijoe.core.scheduler import Scheduler
+from cijoe.core.stepcache import StepCache, default_path
 
 DEFAULT_CONFIG_FILENAME = "cijoe-config.toml"
 DEFAULT_TASK_FILENAME = "cijoe-task.yaml"
@@ -89,36 +92,23 @@ def search_for_file(path: Path) -> Optional[Path]:
     return None
 
 
-def create_combined_toml(configs: list[Path], path: Path):
-    def merge_dicts(a: dict, b: dict) -> dict:
-        """
-        Recursively merge two dictionaries.
-        Values in `b` overwrite values in `a` unless both values are dicts.
-        """
-        result = dict(a)
-
-        for key, value in b.items():
-            if (
-                key in result
-                and isinstance(result[key], dict)
-                and isinstance(value, dict)
-            ):
-                result[key] = merge_dicts(result[key], value)
-            else:
-                result[key] = value
+def log_errors(errors):
+    for error in errors:
+        log.error(error)
 
-        return result
 
-    combined_config: dict[str, Any] = {}
-    for config in configs:
-        combined_config = merge_dicts(combined_config, dict_from_tomlfile(config))
+def load_script(script):
+    """Imports the module of the given script, returns a list of errors"""
 
-    dict_to_tomlfile(combined_config, path)
+    try:
+        errors = script.load()
+    except Exception:
+        log.exception(f"script({script.path}) : import failed")
+        return ["import failed"]
 
+    log_errors(errors)
 
-def log_errors(errors):
-    for error in errors:
-        log.error(error)
+    return errors
 
 
 def cli_integrity_check(args):
@@ -150,16 +140,14 @@ def cli_integrity_check(args):
     errors = Task.dict_normalize(task_dict)  # Normalize it
     errors += Task.dict_lint(args, task_dict)  # Check the yaml-file
 
-    with tempfile.NamedTemporaryFile() as config_file:
-        create_combined_toml(args.config, Path(config_file.name))
-        args.config = Path(config_file.name)
-
-        config = Config.from_path(args.config)
-        if not config:
-            log.error(f"failed: Config.from_path({args.config})")
-            return errno.EINVAL
+    config = Config(args.config[-1], layers=args.config)
+    config_errors = config.load()
+    if config_errors:
+        log_errors(config_errors)
+        log.error(f"failed: Config({args.config}).load()")
+        return errno.EINVAL
 
-        errors += dict_substitute(task_dict, config.options)
+    errors += Task.dict_substitute(task_dict, default_context(config))
 
     if errors:
         log_errors(errors)
@@ -189,6 +177,8 @@ def cli_resources(args):
 def _existing_state_path(output: Path) -> Optional[Path]:
     """Return the path to task.state, falling back to legacy workflow.state."""
 
+    journal.restore(output, Task.STATE_FILENAME)
+
     candidate = output / Task.STATE_FILENAME
     if candidate.exists():
         return candidate
@@ -200,6 +190,56 @@ def _existing_state_path(output: Path) -> Optional[Path]:
     return None
 
 
+def _resume_state(args, config) -> Optional[dict]:
+    """
+    Returns the task-state of the run in 'args.output' when it can be resumed. That
+    is, when it was produced by the same task and configuration. None otherwise.
+    """
+
+    state_path = _existing_state_path(args.output)
+    if state_path is None:
+        log.error(f"no {Task.STATE_FILENAME} in output({args.output})")
+        return None
+
+    task_orig = args.output / "task.orig"
+    if not task_orig.exists() or task_orig.read_bytes() != args.task.read_bytes():
+        log.error(f"task({args.task}) differs from '{task_orig}'")
+        return None
+
+    config_orig = args.output / "config.orig"
+    if not config_orig.exists() or dict_from_tomlfile(config_orig) != config.orig:
+        log.error(f"configs({args.config}) differ from '{config_orig}'")
+        return None
+
+    return dict_from_yamlfile(state_path)
+
+
+def _resume_steps(state: dict, previous: dict, output: Path) -> dict:
+    """
+    Keep the status, and output, of the steps that passed in the 'previous' task-state
+    up until the first step that failed or did not run; the output of the remaining
+    steps is removed. Returns the names of the kept steps, as done for the Scheduler
+    """
+
+    done = {}
+
+    steps = zip(state["steps"], previous.get("steps", []))
+    for step, prev in steps:
+        if step["id"] != prev["id"] or not prev["status"]["passed"]:
+            break
+
+        log.info(f"step({step['name']}) : passed; resumed")
+        step["status"] = prev["status"]
+        state["status"]["passed"] += 1
+        done[step["name"]] = "passed"
+
+    for step in state["steps"]:
+        if step["name"] not in done:
+            shutil.rmtree(Task.step_path(output, step), ignore_errors=True)
+
+    return done
+
+
 def cli_archive(args):
     """Move 'output' directory into archive"""
 
@@ -245,6 +285,7 @@ def cli_produce_report(args):
         reporter.load()
 
     setattr(args, "report_open", args.skip_report)
+    setattr(args, "report_jobs", args.jobs)
 
     return reporter.func(args, cijoe)
 
@@ -363,29 +404,37 @@ def cli_task(args):
     log.info(f"configs: {args.config}")
     log.info(f"output: {args.output}")
 
-    cli_archive(args)
+    if not args.resume:
+        cli_archive(args)
 
-    state_path = args.output / Task.STATE_FILENAME
-    if state_path.exists():
-        log.error(f"aborting; output({args.output}) directory already exists")
-        return errno.EPERM
+        state_path = args.output / Task.STATE_FILENAME
+        if state_path.exists():
+            log.error(f"aborting; output({args.output}) directory already exists")
+            return errno.EPERM
 
-    os.makedirs(args.output)
-    shutil.copyfile(args.task, args.output / "task.orig")
-    if len(args.config) > 1:
-        for i, c in enumerate(args.config):
-            shutil.copyfile(c, args.output / f"config{i}.orig")
+        os.makedirs(args.output)
+        shutil.copyfile(args.task, args.output / "task.orig")
+        if len(args.config) > 1:
+            for i, c in enumerate(args.config):
+                shutil.copyfile(c, args.output / f"config{i}.orig")
 
-    create_combined_toml(args.config, args.output / "config.orig")
-    args.config = args.output / "config.orig"
-
-    config = Config(args.config)
+    config = Config(args.output / "config.orig", layers=args.config)
     errors = config.load()
     if errors:
         log_errors(errors)
         log.error(f"failed: Config({args.config}).load()")
         return errno.EINVAL
 
+    previous = None
+    if args.resume:
+        previous = _resume_state(args, config)
+        if previous is None:
+            log.error(f"aborting; cannot resume output({args.output})")
+            return errno.EINVAL
+
+    config.to_tomlfile(config.path)
+    args.config = config.path
+
     task = Task(args.task)
 
     errors = task.load(args, config)
@@ -396,6 +445,7 @@ def cli_task(args):
 
     task.state["tag"] = args.tag
     step_names = [step["name"] for step in task.state["steps"]]
+    step_names += [step["group"] for step in task.state["steps"] if "group" in step]
     for step_name in args.step:
         if step_name in step_names:
             continue
@@ -405,38 +455,95 @@ def cli_task(args):
 
     resources = get_resources()
 
-    # pre-load scripts and augment state with step-descriptions.
-    # TODO: for some reason when mod.__doc__ is None, then the docstring from a previous
-    # mod trickles in. This should be fixed...
+    # augment state with step-descriptions; from the analysis of the script-content,
+    # the script-modules are only imported when their step is executed
     for step in task.state["steps"]:
-        script_ident = step["uses"]
-        resources["scripts"][script_ident].load()
+        docs = resources["scripts"][step["uses"]].analyse()["docs"]
+        step["description"] = str(docs) if docs else "Undocumented"
 
-        step["description"] = "Undocumented"
-        if resources["scripts"][script_ident].mod.__doc__:
-            step["description"] = str(resources["scripts"][script_ident].mod.__doc__)
+    done = _resume_steps(task.state, previous, args.output) if previous else {}
 
     task.state["status"]["started"] = time.time()
 
-    cijoe = Cijoe(config, args.output, args.monitor)
+    cijoe = Cijoe(config, args.output, args.monitor, journaled=True)
     fail_fast = _get_fail_fast(cijoe)
 
-    for step in task.state["steps"]:
+    if cijoe.journal:
+        cijoe.journal.task(task.state)
+
+    step_cache = StepCache(Path(cijoe.getconf("cijoe.cache.path", default_path())))
+    state_lock = threading.Lock()
+
+    def record(step):
+        """Record the state of the task, and the given step"""
+
+        if cijoe.journal:
+            cijoe.journal.step(step["nr"] - 1, step, task.state["status"])
+        if cijoe.state_format != "journal":
+            task.state_dump(args.output / Task.STATE_FILENAME)
+
+    def finish(step, begin, status, metrics=None):
+        """Update the given step with its 'status', and accumulate it into the state"""
+
+        with state_lock:
+            step["status"].update(status)
+            if metrics:
+                step["metrics"] = metrics
+
+            for key in ["failed", "passed", "skipped"]:
+                task.state["status"][key] += step["status"][key]
+
+            step["status"]["elapsed"] = time.time() - begin
+            task.state["status"]["elapsed"] = (
+                time.time() - task.state["status"]["started"]
+            )
+
+            for text, status in step["status"].items():
+                if text != "elapsed" and status:
+                    log.info(f"step({step['name']}) : {text}")
+
+            if cijoe.journal:
+                cijoe.journal.step(step["nr"] - 1, step, task.state["status"])
+
+    def execute(step):
+        """Execute the given step, in a Cijoe of its own; returns True on failure"""
+
         log.info(f"step({step['name']}) - begin")
 
         begin = time.time()
-        step["status"]["started"] = begin
-        task.state_dump(args.output / Task.STATE_FILENAME)
+        with state_lock:
+            step["status"]["started"] = begin
+            record(step)
 
-        cijoe.set_output_ident(step["id"])
-        os.makedirs(os.path.join(cijoe.output_path, step["id"]), exist_ok=True)
+        step_cijoe = cijoe.fork(step["id"])
 
-        if args.step and step["name"] not in args.step:
-            step["status"]["skipped"] = 1
-        else:
-            script_ident = step["uses"]
-            script = resources["scripts"][script_ident]
+        script_ident = step["uses"]
+        script = resources["scripts"][script_ident]
+        step_path = Task.step_path(args.output, step)
+
+        inputs = StepCache.inputs(script, step, step_cijoe) if step.get("cache") else {}
+        cache_key = StepCache.key(inputs) if inputs else None
 
+        restored = None
+        if cache_key:
+            try:
+                restored = step_cache.restore(cache_key, step_path)
+            except OSError as exc:
+                log.error(f"step({step['name']}) : cache restore failed; err({exc})")
+                shutil.rmtree(step_path, ignore_errors=True)
+                os.makedirs(step_path, exist_ok=True)
+
+        # The step is updated by finish(), under the state-lock, since the task-state,
+        # and with it the step, is dumped by concurrently executing steps
+        status = {}
+        metrics = None
+        if restored:
+            log.info(f"step({step['name']}) : restored from cache({cache_key})")
+            status = {"passed": 1, "cached": 1}
+        elif load_script(script):
+            log.error(f"script({script_ident}) : failed loading")
+            status["failed"] = 1
+        else:
             arguments = []
             if "with" in step:
                 for k, v in step["with"].items():
@@ -450,39 +557,65 @@ def cli_task(args):
             parser = argparse.ArgumentParser()
             if script.argparser_func:
                 script.argparser_func(parser)
-            script_args = parser.parse_args(arguments)
-            args = parser.parse_args(arguments, namespace=args)
+            step_args = parser.parse_args(
+                arguments, namespace=argparse.Namespace(**vars(args))
+            )
 
             try:
-                err = script.func(args, cijoe)
+                err = script.func(step_args, step_cijoe)
                 if err:
                     log.error(f"script({script_ident}) : err({err})")
-                step["status"]["failed" if err else "passed"] = 1
+                status["failed" if err else "passed"] = 1
             except KeyboardInterrupt:
                 log.exception(f"script({script_ident}) : failed")
-                step["status"]["failed"] = 1
+                status["failed"] = 1
             except Exception:
                 log.exception(f"script({script_ident}) : failed")
-                step["status"]["failed"] = 1
-            finally:
-                for k in vars(script_args):
-                    delattr(args, k)
+                status["failed"] = 1
 
-        for key in ["failed", "passed", "skipped"]:
-            task.state["status"][key] += step["status"][key]
+            if step_cijoe.metrics:
+                metrics = dict(step_cijoe.metrics)
 
-        step["status"]["elapsed"] = time.time() - begin
-        task.state["status"]["elapsed"] += step["status"]["elapsed"]
+            if cache_key and status.get("passed"):
+                try:
+                    if cijoe.state_format == "journal":
+                        journal.restore_cmds(args.output, step_cijoe.output_ident)
+                    step_cache.store(
+                        cache_key, step_path, inputs, {**step["status"], **status}
+                    )
+                except OSError as exc:
+                    log.error(f"step({step['name']}) : cache store failed; err({exc})")
 
-        for text, status in step["status"].items():
-            if text != "elapsed" and status:
-                log.info(f"step({step['name']}) : {text}")
+        finish(step, begin, status, metrics)
 
-        if step["status"]["failed"] and fail_fast:
-            log.error(f"exiting, fail_fast({fail_fast})")
-            break
+        return bool(status.get("failed"))
+
+    def block(step):
+        """Skip the given step, since a step that it needs did not pass"""
+
+        log.error(f"step({step['name']}) : skipped; needs({step['needs']}) not passed")
+        finish(step, time.time(), {"skipped": 1})
 
-    task.state_dump(args.output / Task.STATE_FILENAME)
+    # Steps that are not selected are skipped; they do not meet the needs of others
+    for step in task.state["steps"]:
+        selected = {step["name"], step.get("group")} & set(args.step)
+        if args.step and not selected and step["name"] not in done:
+            finish(step, time.time(), {"skipped": 1})
+            done[step["name"]] = "skipped"
+
+    Scheduler(
+        task.state["steps"],
+        execute,
+        block,
+        max_workers=cijoe.getconf("cijoe.task.max_workers", 1),
+        fail_fast=fail_fast,
+        done=done,
+    ).run()
+
+    if cijoe.journal:
+        cijoe.journal.close()
+    if cijoe.state_format != "journal":
+        task.state_dump(args.output / Task.STATE_FILENAME)
 
     err = errno.EIO if task.state["status"]["failed"] else 0
     if err:
@@ -568,6 +701,11 @@ def parse_args():
         const=1,
         help="Increase log-level. Provide '-l' for info and '-ll' for debug.",
     )
+    run_group.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume the task-run at '-o / --output'; passed steps are not re-run",
+    )
     run_group.add_argument(
         "--monitor",
         "-m",
@@ -611,6 +749,13 @@ def parse_args():
         const=1,
         help="Produce report, and open it, for output at '-o / --output' and exit.",
     )
+    utils_group.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="Number of threads processing the output when producing the report.",
+    )
     utils_group.add_argument(
         "--integrity-check",
         "-i",
@@ -696,13 +841,13 @@ def parse_args():
         if not script:
             log.error(f"Invalid target({ident})")
             return errno.EINVAL, None
-        script.load()
+        docs = script.analyse()["docs"]
+        help_text = next(line for line in docs.splitlines() if line) if docs else ""
+
+        # Only import the script-module when it has arguments to add
+        if script.content_has_argparser_func():
+            script.load()
 
-        help_text = (
-            next(line for line in script.docs.splitlines() if line)
-            if script.docs
-            else ""
-        )
         script_group = parser.add_argument_group(
             help_text, "Options specific for the given script"
         )
@@ -2,19 +2,27 @@
 
 """
 
+import codecs
+import copy
 import logging as log
 import os
 import sys
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Union
+from typing import Any, Dict, Union
 
 import yaml
 
-from cijoe.core import transport
-from cijoe.core.misc import ENCODING, sanitize_ident
+from cijoe.core import journal, transport
+from cijoe.core.misc import ENCODING, open_output, read_output, sanitize_ident
 from cijoe.core.resources import Config
 
+# Default limit of commands in flight by run_many(); over ssh, each is a session,
+# thus, it must be within the MaxSessions of the server, which defaults to 10
+RUN_MAX_WORKERS = 8
+
 
 def convert_str(value: str) -> Union[str, int, bool]:
     # Strip and lowercase the input to make checks more robust
@@ -46,37 +54,100 @@ def default_output_path():
 
 
 class Tee:
-    def __init__(self, file_path, monitor):
-        self.file = open(file_path, "w")
+    """
+    Captures command output, as raw bytes, to file, and when monitoring, mirrors it
+    to stdout. Only the mirror is decoded, and only when monitoring. The mirror is
+    flushed line by line, the file is left buffered until close().
+
+    When 'head' and/or 'tail' are given, then only the first 'head' and the last
+    'tail' bytes are kept in the file, separated by a line stating the amount of
+    bytes elided. The full output can additionally be written, gzip-compressed, to
+    'full_path'. A 'file_path' with suffix '.gz' is itself gzip-compressed.
+    """
+
+    def __init__(self, file_path, monitor, head=None, tail=None, full_path=None):
+        self.file_path = file_path
+        self.file = None
+        self.full_path = full_path
+        self.full = None
         self.monitor = monitor
-        self.buffer = []
-        self.buffer_size = 0
+
+        self.bounded = head is not None or tail is not None
+        self.head = int(head or 0)
+        self.tail = int(tail or 0)
+        self.head_size = 0
+        self.tail_buffer = bytearray()
+        self.elided = 0
+
+        # Output arrives in arbitrary chunks, which might split multi-byte characters
+        self.decoder = None
 
     def write(self, data: bytes):
-        decoded = data.decode(ENCODING, errors="replace")
-        self.buffer.append(decoded)
-        self.buffer_size += len(decoded)
+        if self.full is not None:
+            self.full.write(data)
 
-        if "\n" in decoded or self.buffer_size >= 4096:
-            self.flush()
+        if not self.bounded:
+            self.file.write(data)
+        else:
+            self.write_bounded(data)
 
-    def flush(self):
-        output = "".join(self.buffer)
+        if self.monitor:
+            if self.decoder is None:
+                self.decoder = codecs.getincrementaldecoder(ENCODING)(errors="replace")
+            sys.stdout.write(self.decoder.decode(data))
+            if b"\n" in data:
+                sys.stdout.flush()
+
+    def write_bounded(self, data: bytes):
+        """Write the head to file, and retain the tail until close()"""
+
+        room = self.head - self.head_size
+        if room > 0:
+            self.file.write(data[:room])
+            self.head_size += min(room, len(data))
+            data = data[room:]
+
+        self.tail_buffer += data
+        excess = len(self.tail_buffer) - self.tail
+        if excess > 0:
+            del self.tail_buffer[:excess]
+            self.elided += excess
 
-        self.file.write(output)
+    def flush(self):
         self.file.flush()
 
         if self.monitor:
-            sys.stdout.write(output)
             sys.stdout.flush()
 
-        self.buffer = []
-        self.buffer_size = 0
+    def open(self):
+        if self.file is None:
+            self.file = open_output(self.file_path, "wb")
+        if self.full is None and self.full_path:
+            self.full = open_output(self.full_path, "wb")
 
     def close(self):
+        if self.file is None:
+            return
+
+        if self.elided:
+            self.file.write(f"\n[cijoe: elided {self.elided} bytes]\n".encode())
+        if self.tail_buffer:
+            self.file.write(self.tail_buffer)
+            self.tail_buffer = bytearray()
+
+        if self.decoder is not None:
+            sys.stdout.write(self.decoder.decode(b"", final=True))
+        self.flush()
+
         self.file.close()
+        self.file = None
+
+        if self.full is not None:
+            self.full.close()
+            self.full = None
 
     def __enter__(self):
+        self.open()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -106,46 +177,105 @@ class CommandState(object):
         self.output_fpath = Path(cmd_output_fpath)
         self.state_fpath = Path(cmd_state_fpath)
 
-        self.cmd_output = Tee(self.output_fpath, monitor)
+        # See 'cijoe.run.output'; when compressing an unbounded output, then only
+        # the compressed output is kept
+        head, tail = cijoe.output_head, cijoe.output_tail
+        bounded = head is not None or tail is not None
+        full_fpath = None
+        if cijoe.output_compress and bounded:
+            full_fpath = self.output_fpath.with_name(f"{self.output_fpath.name}.gz")
+        elif cijoe.output_compress:
+            self.output_fpath = self.output_fpath.with_name(
+                f"{self.output_fpath.name}.gz"
+            )
+
+        self.cmd_output = Tee(self.output_fpath, monitor, head, tail, full_fpath)
 
     def output(self):
         """Returns the content of 'output_fpath'"""
 
-        with self.output_fpath.open() as ofd:
-            return ofd.read()
+        return read_output(self.output_fpath)
+
+    def to_dict(self):
+        """Returns the command state as a dict"""
+
+        return {
+            "cmd": self.cmd,
+            "cwd": str(self.cwd),
+            "err": self.err,
+            "begin": self.begin,
+            "end": self.end,
+            "elapsed": self.elapsed,
+            "output_dpath": str(self.output_dpath),
+            "output_fpath": str(self.output_fpath),
+            "output_elided": self.cmd_output.elided,
+            "is_done": self.is_done,
+        }
 
     def to_file(self):
         """Dump the command state to file"""
 
         with self.state_fpath.open("w", encoding=ENCODING) as state_file:
-            state = {
-                "cmd": self.cmd,
-                "cwd": str(self.cwd),
-                "err": self.err,
-                "begin": self.begin,
-                "end": self.end,
-                "elapsed": self.elapsed,
-                "output_dpath": str(self.output_dpath),
-                "output_fpath": str(self.output_fpath),
-                "is_done": self.is_done,
-            }
-            yaml.dump(state, state_file)
+            yaml.dump(self.to_dict(), state_file)
+
+
+def index_options(options: dict, prefix: str = "") -> Dict[str, Any]:
+    """
+    Returns a flat index of the given, nested, configuration options, keyed on the
+    dot-separated path of every value, e.g. {"foo": {...}, "foo.bar": 42}
+    """
+
+    index = {}
+    for key, value in options.items():
+        path = f"{prefix}{key}"
+        index[path] = value
+        if isinstance(value, dict):
+            index.update(index_options(value, f"{path}."))
+
+    return index
 
 
 class Cijoe(object):
     """CIJOE providing retargetable command-line expressions and data-transfers"""
 
-    def __init__(self, config: Config, output_path: Path, monitor: bool):
-        """Create a cijoe encapsulation defined by the given config_fpath"""
+    def __init__(
+        self, config: Config, output_path: Path, monitor: bool, journaled=False
+    ):
+        """
+        Create a cijoe encapsulation defined by the given config_fpath. State is
+        journaled, as given by 'cijoe.state.format', only when 'journaled', e.g. for
+        the task-runner, whose journal is restored; otherwise YAML-files are written.
+        """
 
         self.config = config
+        self.refresh()
 
         self.run_count = 0
+        self.run_lock = threading.Lock()
         self.output_path = output_path if output_path else default_output_path()
         self.output_ident = "artifacts"
 
         self.monitor = monitor
 
+        # Metrics recorded by the script of a step; see metric()
+        self.metrics: Dict[str, Any] = {}
+
+        # Bounds and compression of command-output; see 'cijoe.run.output'
+        self.output_head = self.getconf("cijoe.run.output.head", None)
+        self.output_tail = self.getconf("cijoe.run.output.tail", None)
+        self.output_compress = bool(self.getconf("cijoe.run.output.compress", False))
+
+        # Format of task- and command-state; see cijoe.core.journal
+        self.state_format = "yaml"
+        if journaled:
+            self.state_format = self.getconf("cijoe.state.format", "yaml")
+        if self.state_format not in journal.FORMATS:
+            log.error(f"Invalid cijoe.state.format({self.state_format}); using 'yaml'")
+            self.state_format = "yaml"
+        self.journal = None
+        if self.state_format != "yaml":
+            self.journal = journal.Journal(Path(self.output_path) / journal.FILENAME)
+
         os.makedirs(os.path.join(self.output_path, self.output_ident), exist_ok=True)
 
         self.transports = {}
@@ -171,29 +301,72 @@ class Cijoe(object):
         self.output_ident = output_ident
         self._get_transport(transport_name).output_ident = output_ident
 
+    def fork(self, output_ident: str):
+        """
+        Returns a Cijoe sharing configuration, transports, and journal with this one,
+        but with its own output-identifier and command run-count. This allows for
+        steps to run concurrently, each with their own output-directory.
+        """
+
+        forked = copy.copy(self)
+        forked.run_count = 0
+        forked.run_lock = threading.Lock()
+        forked.output_ident = sanitize_ident(output_ident)
+        forked.metrics = {}
+
+        os.makedirs(os.path.join(self.output_path, forked.output_ident), exist_ok=True)
+
+        return forked
+
+    def metric(self, name: str, value: Any):
+        """
+        Record a metric, e.g. a duration in seconds, by the given name. When running
+        a task, then the metrics are added to the state of the step, as 'metrics'.
+        """
+
+        self.metrics[name] = value
+
+    def _prepare(self, cmd, cwd):
+        """Allocate a run-count, and thereby the cmd_XX.output/.state pair"""
+
+        with self.run_lock:
+            self.run_count += 1
+
+            return CommandState(
+                cijoe=self,
+                cmd=cmd,
+                cwd=cwd,
+                err=0,
+                begin=time.time(),
+                end=0,
+                is_done=False,
+                monitor=self.monitor,
+            )
+
     def _run(self, cmd, cwd, env, transport):
-        self.run_count += 1
-
-        begin = time.time()
-        state = CommandState(
-            cijoe=self,
-            cmd=cmd,
-            cwd=cwd,
-            err=0,
-            begin=begin,
-            end=0,
-            is_done=False,
-            monitor=self.monitor,
-        )
-        state.to_file()
+        return self._execute(self._prepare(cmd, cwd), env, transport)
+
+    def state_to_file(self, state: CommandState):
+        """Record the given command state, as a YAML-file and/or in the journal"""
+
+        if self.journal:
+            self.journal.cmd(
+                state.state_fpath.relative_to(self.output_path), state.to_dict()
+            )
+        if self.state_format != "journal":
+            state.to_file()
+
+    def _execute(self, state, env, transport):
+        state.begin = time.time()
+        self.state_to_file(state)
 
         with state.cmd_output as cmd_output:
-            err = transport.run(cmd, cwd, env, cmd_output)
+            err = transport.run(state.cmd, state.cwd, env, cmd_output)
             state.err = err
             state.end = time.time()
             state.elapsed = state.end - state.begin
             state.is_done = True
-            state.to_file()
+            self.state_to_file(state)
 
         return err, state
 
@@ -231,13 +404,68 @@ class Cijoe(object):
 
         return self._run(cmd, cwd, env, self._get_transport("initiator"))
 
+    def submit(self, cmd, cwd=None, env={}, transport_name=None, executor=None):
+        """
+        Execute the given shell command/expression via 'config.transport', without
+        waiting for it to finish
+
+        The run-count, and thereby the location of the cmd_output, is allocated at the
+        time of submission. Returns a concurrent.futures.Future which resolves to the
+        same (err, state) tuple as returned by run(). The command is executed by the
+        given 'executor' or by a thread of its own.
+        """
+
+        transport = self._get_transport(transport_name)
+        state = self._prepare(cmd, cwd)
+
+        if executor:
+            return executor.submit(self._execute, state, env, transport)
+
+        future: Future = Future()
+
+        def execute():
+            try:
+                future.set_result(self._execute(state, env, transport))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+        threading.Thread(target=execute, daemon=True).start()
+
+        return future
+
+    def run_many(self, cmds, cwd=None, env={}, transport_name=None, max_workers=None):
+        """
+        Execute the given shell commands/expressions concurrently via
+        'config.transport'
+
+        Local commands run as parallel sub-processes, remote commands run on
+        separate channels over a shared connection. At most 'max_workers' commands
+        are in flight at a time, defaulting to 'cijoe.run.max_workers' in the
+        configuration or RUN_MAX_WORKERS. Returns a list of (err, state)
+        tuples, in the order of the given 'cmds'.
+        """
+
+        cmds = list(cmds)
+        if not cmds:
+            return []
+
+        if max_workers is None:
+            max_workers = self.getconf("cijoe.run.max_workers", RUN_MAX_WORKERS)
+
+        with ThreadPoolExecutor(max_workers=max(int(max_workers), 1)) as executor:
+            futures = [
+                self.submit(cmd, cwd, env, transport_name, executor) for cmd in cmds
+            ]
+
+            return [future.result() for future in futures]
+
     def put(self, src, dst, transport_name=None):
         """Transfer 'src' on 'dev_box' to 'dst' on **test_target**"""
 
         os.makedirs(os.path.join(self.output_path, self.output_ident), exist_ok=True)
 
         try:
-            return self._get_transport(transport_name).put(src, dst)
+            return self._get_transport(transport_name).put(src, dst, self.output_ident)
         except Exception as exc:
             log.error(f"err({exc})")
             log.debug(f"src({src}), dst({dst})")
@@ -253,7 +481,7 @@ class Cijoe(object):
         os.makedirs(os.path.join(self.output_path, self.output_ident), exist_ok=True)
 
         try:
-            return self._get_transport(transport_name).get(src, dst)
+            return self._get_transport(transport_name).get(src, dst, self.output_ident)
         except Exception as exc:
             log.error(f"err({exc})")
             log.debug(f"src({src}), dst({dst})")
@@ -263,6 +491,32 @@ class Cijoe(object):
 
         return False
 
+    def refresh(self):
+        """
+        (Re)build the key-index of the configuration and the snapshot of the
+        environment-variables used by getconf(). This is done when the Cijoe object
+        is constructed, call it again when the configuration or the environment
+        has been modified.
+        """
+
+        self.conf_index = index_options(self.config.options)
+        self.conf_leaves = [
+            key for key, value in self.conf_index.items() if not isinstance(value, dict)
+        ]
+        self.conf_environ = dict(os.environ)
+        self.conf_envkeys: Dict[str, str] = {}
+
+    def getconf_envkey(self, key: str) -> str:
+        """Returns the name of the environment-variable overriding the given key"""
+
+        envkey = self.conf_envkeys.get(key)
+        if envkey is None:
+            envkey = self.conf_envkeys[key] = (
+                key.replace(".", "_").replace("-", "_").upper()
+            )
+
+        return envkey
+
     def getconf(self, key: str, default: Any = None):
         """
         Return value for given key, and return default if no value is found.
@@ -272,24 +526,34 @@ class Cijoe(object):
 
         The value is found in the cijoe configuration file, but is overwritten
         if the key (with points replaced with underscores, ex. FOO_BAR_JAZZ) is
-        found in the initiator's environment variables.
+        found in the initiator's environment variables. The configuration and
+        environment are as they were when constructed or last refreshed.
         """
 
-        envkey = key.replace(".", "_").replace("-", ".").upper()
-        envvar = os.getenv(envkey)
+        envvar = self.conf_environ.get(self.getconf_envkey(key))
         if envvar:
-            log.debug(f"found {key} ({envkey}) in environment variables.")
+            log.debug(f"found {key} in environment variables.")
             return convert_str(envvar)
 
-        dict_keys = key.split(".")
-        config = self.config.options
+        return self.conf_index.get(key, default)
 
-        try:
-            # fold over the list of dict keys, to iterate through nested dicts
-            [config := config.get(key, {}) for key in dict_keys[:-1]]
-            return config.get(dict_keys[-1], default)
-        except AttributeError as exc:
-            # AttributeError is raised if one of the keys are associated to a
-            # value that is not a dict.
-            log.debug(f"{key} not in config: {exc}")
-            return default
+    def getconf_effective(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Returns the effective value of every key in the configuration, along with its
+        source; "env" when overridden by an environment-variable, "file" otherwise,
+        along with the 'path' of the config-file providing it.
+        """
+
+        effective = {}
+        for key in self.conf_leaves:
+            envvar = self.conf_environ.get(self.getconf_envkey(key))
+            if envvar:
+                effective[key] = {"value": convert_str(envvar), "source": "env"}
+            else:
+                effective[key] = {
+                    "value": self.conf_index[key],
+                    "source": "file",
+                    "path": self.config.provenance.get(key, self.config.path),
+                }
+
+        return effective
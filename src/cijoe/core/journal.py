@@ -0,0 +1,182 @@
+"""
+    Journal
+    =======
+
+    An append-only record, in JSON Lines format, of the state of a task-run. This is
+    an alternative to rewriting the YAML-files ``task.state`` and ``cmd_XX.state``
+    whenever the state changes. Each line is an event:
+
+    * ``{"event": "task", "state": {...}}``; the entire task-state, when it begins
+    * ``{"event": "step", "index": 0, "status": {...}, "task_status": {...}}``; the
+      status of a step, and the task, at step-transitions, along with the
+      ``metrics`` of the step, when it recorded any
+    * ``{"event": "cmd", "path": "001_foo/cmd_01.state", "state": {...}}``; the
+      state of a command, when it begins and when it is done
+
+    The file is flushed for every event, and synced to disk in batches. The YAML
+    views are rebuilt from the journal using restore().
+
+    The format is selected via the configuration option ``cijoe.state.format``:
+
+    * ``yaml``: only the YAML-files are written; this is the default
+    * ``journal``: only the journal is written
+    * ``both``: the journal and the YAML-files are written
+
+    Only the task-runner journals, other cijoe-instances, e.g. the one provided by
+    the pytest-plugin to tests run by ``core.testrunner``, write YAML-files.
+"""
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, TextIO
+
+import yaml
+
+from cijoe.core.misc import ENCODING
+
+FILENAME = "journal.jsonl"
+FORMATS = ["yaml", "journal", "both"]
+
+
+class Journal(object):
+    """Appends events to the journal-file at 'path', opened on first append"""
+
+    def __init__(self, path: Path, sync_interval=1.0):
+        self.path = Path(path)
+        self.sync_interval = sync_interval
+        self.file: Optional[TextIO] = None
+        self.synced = 0.0
+        self.lock = threading.Lock()
+
+    def append(self, event: dict):
+        line = json.dumps(event, default=str) + "\n"
+
+        with self.lock:
+            if self.file is None:
+                self.file = self.path.open("a", encoding=ENCODING)
+                self.synced = time.monotonic()
+
+            self.file.write(line)
+            self.file.flush()
+
+            if time.monotonic() - self.synced >= self.sync_interval:
+                os.fsync(self.file.fileno())
+                self.synced = time.monotonic()
+
+    def task(self, state: dict):
+        self.append({"event": "task", "state": state})
+
+    def step(self, index: int, step: dict, task_status: dict):
+        event = {
+            "event": "step",
+            "index": index,
+            "status": step["status"],
+            "task_status": task_status,
+        }
+        if "metrics" in step:
+            event["metrics"] = step["metrics"]
+
+        self.append(event)
+
+    def cmd(self, path: Path, state: dict):
+        self.append({"event": "cmd", "path": str(path), "state": state})
+
+    def close(self):
+        with self.lock:
+            if self.file is None:
+                return
+
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+
+def replay(path: Path):
+    """
+    Returns the task-state and a dict of command-states, keyed by their path
+    relative to the output-directory, as described by the journal at 'path'
+    """
+
+    task_state: Dict[str, Any] = {}
+    cmd_states: Dict[str, dict] = {}
+
+    with Path(path).open(encoding=ENCODING) as journal:
+        for line in journal:
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                break  # A partially written event, from an interrupted run
+
+            if event["event"] == "task":
+                task_state = event["state"]
+
+                # When resuming a task-run, only the commands of kept steps remain
+                kept = [s["id"] for s in task_state["steps"] if s["status"]["passed"]]
+                cmd_states = {
+                    cmd_path: cmd_state
+                    for cmd_path, cmd_state in cmd_states.items()
+                    if Path(cmd_path).parts[0] in kept
+                }
+            elif event["event"] == "step" and task_state:
+                task_state["steps"][event["index"]]["status"] = event["status"]
+                if "metrics" in event:
+                    task_state["steps"][event["index"]]["metrics"] = event["metrics"]
+                task_state["status"] = event["task_status"]
+            elif event["event"] == "cmd":
+                cmd_states[event["path"]] = event["state"]
+
+    return task_state, cmd_states
+
+
+def restore_cmds(output_path: Path, prefix: str):
+    """
+    Write the YAML-files 'cmd_XX.state' in the sub-directory 'prefix' of
+    'output_path' from the journal. Returns the number of files written.
+    """
+
+    path = Path(output_path) / FILENAME
+    if not path.exists():
+        return 0
+
+    _, cmd_states = replay(path)
+
+    count = 0
+    for cmd_path, cmd_state in cmd_states.items():
+        if Path(cmd_path).parts[0] != prefix:
+            continue
+
+        with (Path(output_path) / cmd_path).open("w", encoding=ENCODING) as state_file:
+            yaml.dump(cmd_state, state_file)
+        count += 1
+
+    return count
+
+
+def restore(output_path: Path, state_filename="task.state"):
+    """
+    Rebuild the YAML-files 'task.state' and 'cmd_XX.state' in 'output_path' from
+    the journal, when the journal is more recent than the YAML-files. Returns True
+    when the files were restored.
+    """
+
+    path = Path(output_path) / FILENAME
+    state_path = Path(output_path) / state_filename
+    if not path.exists():
+        return False
+    if state_path.exists() and state_path.stat().st_mtime >= path.stat().st_mtime:
+        return False
+
+    task_state, cmd_states = replay(path)
+
+    for cmd_path, cmd_state in cmd_states.items():
+        with (Path(output_path) / cmd_path).open("w", encoding=ENCODING) as state_file:
+            yaml.dump(cmd_state, state_file)
+
+    if task_state:
+        with state_path.open("w", encoding=ENCODING) as state_file:
+            yaml.dump(task_state, state_file)
+
+    return True
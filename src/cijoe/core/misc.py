@@ -6,7 +6,7 @@ import lzma
 import shutil
 from pathlib import Path
 from tempfile import NamedTemporaryFile, TemporaryDirectory
-from typing import Optional
+from typing import Optional, Tuple
 
 import requests
 
@@ -22,6 +22,35 @@ def sanitize_ident(ident: str):
     return ident
 
 
+def open_output(path: Path, mode="rb"):
+    """Opens the command-output at 'path', (de)compressing '.gz' transparently"""
+
+    path = Path(path)
+    if path.suffix == ".gz":
+        return gzip.open(path, mode, compresslevel=6)
+
+    return path.open(mode)
+
+
+def read_output(path: Path) -> str:
+    """Returns the decoded content of the command-output at 'path'"""
+
+    with open_output(path) as output:
+        return output.read().decode(ENCODING, errors="replace")
+
+
+def read_output_preview(path: Path, size: int) -> Tuple[str, bool]:
+    """
+    Returns the decoded first 'size' bytes of the command-output at 'path', and
+    whether the output is truncated, that is, longer than 'size' bytes
+    """
+
+    with open_output(path) as output:
+        head = output.read(size + 1)
+
+    return head[:size].decode(ENCODING, errors="replace"), len(head) > size
+
+
 def download(url: str, path: Path):
     """Downloads a file over http(s), returns (err, path)."""
 
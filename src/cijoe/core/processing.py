@@ -3,53 +3,142 @@
 """
 
 import json
+import logging as log
+import os
+import tempfile
 import time
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
-from cijoe.core.misc import ENCODING, sanitize_ident
+from cijoe.core import journal
+from cijoe.core.misc import ENCODING, read_output, read_output_preview, sanitize_ident
 from cijoe.core.resources import Task, dict_from_yamlfile
 
+TESTREPORT_LOG_FILENAME = "testreport.log"
+TESTREPORT_IDX_FILENAME = "testreport.idx"
+TESTREPORT_IDX_VERSION = 1
+TESTREPORT_TYPE = "TestReport"
+
 
 def cmd_number_from_path(path):
     """Extracts the numerical part after 'cmd_' in the filename stem."""
 
-    return int(path.stem.split("_")[1])
+    return int(path.name.split(".")[0].split("_")[1])
+
+
+class CommandRunlog(Mapping):
+    """
+    The runlog of a command; the paths to its .output and .state files, with the
+    state and output loaded on first access. It is a read-only mapping with the
+    keys: output_path, output, output_truncated, state, and state_path.
+
+    With 'preview', then only the first 'preview' bytes of the output are read.
+    """
+
+    KEYS = ("output_path", "output", "output_truncated", "state", "state_path")
+
+    def __init__(self, preview: Optional[int] = None):
+        self.preview = preview
+        self.output_path: Optional[Path] = None
+        self.state_path: Optional[Path] = None
+
+        self._state: Optional[Dict[str, Any]] = None
+        self._output: Optional[Tuple[str, bool]] = None
+
+    @property
+    def state(self) -> Dict[str, Any]:
+        if self._state is None:
+            state = {}
+            if self.state_path:
+                state = dict_from_yamlfile(self.state_path)
+                if not state["is_done"]:
+                    state["elapsed"] = time.time() - state["begin"]
+            self._state = state
+
+        return self._state
+
+    @property
+    def output(self) -> str:
+        if self._output is None:
+            if not self.output_path:
+                self._output = ("", False)
+            elif self.preview is None:
+                self._output = (read_output(self.output_path), False)
+            else:
+                self._output = read_output_preview(self.output_path, self.preview)
+
+        return self._output[0]
+
+    @property
+    def output_truncated(self) -> bool:
+        self.output
+
+        return self._output[1] if self._output else False
 
+    def load(self) -> "CommandRunlog":
+        """Load the state and output now, e.g. by a worker, rather than on access"""
 
-def runlog_from_path(path: Path):
-    """Produce a dict of command-dicts with paths to .output and .state files"""
+        self.state
+        self.output
 
-    run: Dict[str, Dict[str, Any]] = {}
+        return self
+
+    def output_preview(self, size: int) -> Tuple[str, bool]:
+        """Returns the first 'size' bytes of output, and whether it is truncated"""
+
+        if not self.output_path:
+            return "", False
+
+        return read_output_preview(self.output_path, size)
+
+    def __repr__(self) -> str:
+        return (
+            f"CommandRunlog(output_path={self.output_path}, "
+            f"state_path={self.state_path})"
+        )
+
+    def __getitem__(self, key: str):
+        if key not in self.KEYS:
+            raise KeyError(key)
+
+        return getattr(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.KEYS)
+
+    def __len__(self) -> int:
+        return len(self.KEYS)
+
+
+def runlog_from_path(path: Path, preview: Optional[int] = None):
+    """
+    Produce a dict of CommandRunlog with paths to .output and .state files, the
+    content of the files are loaded when accessed, see CommandRunlog.
+    """
+
+    run: Dict[str, CommandRunlog] = {}
 
     if not (path.is_dir() and path.exists()):
         return run
 
     for cmd_path in sorted(path.glob("cmd_*.*"), key=cmd_number_from_path):
-        stem = cmd_path.stem
-        suffix = cmd_path.suffix[1:]
-        if suffix not in ["output", "state"]:
+        stem, _, suffix = cmd_path.name.partition(".")
+        if suffix not in ["output", "output.gz", "state"]:
             continue
 
         if stem not in run:
-            run[stem] = {
-                "output_path": None,
-                "output": "",
-                "state": {},
-                "state_path": None,
-            }
+            run[stem] = CommandRunlog(preview)
 
-        run[stem][f"{suffix}_path"] = cmd_path
-        if suffix == "output":
-            with run[stem][f"{suffix}_path"].open(
-                encoding=ENCODING, errors="replace"
-            ) as content:
-                run[stem][f"{suffix}"] = content.read()
-        elif suffix == "state":
-            yaml_dict = dict_from_yamlfile(run[stem][f"{suffix}_path"])
-            if not yaml_dict["is_done"]:
-                yaml_dict["elapsed"] = time.time() - yaml_dict["begin"]
-            run[stem][f"{suffix}"] = yaml_dict
+        # The full output compressed; used when there is no (bounded) plain output
+        if suffix == "output.gz":
+            output_path = run[stem].output_path
+            if output_path is not None and output_path.suffix != ".gz":
+                continue
+            suffix = "output"
+
+        setattr(run[stem], f"{suffix}_path", cmd_path)
 
     return run
 
@@ -95,58 +184,122 @@ def longrepr_to_string(longrepr):
     return "\n".join(lines)
 
 
-def testreport_from_file(path: Path):
-    """Parse the given 'pytest-reportlog' output into a restreport dict"""
+def testreports_from_log(logpath: Path) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Yields the line-number and record of each 'TestReport' in the given
+    'pytest-reportlog' output, one line at a time. Lines not mentioning a
+    'TestReport' are skipped without decoding them.
+    """
+
+    with logpath.open(encoding=ENCODING) as logfile:
+        for count, line in enumerate(logfile):
+            if TESTREPORT_TYPE not in line:
+                continue
+
+            result = json.loads(line)
+            if result["$report_type"] == TESTREPORT_TYPE:
+                yield count, result
+
+
+def testreport_tests_from_log(logpath: Path) -> List[Dict[str, Any]]:
+    """Returns a summary of each test, in order, of the given 'pytest-reportlog'"""
+
+    tests: Dict[str, Dict[str, Any]] = {}
+
+    for count, result in testreports_from_log(logpath):
+        nodeid: str = result["nodeid"]
+        if nodeid not in tests:
+            try:
+                comp = nodeid.split("::")
+                group_left = comp[0]
+                group_right = "".join(comp[1:])
+            except Exception:
+                group_left, group_right = (nodeid, nodeid)
+
+            tests[nodeid] = {
+                "group_left": group_left,
+                "group_right": group_right,
+                "count": count,
+                "nodeid": nodeid,
+                "duration": 0.0,
+                "outcome": [],
+                "longrepr": "",
+            }
+        if isinstance(result["longrepr"], list):
+            tests[nodeid]["longrepr"] += "\n".join(
+                [str(item) for item in result["longrepr"]]
+            )
+        elif isinstance(result["longrepr"], dict):
+            tests[nodeid]["longrepr"] += longrepr_to_string(result["longrepr"])
+
+        tests[nodeid]["duration"] += result["duration"]
+        tests[nodeid]["outcome"] += [result["outcome"]]
+
+    return list(tests.values())
+
+
+def testreport_tests(path: Path) -> List[Dict[str, Any]]:
+    """
+    Returns the summary of each test in the 'testreport.log' in 'path'. The
+    summary is kept in 'testreport.idx', next to the log, and is re-used as long
+    as the log is unchanged, avoiding parsing the log on every report.
+    """
+
+    logpath = path / TESTREPORT_LOG_FILENAME
+    idxpath = path / TESTREPORT_IDX_FILENAME
+
+    stat = logpath.stat()
+    source = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+    try:
+        with idxpath.open("r", encoding=ENCODING) as idxfile:
+            idx = json.load(idxfile)
+        if idx.get("version") == TESTREPORT_IDX_VERSION and idx["log"] == source:
+            return idx["tests"]
+    except (OSError, ValueError, KeyError, AttributeError):
+        pass
+
+    tests = testreport_tests_from_log(logpath)
+
+    idx = {"version": TESTREPORT_IDX_VERSION, "log": source, "tests": tests}
+    try:
+        with tempfile.NamedTemporaryFile(
+            "w", dir=path, encoding=ENCODING, delete=False
+        ) as tmpfile:
+            json.dump(idx, tmpfile, separators=(",", ":"))
+        os.replace(tmpfile.name, idxpath)
+    except OSError as exc:
+        log.debug(f"failed writing testreport-index({idxpath}); {exc}")
+
+    return tests
+
+
+def testreport_from_file(
+    path: Path, preview: Optional[int] = None, runlog_map: Callable = map
+):
+    """
+    Parse the given 'pytest-reportlog' output into a restreport dict. The runlogs
+    of the tests are collected via 'runlog_map', e.g. the map() of an executor.
+    """
 
     results: Dict[str, Dict[str, Any]] = {
         "status": {"failed": 0, "passed": 0, "skipped": 0, "total": 0},
         "tests": {},
     }
 
-    logpath = path / "testreport.log"
-    if not logpath.exists():
+    if not (path / TESTREPORT_LOG_FILENAME).exists():
         return {}
 
-    with logpath.open() as logfile:
-        for count, line in enumerate(logfile.readlines()):
-            result = json.loads(line)
-            if result["$report_type"] != "TestReport":
-                continue
-
-            nodeid: str = result["nodeid"]
-            if nodeid not in results["tests"]:
-                try:
-                    comp = nodeid.split("::")
-                    group_left = comp[0]
-                    group_right = "".join(comp[1:])
-                except Exception:
-                    group_left, group_right = (nodeid, nodeid)
-
-                results["tests"][nodeid] = {
-                    "group_left": group_left,
-                    "group_right": group_right,
-                    "count": count,
-                    "nodeid": nodeid,
-                    "duration": 0.0,
-                    "outcome": [],
-                    "runlog": {},
-                    "longrepr": "",
-                }
-            if isinstance(result["longrepr"], list):
-                results["tests"][nodeid]["longrepr"] += "\n".join(
-                    [str(item) for item in result["longrepr"]]
-                )
-            elif isinstance(result["longrepr"], dict):
-                results["tests"][nodeid]["longrepr"] += longrepr_to_string(
-                    result["longrepr"]
-                )
-
-            results["tests"][nodeid]["duration"] += result["duration"]
-            results["tests"][nodeid]["outcome"] += [result["outcome"]]
+    for testcase in testreport_tests(path):
+        results["tests"][testcase["nodeid"]] = {**testcase, "runlog": {}}
 
-            runlog = runlog_from_path(path / sanitize_ident(result["nodeid"]))
-            if runlog:
-                results["tests"][nodeid]["runlog"] = runlog
+    nodeids = list(results["tests"].keys())
+    runlogs = runlog_map(
+        lambda nodeid: runlog_from_path(path / sanitize_ident(nodeid), preview),
+        nodeids,
+    )
+    for nodeid, runlog in zip(nodeids, runlogs):
+        if runlog:
+            results["tests"][nodeid]["runlog"] = runlog
 
     for nodeid, testcase in results["tests"].items():
         results["status"]["total"] += 1
@@ -175,7 +328,16 @@ def artifacts_in_path(path: Path):
     return sorted(artifacts)
 
 
-def process_task_output(args, cijoe):
+def process_task_output(args, cijoe, preview: Optional[int] = None, jobs: int = 1):
+    """
+    Returns the task-state of the task-run in 'args.output' with the runlog and
+    testreport of each step, see runlog_from_path() for 'preview'. With 'jobs',
+    then the steps, and the tests of each step, are processed by as many threads,
+    which also load the state and output of the runlogs, rather than on access.
+    """
+
+    journal.restore(args.output, Task.STATE_FILENAME)
+
     state_path = args.output / Task.STATE_FILENAME
     if not state_path.exists():
         legacy = args.output / "workflow.state"
@@ -193,17 +355,41 @@ def process_task_output(args, cijoe):
         if step["status"]["started"] > 0 and step["status"]["elapsed"] == 0:
             step["status"]["elapsed"] = time.time() - step["status"]["started"]
 
-        step_path = args.output / step["id"]
-        if not step_path.exists():
-            continue
+    # The tests are processed by a pool of their own, as the steps wait for them
+    with ThreadPoolExecutor(max_workers=max(int(jobs), 1)) as steps_executor:
+        with ThreadPoolExecutor(max_workers=max(int(jobs), 1)) as tests_executor:
 
-        runlog = runlog_from_path(step_path)
-        if runlog:
-            step["extras"]["runlog"] = runlog
+            def load(runlog: Dict[str, CommandRunlog]):
+                if jobs > 1:
+                    for cmd in runlog.values():
+                        cmd.load()
+
+                return runlog
+
+            def runlog_map(func: Callable, items: List[str]):
+                if jobs <= 1:
+                    return map(func, items)
+
+                return tests_executor.map(lambda item: load(func(item)), items)
+
+            def process_step(step: dict):
+                step_path = Task.step_path(args.output, step)
+                if not step_path.exists():
+                    return {}, {}
+
+                return (
+                    load(runlog_from_path(step_path, preview)),
+                    testreport_from_file(step_path, preview, runlog_map),
+                )
 
-        testreport = testreport_from_file(step_path)
-        if testreport:
-            step["extras"]["testreport"] = testreport
+            steps_map = map if jobs <= 1 else steps_executor.map
+            for step, (runlog, testreport) in zip(
+                task_state["steps"], steps_map(process_step, task_state["steps"])
+            ):
+                if runlog:
+                    step["extras"]["runlog"] = runlog
+                if testreport:
+                    step["extras"]["testreport"] = testreport
 
     return task_state
 
@@ -21,7 +21,9 @@
     as for path by the cijoe.core.resources.Collector.
 
     The Collector is a SingleTon, since it is used extensively everywhere and the tasks
-    of doing collection can be somewhat time-consuming.
+    of doing collection can be somewhat time-consuming. Additionally, the classification
+    of scripts is cached on disk, see CollectorCache, such that collection in a
+    subsequent invocation only needs to stat() the scripts.
 
     Intended usage
     --------------
@@ -36,17 +38,22 @@
         cijoe --resources
 """
 import ast
+import copy
 import importlib
 import inspect
+import itertools
+import json
 import logging as log
 import os
 import pkgutil
 import re
 import sys
+import tempfile
+import threading
 from argparse import Namespace
 from importlib.machinery import SourceFileLoader
 from pathlib import Path
-from typing import Any, Dict, List, Union
+from typing import Any, Dict, List, Optional, Union
 
 try:
     from importlib.resources import files as importlib_files
@@ -59,6 +66,8 @@ import jinja2
 import yaml
 
 import cijoe
+from cijoe.core import __version__, scheduler
+from cijoe.core.misc import sanitize_ident
 
 if sys.version_info >= (3, 11):
     import tomllib  # Python 3.11 and newer
@@ -89,6 +98,33 @@ def dict_to_tomlfile(data, path: Path):
         return tomli_w.dump(data, tomlfile)
 
 
+def dict_merge(topic: dict, layer: dict, provenance: dict, source, prefix="") -> dict:
+    """
+    Merge 'layer' into 'topic', in-place; values in 'layer' overwrite those in 'topic'
+    unless both are dicts, then they are merged recursively. The 'source' of every
+    merged value is recorded in 'provenance', keyed on its dot-separated path.
+    """
+
+    for key, value in layer.items():
+        path = f"{prefix}{key}"
+
+        if isinstance(value, dict):
+            if not isinstance(topic.get(key), dict):
+                topic[key] = {}
+                provenance.pop(path, None)
+            dict_merge(topic[key], value, provenance, source, f"{path}.")
+            continue
+
+        if isinstance(topic.get(key), dict):
+            for stale in [k for k in provenance if k.startswith(f"{path}.")]:
+                del provenance[stale]
+
+        topic[key] = value
+        provenance[path] = source
+
+    return topic
+
+
 def default_context(config=None, resources=None):
     """Return a default context for dict-substitution"""
 
@@ -104,33 +140,64 @@ def default_context(config=None, resources=None):
     }
 
 
-def dict_substitute(topic: dict, context: dict) -> list:
-    """Traverse the given 'topic' replacing {{ foo.bar }} entities with ctx. values"""
+class Substitution(object):
+    """
+    Replaces {{ foo.bar }} entities in the strings of a document with context values
 
-    errors = []
+    A single jinja2-environment is shared by all substitutions, strings without
+    template-markers are not rendered, and compiled templates are cached keyed on
+    their source text.
+    """
 
-    jinja_env = jinja2.Environment(undefined=jinja2.StrictUndefined)
-    for key, value in topic.items():
-        try:
+    MARKERS = ("{{", "{%", "{#")
+    NEWLINES = re.compile(r"\r\n|\r|\n")
+
+    def __init__(self):
+        self.env = jinja2.Environment(undefined=jinja2.StrictUndefined)
+        self.templates: Dict[str, jinja2.Template] = {}
+
+    def render(self, text: str, context: dict) -> str:
+        """Returns the given 'text' rendered with the given 'context'"""
+
+        if not any(marker in text for marker in Substitution.MARKERS):
+            # Equivalent to rendering: newlines are normalized, and a single
+            # trailing newline is removed
+            lines = Substitution.NEWLINES.split(text)
+            if len(lines) > 1 and lines[-1] == "":
+                lines.pop()
+            return "\n".join(lines)
+
+        template = self.templates.get(text)
+        if template is None:
+            template = self.templates[text] = self.env.from_string(text)
+
+        return template.render(context)
+
+    def substitute(self, topic: Union[dict, list], context: dict) -> list:
+        """Substitute all strings in 'topic', in-place. Returns a list of errors"""
+
+        errors = []
+
+        items = topic.items() if isinstance(topic, dict) else enumerate(topic)
+        for key, value in items:
             if isinstance(value, str):
-                topic[key] = jinja_env.from_string(value).render(context)
-            elif isinstance(value, list) and all(
-                isinstance(line, str) for line in value
-            ):
-                topic[key] = [
-                    jinja_env.from_string(line).render(context) for line in value
-                ]
-            elif isinstance(value, list) and all(
-                isinstance(entity, dict) for entity in value
-            ):
-                for entity in value:
-                    errors += dict_substitute(entity, context)
-            elif isinstance(value, dict):
-                errors += dict_substitute(value, context)
-        except jinja2.exceptions.UndefinedError as exc:
-            errors.append(f"Substitution-error: {exc}")
+                try:
+                    topic[key] = self.render(value, context)
+                except jinja2.exceptions.UndefinedError as exc:
+                    errors.append(f"Substitution-error: {exc}")
+            elif isinstance(value, (dict, list)):
+                errors += self.substitute(value, context)
+
+        return errors
+
 
-    return errors
+SUBSTITUTION = Substitution()
+
+
+def dict_substitute(topic: dict, context: dict) -> list:
+    """Traverse the given 'topic' replacing {{ foo.bar }} entities with ctx. values"""
+
+    return SUBSTITUTION.substitute(topic, context)
 
 
 class Resource(object):
@@ -159,23 +226,34 @@ class Resource(object):
 
 class Config(Resource):
     """
-    Encapsulation of a CIJOE config-file, e.g. 'example_config_default.toml'
+    Encapsulation of a CIJOE config-file, e.g. 'example_config_default.toml', or of
+    multiple config-files layered on top of each other, merged in the given order
 
     ivar: options: dict of configuration options populated by load() / from_path()
+    ivar: orig: dict of configuration options, as merged, before substitution
+    ivar: provenance: dict of the config-file providing each option, keyed on path
     """
 
     SUFFIX = ".toml"
 
-    def __init__(self, path: Path, pkg=None):
+    def __init__(self, path: Path, pkg=None, layers: Optional[List[Path]] = None):
         super().__init__(path, pkg)
 
+        self.layers = [Path(layer) for layer in layers] if layers else [self.path]
         self.options: Dict[str, Any] = {}
+        self.orig: Dict[str, Any] = {}
+        self.provenance: Dict[str, Path] = {}
 
     def load(self):
         """Populates self.options on success. Returns a list of errors otherwise"""
 
-        # config_dict = dict_from_yamlfile(self.path)
-        config_dict = dict_from_tomlfile(self.path)
+        config_dict: Dict[str, Any] = {}
+        provenance: Dict[str, Path] = {}
+        for layer in self.layers:
+            dict_merge(config_dict, dict_from_tomlfile(layer), provenance, layer)
+
+        self.orig = copy.deepcopy(config_dict)
+        self.provenance = provenance
 
         errors = dict_substitute(config_dict, default_context())
         if errors:
@@ -203,6 +281,11 @@ class Config(Resource):
 
         return config
 
+    def to_tomlfile(self, path: Path):
+        """Dumps the merged configuration options, before substitution, to 'path'"""
+
+        dict_to_tomlfile(self.orig, path)
+
 
 class Script(Resource):
     """Script representation and encapsulation"""
@@ -210,6 +293,7 @@ class Script(Resource):
     SUFFIX = ".py"
     NAMING_CONVENTION = ["worklet_entry", "script_entry", "main"]
     ARGPARSER_FUNC = "add_args"
+    LOAD_LOCK = threading.Lock()
 
     def __init__(self, path, pkg=None):
         super().__init__(path, pkg)
@@ -219,65 +303,76 @@ class Script(Resource):
         self.mod = None
         self.mod_name = None
         self.docs = None
+        self.analysis: Optional[Dict[str, Any]] = None
 
-    def content_has_script_func(self):
-        """Checks whether the resource-content has the script entry-function"""
+    def analyse(self):
+        """
+        Returns the analysis of the resource-content as a dict with the name of the
+        script entry-function ('entry', None when missing), whether it has a function
+        to add cli arguments ('has_argparser'), and the module docstring ('docs').
+
+        The content is parsed once, inspecting only top-level function definitions,
+        and the analysis is memoized in 'self.analysis'.
+        """
 
+        if self.analysis is not None:
+            return self.analysis
+
+        if not self.content:
+            self.content_from_file()
+
+        analysis: Dict[str, Any] = {"entry": None, "has_argparser": False, "docs": None}
         try:
             tree = ast.parse(self.content)
         except SyntaxError:
-            return False
+            self.analysis = analysis
+            return analysis
 
-        for node in [x for x in ast.walk(tree) if isinstance(x, ast.FunctionDef)]:
-            if node.name not in Script.NAMING_CONVENTION:
-                log.debug(f"skipping; invalid entry-name({node.name})")
-                continue
+        analysis["docs"] = ast.get_docstring(tree, clean=False)
 
+        for node in [x for x in tree.body if isinstance(x, ast.FunctionDef)]:
             argnames = [arg.arg for arg in node.args.args]
-            if argnames != ["args", "cijoe"]:
-                log.debug(f"skipping; invalid argnames({argnames})")
-                continue
 
-            return True
+            if node.name in Script.NAMING_CONVENTION:
+                if argnames != ["args", "cijoe"]:
+                    log.debug(f"skipping; invalid argnames({argnames})")
+                elif analysis["entry"] is None:
+                    analysis["entry"] = node.name
+            elif node.name == Script.ARGPARSER_FUNC:
+                if argnames != ["parser"]:
+                    log.debug(f"skipping; invalid argnames({argnames})")
+                else:
+                    analysis["has_argparser"] = True
 
-        return False
+        self.analysis = analysis
 
-    def content_has_argparser_func(self):
-        """Checks whether the resource-content has a function to add cli arguments"""
+        return analysis
 
-        try:
-            tree = ast.parse(self.content)
-        except SyntaxError:
-            return False
-
-        for node in [x for x in ast.walk(tree) if isinstance(x, ast.FunctionDef)]:
-            if node.name != Script.ARGPARSER_FUNC:
-                log.debug(f"skipping; invalid argparser function name({node.name})")
-                continue
+    def content_has_script_func(self):
+        """Checks whether the resource-content has the script entry-function"""
 
-            argnames = [arg.arg for arg in node.args.args]
-            if argnames != ["parser"]:
-                log.debug(f"skipping; invalid argnames({argnames})")
-                continue
+        return self.analyse()["entry"] is not None
 
-            return True
+    def content_has_argparser_func(self):
+        """Checks whether the resource-content has a function to add cli arguments"""
 
-        return False
+        return self.analyse()["has_argparser"]
 
     def load(self):
         """Loads the module and the script-entry function"""
 
-        if self.func:
-            return []
+        # Instances of a matrix step share the script, and execute concurrently
+        with Script.LOAD_LOCK:
+            if self.func:
+                return []
 
-        if not self.content:
-            self.content_from_file()
+            return self.__load()
 
-        if not self.content_has_script_func():
+    def __load(self):
+        analysis = self.analyse()
+        if analysis["entry"] is None:
             return ["Missing script_entry() function in ast"]
 
-        has_argparser_func = self.content_has_argparser_func()
-
         path = Path(self.path).resolve()
 
         mod_path = str(path)
@@ -299,25 +394,20 @@ class Script(Resource):
         )
         mod = importlib.util.module_from_spec(spec)
         spec.loader.exec_module(mod)
-        docstring = mod.__doc__
 
-        # mod = SourceFileLoader("", str(self.path)).load_module()
-        for function_name, function in inspect.getmembers(mod, inspect.isfunction):
-            if function_name == Script.ARGPARSER_FUNC and has_argparser_func:
-                self.argparser_func = function
+        function = getattr(mod, analysis["entry"], None)
+        if not inspect.isfunction(function):
+            return ["Missing script_entry() function in loaded module"]
 
-            if function_name not in Script.NAMING_CONVENTION:
-                continue
+        if analysis["has_argparser"]:
+            self.argparser_func = getattr(mod, Script.ARGPARSER_FUNC, None)
 
-            if self.func:
-                continue
-
-            self.mod = mod
-            self.mod_name = mod_name
-            self.func = function
-            self.docs = docstring
+        self.mod = mod
+        self.mod_name = mod_name
+        self.func = function
+        self.docs = analysis["docs"]
 
-        return ["Missing script_entry() function in loaded module"]
+        return []
 
 
 class Task(Resource):
@@ -349,9 +439,52 @@ class Task(Resource):
         with path.open("w+") as state_file:
             yaml.dump(self.state, state_file)
 
+    @staticmethod
+    def step_path(output_path: Path, step: dict) -> Path:
+        """Returns the path to the output-directory of the given step"""
+
+        return Path(output_path) / sanitize_ident(step["id"])
+
+    @staticmethod
+    def matrix_expand(step: dict) -> List[dict]:
+        """
+        Returns the instances of the given step, one for every combination of the
+        values in its 'matrix'. An instance is named by its values, and records them
+        in 'matrix', and the name of the step it is an instance of in 'group'
+        """
+
+        instances: List[dict] = []
+
+        names = set()
+        keys = list(step["matrix"])
+        for values in itertools.product(*[step["matrix"][key] for key in keys]):
+            # The values are sanitized as the step-ident is, such that the name
+            # of the instance matches the name of its output directory
+            name = "-".join(
+                [step["name"]]
+                + [
+                    sanitize_ident(re.sub(r"[^a-zA-Z0-9\.\-_]", "_", str(value)))
+                    for value in values
+                ]
+            )
+            if name in names:
+                name = f"{name}-{len(instances)}"
+            names.add(name)
+
+            instance = copy.deepcopy(step)
+            instance["name"] = name
+            instance["group"] = step["name"]
+            instance["matrix"] = dict(zip(keys, values))
+            instances.append(instance)
+
+        return instances
+
     @staticmethod
     def dict_normalize(topic: dict):
-        """Normalize the task-dict, transformation of the 'run' shorthand"""
+        """
+        Normalize the task-dict, expansion of 'matrix' and transformation of the 'run'
+        shorthand
+        """
 
         errors = []
 
@@ -359,6 +492,30 @@ class Task(Resource):
             errors.append("Missing required top-level key: 'steps'")
             return errors
 
+        steps = []
+        for nr, step in enumerate(topic["steps"], 1):
+            if "matrix" not in step:
+                steps.append(step)
+                continue
+
+            matrix = step["matrix"]
+            if (
+                not isinstance(matrix, dict)
+                or not matrix
+                or not all(isinstance(v, list) and v for v in matrix.values())
+                or any(
+                    isinstance(el, (dict, list)) for v in matrix.values() for el in v
+                )
+            ):
+                errors.append(
+                    f"Invalid step({nr}); 'matrix' must map keys to lists of values"
+                )
+                return errors
+
+            steps += Task.matrix_expand(step)
+
+        topic["steps"] = steps
+
         for step in topic["steps"]:
             if step["name"].endswith(".py"):
                 errors.append(
@@ -424,7 +581,7 @@ class Task(Resource):
             errors.append(f"Duplicate step-names: {duplicate_names}")
             return errors
 
-        valid = set(["name", "uses", "with"])
+        valid = set(["name", "uses", "with", "needs", "cache", "matrix", "group"])
         required = set(["name", "uses"])
 
         for nr, step in enumerate(topic["steps"], 1):
@@ -469,6 +626,35 @@ class Task(Resource):
                         )
                         continue
 
+        for nr, step in enumerate(topic["steps"], 1):
+            cache = step.get("cache", False)
+            if not isinstance(cache, (bool, list)) or (
+                isinstance(cache, list) and not all(isinstance(k, str) for k in cache)
+            ):
+                errors.append(
+                    f"Invalid step({nr}); 'cache' must be a bool or a list of keys"
+                )
+
+        errors += scheduler.lint(topic["steps"])
+
+        return errors
+
+    @staticmethod
+    def dict_substitute(topic: dict, context: dict) -> list:
+        """
+        Substitute the task-dict, with the 'matrix' values of a step available to it
+        as {{ matrix.foo }}
+        """
+
+        rest = {key: value for key, value in topic.items() if key != "steps"}
+        errors = dict_substitute(rest, context)
+        topic.update(rest)
+
+        for step in topic.get("steps", []):
+            errors += dict_substitute(
+                step, {**context, "matrix": step.get("matrix", {})}
+            )
+
         return errors
 
     def load(self, args: Namespace, config: Config, extra_steps: list = []):
@@ -493,7 +679,7 @@ class Task(Resource):
         if errors:
             return errors
 
-        errors += dict_substitute(task_dict, default_context(config))
+        errors += Task.dict_substitute(task_dict, default_context(config))
         if errors:
             return errors
 
@@ -519,6 +705,99 @@ class Task(Resource):
         return errors
 
 
+class CollectorCache(object):
+    """
+    Persistent cache of the analysis of Script resources, keyed on path, and
+    invalidated by changes to mtime and size of the file.
+
+    The cache is stored at '$XDG_CACHE_HOME/cijoe/resources.json', defaulting to
+    '~/.cache/cijoe/resources.json', and is disabled by setting the environment
+    variable CIJOE_DISABLE_RESOURCE_CACHE.
+    """
+
+    FILENAME = "resources.json"
+    VERSION = 2
+
+    def __init__(self, path: Optional[Path]):
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.is_dirty = False
+
+    @staticmethod
+    def default_path():
+        cache_home = os.environ.get("XDG_CACHE_HOME", None)
+        cache_home = Path(cache_home) if cache_home else Path.home() / ".cache"
+
+        return cache_home / "cijoe" / CollectorCache.FILENAME
+
+    def load(self):
+        """Load the cache from file; an invalid or outdated cache is ignored"""
+
+        if self.path is None:
+            return
+
+        try:
+            with self.path.open("r") as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            return
+
+        if cache.get("version") != [CollectorCache.VERSION, __version__]:
+            return
+
+        self.entries = cache.get("entries", {})
+
+    def get(self, path, stat) -> Optional[Dict[str, Any]]:
+        """Returns the cached analysis of 'path', None when missing or outdated"""
+
+        entry = self.entries.get(str(path), None)
+        if entry is None or stat is None:
+            return None
+        if (entry["mtime_ns"], entry["size"]) != (stat.st_mtime_ns, stat.st_size):
+            return None
+
+        return entry["analysis"]
+
+    def put(self, path, stat, analysis: Dict[str, Any]):
+        if stat is None:
+            return
+
+        self.entries[str(path)] = {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "analysis": analysis,
+        }
+        self.is_dirty = True
+
+    def save(self):
+        """Atomically write the cache to file, dropping entries of removed files"""
+
+        if self.path is None or not self.is_dirty:
+            return
+
+        cache = {
+            "version": [CollectorCache.VERSION, __version__],
+            "entries": {
+                path: entry
+                for path, entry in self.entries.items()
+                if Path(path).exists()
+            },
+        }
+
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.path.parent, delete=False
+            ) as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(cache_file.name, self.path)
+        except OSError as exc:
+            log.debug(f"failed writing cache({self.path}); {exc}")
+            return
+
+        self.is_dirty = False
+
+
 class Collector(object):
     """Collects resources from installed packages and the current working directory"""
 
@@ -530,7 +809,7 @@ class Collector(object):
         ("auxiliary", ".*"),
     ]
     LEGACY_CATEGORIES = {"workflows": "tasks"}
-    IGNORE = ["__init__.py", "__pycache__", "setup.py"]
+    IGNORE = [".keep", "__init__.py", "__pycache__", "setup.py"]
 
     def __new__(cls):
         if not hasattr(cls, "instance"):
@@ -545,9 +824,13 @@ class Collector(object):
 
         if category == "scripts":
             resource = Script(candidate, pkg)
-            resource.content_from_file()
 
-            if not resource.content_has_script_func():
+            stat = candidate.stat() if isinstance(candidate, Path) else None
+            resource.analysis = self.cache.get(candidate, stat)
+            if resource.analysis is None:
+                self.cache.put(candidate, stat, resource.analyse())
+
+            if resource.analysis["entry"] is None:
                 category = "auxiliary"
         elif category == "configs":
             resource = Config(candidate, pkg)
@@ -561,6 +844,11 @@ class Collector(object):
     def reset(self):
         self.resources = {category: {} for category, _ in Collector.RESOURCES}
         self.is_done = False
+        self.cache = CollectorCache(
+            None
+            if os.environ.get("CIJOE_DISABLE_RESOURCE_CACHE", None)
+            else CollectorCache.default_path()
+        )
 
     def collect_from_path(self, path=None, max_depth=2):
         """Collects non-packaged scripts from the given 'path'"""
@@ -622,6 +910,8 @@ class Collector(object):
         if self.is_done:
             return
 
+        self.cache.load()
+
         self.collect_from_packages(cijoe.__path__, "cijoe.")
         self.collect_from_path()
 
@@ -636,6 +926,8 @@ class Collector(object):
         if home.exists():
             self.collect_from_path(home)
 
+        self.cache.save()
+
         self.is_done = True
 
 
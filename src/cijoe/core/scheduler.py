@@ -0,0 +1,183 @@
+"""
+    Scheduler
+    =========
+
+    Executes the steps of a task as a directed acyclic graph. The edges of the graph
+    are given by the optional 'needs' key of a step, listing the names of preceding
+    steps that must pass before the step can begin. A step without 'needs' waits for
+    all preceding steps to finish, thus, a task without any 'needs' is executed
+    sequentially, in the order the steps are listed. The exception being steps of the
+    same 'group', e.g. the instances of a step with a 'matrix', which do not wait for
+    each other. A step can need a group by its name, that is, all of its steps.
+
+    Steps whose dependencies are done are executed concurrently, limited by
+    'max_workers'. With a single worker, then the steps are executed by the calling
+    thread, just as they would be without a scheduler. When a needed step fails, or
+    is itself blocked, or is not executed since it is not selected, then the step is
+    blocked, that is, it is not executed. With
+    'fail_fast', then no further steps are started once a step has failed, the steps
+    already running are waited for.
+"""
+
+import logging as log
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Optional
+
+
+def step_needs(step: dict, groups: Optional[Dict[str, List[str]]] = None) -> List[str]:
+    """
+    Returns the list of step-names that the given step needs, with the names of
+    'groups' expanded to the names of their steps
+    """
+
+    needs = step.get("needs", [])
+    needs = [needs] if isinstance(needs, str) else list(needs)
+    if not groups:
+        return needs
+
+    return [name for need in needs for name in groups.get(need, [need])]
+
+
+def step_groups(steps: List[dict]) -> Dict[str, List[str]]:
+    """Returns the names of the steps of each group, e.g. the instances of a matrix"""
+
+    groups: Dict[str, List[str]] = {}
+    for step in steps:
+        if "group" in step:
+            groups.setdefault(step["group"], []).append(step["name"])
+
+    return groups
+
+
+def lint(steps: List[dict]) -> List[str]:
+    """Returns a list of errors in the 'needs' of the given steps"""
+
+    errors = []
+
+    preceding: List[str] = []
+    for nr, step in enumerate(steps, 1):
+        needs = step.get("needs", [])
+        if not isinstance(needs, (str, list)) or not all(
+            isinstance(need, str) for need in step_needs(step)
+        ):
+            errors.append(f"Invalid step({nr}); 'needs' must be a list of step-names")
+        else:
+            unknown = [
+                need
+                for need in step_needs(step)
+                if need not in preceding or need == step.get("group")
+            ]
+            if unknown:
+                errors.append(
+                    f"Invalid step({nr}); 'needs' unknown or succeeding steps{unknown}"
+                )
+
+        preceding.append(step["name"])
+        if "group" in step and step["group"] not in preceding:
+            preceding.append(step["group"])
+
+    return errors
+
+
+class Scheduler(object):
+    """
+    Executes the given 'steps' by calling 'execute(step)', which must return True
+    when the step failed. Blocked steps are given to 'block(step)'. Steps that are
+    already 'done', e.g. when resuming a task-run, are not executed.
+    """
+
+    def __init__(
+        self,
+        steps: List[dict],
+        execute: Callable[[dict], bool],
+        block: Callable[[dict], None],
+        max_workers: int = 1,
+        fail_fast: bool = False,
+        done: Optional[Dict[str, str]] = None,
+    ):
+        self.steps = steps
+        self.execute = execute
+        self.block = block
+        self.max_workers = max(int(max_workers), 1)
+        self.fail_fast = fail_fast
+
+        # The names of the steps that each step needs, and waits for
+        groups = step_groups(steps)
+        self.needs: Dict[str, List[str]] = {
+            step["name"]: step_needs(step, groups) for step in steps
+        }
+        self.waits: Dict[str, List[str]] = {}
+        for nr, step in enumerate(steps):
+            if "needs" in step:
+                self.waits[step["name"]] = self.needs[step["name"]]
+            else:
+                self.waits[step["name"]] = [
+                    prev["name"]
+                    for prev in steps[:nr]
+                    if "group" not in step or prev.get("group") != step["group"]
+                ]
+
+        # Status of the steps that are done: "passed", "failed", or "blocked"
+        self.done: Dict[str, str] = dict(done) if done else {}
+
+    def ready(self, step: dict) -> bool:
+        """Returns True when all the steps that 'step' waits for are done"""
+
+        return all(name in self.done for name in self.waits[step["name"]])
+
+    def blocked(self, step: dict) -> bool:
+        """Returns True when any of the steps that 'step' needs did not pass"""
+
+        return any(self.done[need] != "passed" for need in self.needs[step["name"]])
+
+    def submit(self, executor: ThreadPoolExecutor, step: dict) -> Future:
+        """Submit the given step for execution, inline, when there is no concurrency"""
+
+        if self.max_workers > 1:
+            return executor.submit(self.execute, step)
+
+        future: Future = Future()
+        future.set_result(self.execute(step))
+
+        return future
+
+    def run(self) -> Dict[str, str]:
+        """Execute the steps, returns the status of the steps that are done"""
+
+        pending = [step for step in self.steps if step["name"] not in self.done]
+        running: Dict = {}
+        stopped = False
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                progress = not stopped
+                while progress:
+                    progress = False
+                    for step in [step for step in pending if self.ready(step)]:
+                        if len(running) >= self.max_workers:
+                            break
+
+                        pending.remove(step)
+                        progress = True
+
+                        if self.blocked(step):
+                            self.done[step["name"]] = "blocked"
+                            self.block(step)
+                            continue
+
+                        running[self.submit(executor, step)] = step
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    failed = future.result()
+                    self.done[step["name"]] = "failed" if failed else "passed"
+
+                    if failed and self.fail_fast and not stopped:
+                        log.error(f"exiting, fail_fast({self.fail_fast})")
+                        stopped = True
+
+        return self.done
@@ -9,16 +9,29 @@ Retargtable: false
 
 The report-generator works on the files generated by cijoe on the host which is
 executing cijoe. Thus, no need to make this re-targetable.
+
+Paginated
+---------
+
+For tasks with many commands, or with large command-output, then the report can
+be paginated, via '--report_paginate true' or the configuration key
+'cijoe.report.paginate'. The 'report.html' is then a lightweight index page, with
+a page for each step, and each test, in the 'report' directory. Only a preview of
+each command-output is inlined, the first 'cijoe.report.preview' bytes, along
+with a link to the full output.
 """
 
 import logging as log
+import os
 import webbrowser
 from argparse import ArgumentParser, _StoreAction
 from datetime import datetime
+from pathlib import Path
 
 import jinja2
 import yaml
 
+from cijoe.core.misc import ENCODING, sanitize_ident
 from cijoe.core.processing import process_task_output
 from cijoe.core.resources import get_resources
 
@@ -35,6 +48,19 @@ def add_args(parser: ArgumentParser):
         action=StringToBoolAction,
         help="Whether or not the generated report should be opened (in a browser)",
     )
+    parser.add_argument(
+        "--report_paginate",
+        choices=["true", "false"],
+        default=None,
+        action=StringToBoolAction,
+        help="Produce an index page, with a page per step and test (default: False)",
+    )
+    parser.add_argument(
+        "--report_jobs",
+        type=int,
+        default=1,
+        help="Number of threads processing the task output (default: 1)",
+    )
 
 
 def to_yaml(value):
@@ -59,10 +85,59 @@ def timestamp_to_txt(value):
     return datetime.fromtimestamp(float(value)).strftime("%d-%m-%Y, %H:%M:%S")
 
 
+@jinja2.pass_context
+def href(context, value):
+    """Returns the given path as a link relative to the page being rendered"""
+
+    return os.path.relpath(value, context["page_dir"])
+
+
+def render_to_file(template, path: Path, **context):
+    """Renders the given template to 'path', one chunk at a time"""
+
+    os.makedirs(path.parent, exist_ok=True)
+    with path.open("w", encoding=ENCODING) as page:
+        for chunk in template.generate(page_dir=path.parent, **context):
+            page.write(chunk)
+
+
+def produce_pages(jinja_env, task_state: dict, output: Path, report_path: Path):
+    """Produce the index page at 'report_path', and the pages of steps and tests"""
+
+    pages = Path("report")
+    for step in task_state["steps"]:
+        step["page"] = pages / f"{step['id']}.html"
+        tests = step["extras"].get("testreport", {}).get("tests", {})
+        for nodeid, testcase in tests.items():
+            testcase["page"] = pages / step["id"] / f"{sanitize_ident(nodeid)}.html"
+
+    template = jinja_env.get_template("report-step.html.jinja2")
+    for step in task_state["steps"]:
+        render_to_file(template, output / step["page"], output=output, step=step)
+
+    template = jinja_env.get_template("report-test.html.jinja2")
+    for step in task_state["steps"]:
+        tests = step["extras"].get("testreport", {}).get("tests", {})
+        for testcase in tests.values():
+            render_to_file(
+                template,
+                output / testcase["page"],
+                output=output,
+                step=step,
+                testcase=testcase,
+            )
+
+    template = jinja_env.get_template("report-index.html.jinja2")
+    render_to_file(template, report_path, output=output, **task_state)
+
+
 def main(args, cijoe):
     """Produce a HTML report of the 'task.state' file in 'args.output'"""
 
     report_open = args.report_open
+    paginate = getattr(args, "report_paginate", None)
+    if paginate is None:
+        paginate = cijoe.getconf("cijoe.report.paginate", False)
 
     resources = get_resources()
 
@@ -72,7 +147,9 @@ def main(args, cijoe):
     log.info(f"template: {template_path}")
     log.info(f"report: {report_path}")
 
-    task_state = process_task_output(args, cijoe)
+    preview = cijoe.getconf("cijoe.report.preview", 16384) if paginate else None
+    jobs = getattr(args, "report_jobs", 1)
+    task_state = process_task_output(args, cijoe, preview, jobs)
 
     jinja_env = jinja2.Environment(
         autoescape=True, loader=jinja2.FileSystemLoader(template_path.parent)
@@ -80,10 +157,15 @@ def main(args, cijoe):
     jinja_env.filters["to_yaml"] = to_yaml
     jinja_env.filters["elapsed_txt"] = elapsed_txt
     jinja_env.filters["timestamp_to_txt"] = timestamp_to_txt
-    template = jinja_env.get_template(template_path.name)
-
-    with (report_path).open("w") as report:
-        report.write(template.render(task_state))
+    jinja_env.filters["href"] = href
+
+    if paginate:
+        produce_pages(jinja_env, task_state, args.output, report_path)
+    else:
+        template = jinja_env.get_template(template_path.name)
+        with (report_path).open("w") as report:
+            for chunk in template.generate(task_state):
+                report.write(chunk)
 
     if report_open:
         webbrowser.open("file://%s" % report_path.resolve())
@@ -0,0 +1,125 @@
+"""
+    Step cache
+    ==========
+
+    An opt-in cache of the results of task-steps which are pure functions of their
+    inputs. A step opts in with the key ``cache``, either ``true``, or a list of the
+    configuration keys that the step depends on, e.g.::
+
+        - name: build
+          uses: qemu.build
+          cache: [qemu.repository, qemu.build]
+
+    The cache-key is the digest of the inputs of the step: the identity and content
+    of the script, the resolved ``with`` arguments, and the effective values of the
+    listed configuration keys, or the entire configuration for ``true``.
+
+    An entry, stored in a directory named by the cache-key, holds the content of the
+    output-directory of the step, that is, its artifacts and command-runlog, as it
+    was when the step passed. On a cache hit, then the output-directory is restored
+    from the entry and the step is marked as passed (cached) without executing it.
+    Side-effects of the step outside of its output-directory are not cached.
+
+    The cache is stored at '$XDG_CACHE_HOME/cijoe/steps', defaulting to
+    '~/.cache/cijoe/steps', or at the path given by 'cijoe.cache.path'.
+"""
+
+import hashlib
+import json
+import logging as log
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import yaml
+
+from cijoe.core import __version__
+from cijoe.core.misc import ENCODING
+from cijoe.core.resources import CollectorCache
+
+DIRNAME = "steps"
+ENTRY_FILENAME = "step.yaml"
+
+
+def default_path() -> Path:
+    return CollectorCache.default_path().parent / DIRNAME
+
+
+class StepCache(object):
+    """Content-addressed cache of step-outputs, stored in directory at 'path'"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    @staticmethod
+    def inputs(script, step: dict, cijoe) -> Dict[str, Any]:
+        """Returns the inputs of the given step, as needed to compute the cache-key"""
+
+        if not script.content:
+            script.content_from_file()
+
+        effective = cijoe.getconf_effective()
+        if step["cache"] is True:
+            config = {key: item["value"] for key, item in effective.items()}
+        else:
+            config = {key: cijoe.getconf(key) for key in step["cache"]}
+
+        return {
+            "version": __version__,
+            "script": script.ident,
+            "content": hashlib.sha256(script.content.encode(ENCODING)).hexdigest(),
+            "with": step.get("with", {}),
+            "config": config,
+        }
+
+    @staticmethod
+    def key(inputs: Dict[str, Any]) -> str:
+        """Returns the cache-key, a digest, of the given inputs"""
+
+        text = json.dumps(inputs, sort_keys=True, default=str)
+
+        return hashlib.sha256(text.encode(ENCODING)).hexdigest()
+
+    def restore(self, key: str, output_path: Path) -> Optional[dict]:
+        """
+        Restore the output-directory of the step with the given 'key' to
+        'output_path'. Returns the cache-entry on a hit, None otherwise.
+        """
+
+        entry_path = self.path / key
+        try:
+            with (entry_path / ENTRY_FILENAME).open(encoding=ENCODING) as entry_file:
+                entry = yaml.safe_load(entry_file)
+        except (OSError, yaml.YAMLError):
+            return None
+
+        shutil.copytree(
+            entry_path / "output",
+            output_path,
+            dirs_exist_ok=True,
+            copy_function=shutil.copy,
+        )
+
+        return entry
+
+    def store(self, key: str, output_path: Path, inputs: Dict[str, Any], status: dict):
+        """Store the content of 'output_path' as the cache-entry for 'key'"""
+
+        entry_path = self.path / key
+        if entry_path.exists():
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=self.path, prefix=f".{key}."))
+        try:
+            shutil.copytree(output_path, tmp / "output")
+            with (tmp / ENTRY_FILENAME).open("w", encoding=ENCODING) as entry_file:
+                yaml.dump({"inputs": inputs, "status": status}, entry_file)
+
+            os.rename(tmp, entry_path)
+        except OSError as exc:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not entry_path.exists():
+                log.error(f"failed storing step-cache entry({entry_path}); err({exc})")
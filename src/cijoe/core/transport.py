@@ -1,8 +1,14 @@
+import atexit
 import errno
 import logging as log
 import os
+import selectors
 import shutil
+import socket
 import subprocess
+import threading
+import time
+import weakref
 from abc import ABC, abstractmethod
 from pathlib import Path
 
@@ -11,6 +17,54 @@ from scp import SCPClient
 
 from cijoe.core.resources import Config
 
+PUMP_CHUNK_SIZE = 64 * 1024
+
+# Opening a channel is retried when refused, with a linear backoff in seconds
+CHANNEL_OPEN_RETRIES = 5
+CHANNEL_OPEN_BACKOFF = 0.2
+
+# Transports with a persistent connection, closed by close_persistent() at exit
+PERSISTENT: "weakref.WeakSet[Transport]" = weakref.WeakSet()
+
+
+@atexit.register
+def close_persistent():
+    """Close the connections of the persistent transports; dangling ones hang exit"""
+
+    for transport in list(PERSISTENT):
+        transport.close()
+
+
+def pump(source, read, cmd_output, chunk_size=PUMP_CHUNK_SIZE):
+    """
+    Move output from 'source' to 'cmd_output' until end-of-file
+
+    The 'source' is anything with a fileno(), e.g. a pipe or a paramiko channel,
+    and read(size) must return up to 'size' bytes of what is available, and b""
+    on end-of-file. The source is waited on via a selector, and whatever is
+    available is read in a single call, thus, output is moved in bulk while
+    still being streamed to 'cmd_output' as soon as it is produced.
+    """
+
+    with selectors.DefaultSelector() as selector:
+        try:
+            selector.register(source, selectors.EVENT_READ)
+            selectable = True
+        except (OSError, ValueError):
+            selectable = False  # E.g. pipes on Windows; fall back to blocking reads
+
+        while True:
+            if selectable:
+                selector.select()
+
+            chunk = read(chunk_size)
+            if not chunk:
+                break
+
+            cmd_output.write(chunk)
+
+    cmd_output.flush()
+
 
 class Transport(ABC):
     @abstractmethod
@@ -18,11 +72,16 @@ class Transport(ABC):
         pass
 
     @abstractmethod
-    def get(self, src, dst=None):
+    def get(self, src, dst=None, output_ident=None):
         pass
 
     @abstractmethod
-    def put(self, src, dst=None):
+    def put(self, src, dst=None, output_ident=None):
+        pass
+
+    def close(self):
+        """Release any resources held by the transport"""
+
         pass
 
 
@@ -48,24 +107,21 @@ class Local(Transport):
             cwd=cwd,
             env=env,
         ) as process:
-            while process.poll() is None:
-                cmd_output.write(process.stdout.read(1))
-
-            cmd_output.write(process.stdout.read())
-            cmd_output.flush()
+            fd = process.stdout.fileno()
+            pump(process.stdout, lambda size: os.read(fd, size), cmd_output)
             process.wait()
 
             return process.returncode
 
-    def put(self, src, dst=None):
+    def put(self, src, dst=None, output_ident=None):
         """..."""
 
         if dst is None:
             dst = os.path.basename(src)
         if not os.path.isabs(src):
-            src = os.path.join(self.output_path, self.output_ident, src)
+            src = os.path.join(self.output_path, output_ident or self.output_ident, src)
         if not os.path.isabs(dst):
-            dst = os.path.join(self.output_path, self.output_ident, dst)
+            dst = os.path.join(self.output_path, output_ident or self.output_ident, dst)
 
         if src == dst:
             return True
@@ -77,15 +133,19 @@ class Local(Transport):
         shutil.copy(src, dst)
         return True
 
-    def get(self, src, dst=None):
+    def get(self, src, dst=None, output_ident=None):
         """..."""
 
-        return self.put(src, dst)
+        return self.put(src, dst, output_ident)
 
 
 class SSH(Transport):
     """Provide cmd/push/pull over SSH"""
 
+    # Keys in 'cijoe.transport.<name>' consumed by cijoe, the remaining keys are
+    # passed verbatim to paramiko.SSHClient.connect()
+    OPTIONS = {"persistent": False, "keepalive": 0}
+
     def __init__(self, config, output_path, transport_name):
         """Initialize the CIJOE SSH Transport"""
 
@@ -95,19 +155,20 @@ class SSH(Transport):
         )
         self.output_path = output_path
 
-        self.ssh = paramiko.SSHClient()
-        self.ssh_params = (
+        self.ssh = None
+        self.ssh_params = dict(
             self.config.options.get("cijoe", {}).get("transport").get(transport_name)
         )
+        self.options = {
+            key: self.ssh_params.pop(key, default)
+            for key, default in SSH.OPTIONS.items()
+        }
+        self.persistent = bool(self.options["persistent"])
 
-        # Using the 'AutoAddPolicy()' *without* load_system_host_keys(), by doing so,
-        # then Paramiko does not know any hosts, and simply adds them first time they
-        # are connected to.
-        # It was attempted to use load_system_host_keys() with WarningPolicy(), however,
-        # when a host changed, e.g. re-provisioned virtual machine, then the host-key
-        # changes and Paramiko cannot connect.
-        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        self.scp = None
+        # The connection is shared by concurrent calls, each running on its own
+        # channel; 'users' counts the calls currently using the connection
+        self.lock = threading.RLock()
+        self.users = 0
 
         # Not connecting at this point, since the remote side might be ready at the time
         # the transport is initialized. For example, when a qemu-guest is booted, then
@@ -115,21 +176,138 @@ class SSH(Transport):
         # used. Also, when a system reboots etc. then dropped connections must be
         # handled, lastly connection close must happen as Python terminates, dangling
         # connections will make it hang.
-        # Thus, __connect()/__disconnect() is called for each call to run()/get()/put().
-        # Current short-coming is of course that then these cannot happen in parallel.
+        #
+        # Thus, by default, __connect()/__disconnect() is called for each call to
+        # run()/get()/put(), concurrent calls share the connection until the last
+        # of them is done. When the transport is configured with 'persistent = true'
+        # then the connection is established on first use and kept alive across calls,
+        # dropped connections are detected and re-established, and the connection is
+        # closed at interpreter exit, by close_persistent().
+        if self.persistent:
+            PERSISTENT.add(self)
 
         log.getLogger("paramiko.transport").setLevel(log.CRITICAL)
         paramiko.util.log_to_file(
             self.output_path / "paramiko.log", level=log.root.level
         )
 
+    def is_connected(self):
+        """Returns True when there is an active connection to the remote side"""
+
+        if self.ssh is None:
+            return False
+
+        ssh_transport = self.ssh.get_transport()
+
+        return ssh_transport is not None and ssh_transport.is_active()
+
     def __connect(self):
+        """Connect or re-use the connection, returns True when re-used"""
+
+        with self.lock:
+            reused = self.is_connected()
+            if not reused:
+                self.__open()
+            self.users += 1
+
+        return reused
+
+    def __open(self):
+        self.__close()
+
+        # Using the 'AutoAddPolicy()' *without* load_system_host_keys(), by doing so,
+        # then Paramiko does not know any hosts, and simply adds them first time they
+        # are connected to.
+        # It was attempted to use load_system_host_keys() with WarningPolicy(), however,
+        # when a host changed, e.g. re-provisioned virtual machine, then the host-key
+        # changes and Paramiko cannot connect.
+        self.ssh = paramiko.SSHClient()
+        self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self.ssh.connect(**self.ssh_params)
-        self.scp = SCPClient(self.ssh.get_transport())
+
+        if self.options["keepalive"]:
+            self.ssh.get_transport().set_keepalive(int(self.options["keepalive"]))
 
     def __disconnect(self):
-        self.scp.close()
-        self.ssh.close()
+        with self.lock:
+            self.users = max(self.users - 1, 0)
+            if self.persistent or self.users:
+                return
+
+            self.__close()
+
+    def __close(self):
+        if self.ssh:
+            self.ssh.close()
+            self.ssh = None
+
+    def close(self):
+        """Close the connection, if any"""
+
+        with self.lock:
+            self.users = 0
+            self.__close()
+
+    def __exec_command(self, cmd, env, reused):
+        """Returns stdout of 'cmd' started on a channel of the connection"""
+
+        ssh = self.ssh
+        retries = 0
+        while True:
+            try:
+                _, stdout, _ = ssh.exec_command(cmd, environment=env)
+                return stdout
+            except paramiko.ssh_exception.ChannelException:
+                # The connection is alive, the remote side refused to open another
+                # channel, e.g. its MaxSessions is reached; wait for channels of
+                # concurrent calls to close, and try again on the same connection
+                retries += 1
+                if retries > CHANNEL_OPEN_RETRIES:
+                    raise
+                log.debug(f"channel refused; retry({retries})")
+                time.sleep(CHANNEL_OPEN_BACKOFF * retries)
+            except (paramiko.ssh_exception.SSHException, EOFError, socket.error):
+                if not reused:
+                    raise
+
+                # The connection went stale, e.g. the remote side rebooted, nothing
+                # has been executed yet, so re-connect, unless another call already
+                # did so, and try again. A connection that is still active is shared
+                # with concurrent calls, thus, it is not torn down
+                with self.lock:
+                    if self.ssh is ssh and self.is_connected():
+                        raise
+                    if self.ssh is ssh:
+                        log.debug("connection dropped; re-connecting")
+                        self.__open()
+                    ssh = self.ssh
+                reused = False
+
+    def __scp(self, action, src, dst, reused):
+        """Transfer 'src' to 'dst' using the scp-method 'action', 'put' or 'get'"""
+
+        ssh = self.ssh
+        while True:
+            try:
+                with SCPClient(ssh.get_transport()) as scp:
+                    getattr(scp, action)(src, dst, recursive=True)
+                return
+            except (paramiko.ssh_exception.SSHException, EOFError, socket.error):
+                # When the connection itself dropped, then it is closed, such that
+                # the next call re-connects; a re-used connection might have gone
+                # stale, e.g. the remote side rebooted, then re-connect and try again
+                with self.lock:
+                    if self.ssh is ssh and self.is_connected():
+                        raise
+                    if not reused:
+                        if self.ssh is ssh:
+                            self.__close()
+                        raise
+                    if self.ssh is ssh:
+                        log.debug("connection dropped; re-connecting")
+                        self.__open()
+                    ssh = self.ssh
+                reused = False
 
     def run(self, cmd, cwd, env, cmd_output):
         """Invoke the given command"""
@@ -161,20 +339,16 @@ class SSH(Transport):
             cmd = f"cd {cwd}; {cmd}"
 
         try:
-            self.__connect()
-
-            _, stdout, _ = self.ssh.exec_command(cmd, environment=env)
-            stdout.channel.set_combine_stderr(True)
-
-            while not stdout.channel.exit_status_ready():
-                cmd_output.write(stdout.read(1))
+            reused = self.__connect()
+            try:
+                channel = self.__exec_command(cmd, env, reused).channel
+                channel.set_combine_stderr(True)
 
-            cmd_output.write(stdout.read())
-            cmd_output.flush()
+                pump(channel, channel.recv, cmd_output)
 
-            err = stdout.channel.recv_exit_status()
-
-            self.__disconnect()
+                err = channel.recv_exit_status()
+            finally:
+                self.__disconnect()
         except paramiko.ssh_exception.SSHException as exc:
             err = (
                 exc.errno
@@ -191,34 +365,34 @@ class SSH(Transport):
 
         return err
 
-    def put(self, src, dst=None):
+    def put(self, src, dst=None, output_ident=None):
         """Hmm... no return-value just exceptions"""
 
-        self.__connect()
-
         if dst is None:
             dst = os.path.basename(src)
         if not os.path.isabs(src):
-            src = os.path.join(self.output_path, self.output_ident, src)
+            src = os.path.join(self.output_path, output_ident or self.output_ident, src)
 
-        self.scp.put(src, dst, recursive=True)
-
-        self.__disconnect()
+        reused = self.__connect()
+        try:
+            self.__scp("put", src, dst, reused)
+        finally:
+            self.__disconnect()
 
         return True
 
-    def get(self, src, dst=None):
+    def get(self, src, dst=None, output_ident=None):
         """Hmm... no return-value just exceptions"""
 
-        self.__connect()
-
         if dst is None:
             dst = os.path.basename(src)
         if not os.path.isabs(src):
-            dst = os.path.join(self.output_path, self.output_ident, dst)
+            dst = os.path.join(self.output_path, output_ident or self.output_ident, dst)
 
-        self.scp.get(src, dst, recursive=True)
-
-        self.__disconnect()
+        reused = self.__connect()
+        try:
+            self.__scp("get", src, dst, reused)
+        finally:
+            self.__disconnect()
 
         return True
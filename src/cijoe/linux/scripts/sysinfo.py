@@ -27,10 +27,7 @@ def main(args, cijoe):
         "lspci",
     ]
 
-    err = 0
-    for cmd in commands:
-        err, state = cijoe.run(cmd)
-        if err:
-            err = err
+    # The commands are independent of each other; thus, run them concurrently
+    results = cijoe.run_many(commands)
 
-    return err
+    return next((err for err, _ in results if err), 0)
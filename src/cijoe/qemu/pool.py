@@ -0,0 +1,513 @@
+"""
+    Pool of warm qemu guests
+    ========================
+
+    A pool of identical guests, booted from one disk image, ahead of the tasks using
+    them. Each task leases a guest of the pool, a member, and releases it when done.
+    The pool is configured by 'qemu.pools.<POOL NAME>', e.g.::
+
+        [qemu.pools.workers]
+        guest = "generic-bios-kvm-x86_64"   # The guest that members are copies of
+        transport = "qemu_guest"            # The transport that leases are copies of
+        path = "{{ local.env.HOME }}/guests/pool-workers"
+        size = 4
+
+    A member is a copy of the configuration of the guest, with a guest_path of its
+    own, 'path/<nr>', and a boot drive that is a qcow2 overlay of the disk image.
+    The members are given unique 'tcp_forward' host ports, 'host_port + nr' when
+    'host_port' is set, otherwise, they are allocated when the pool is started.
+
+    A lease is a configuration file, with the transport of the member, to be given
+    along with the configuration of the task e.g. ``cijoe -c task.toml -c
+    lease.toml``. The state of the pool, and its leases, are files in the pool
+    directory, guarded by a file-lock, thus, cijoe processes can share the pool.
+
+    On release, then the member is recycled, unless 'recycle' is false. That is, it
+    is restarted with a new overlay, thus, reset to the content of the disk image.
+    With 'snapshot', then members are resumed from a snapshot, taken when first
+    booted, instead of booting them. The pool keeps count of the leases and the
+    time members are leased, recycled, etc., see metrics().
+
+    Leases left behind are reclaimed, that is, the member is recycled, when leasing.
+    These are expired leases, and members booting or recycling by a process that is
+    no longer running, or members in any of these states, or failed, for more than
+    'stale_timeout' seconds, defaulting to 600.
+"""
+
+import copy
+import errno
+import fcntl
+import logging as log
+import os
+import socket
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from pprint import pformat
+from typing import Any, Dict, List, Optional, Tuple
+
+import psutil
+import yaml
+
+from cijoe.core.resources import dict_to_tomlfile
+from cijoe.qemu.wrapper import Guest
+
+LEASE_STATES = ["booting", "leased", "recycling", "failed"]
+
+
+def allocate_ports(address: str, count: int, first: Optional[int] = None):
+    """
+    Returns (err, ports), the 'count' ports from 'first', or, without 'first',
+    ports allocated by the operating system. Ports are checked to be free on the
+    host 'address'.
+    """
+
+    ports: List[int] = []
+    socks = []
+    try:
+        for nr in range(count):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            socks.append(sock)
+            port = 0 if first is None else first + nr
+            try:
+                sock.bind((address, port))
+            except OSError as exc:
+                log.error(f"port({port}) on address({address}) is not free; {exc}")
+                return exc.errno or errno.EADDRINUSE, []
+
+            ports.append(sock.getsockname()[1])
+    finally:
+        for sock in socks:
+            sock.close()
+
+    return 0, ports
+
+
+class GuestPool(object):
+    """Pool of guests, configured by 'qemu.pools.<pool_name>'"""
+
+    def __init__(self, cijoe, config, pool_name):
+        qemu_config = config.options.get("qemu", {})
+        pool_config = qemu_config.get("pools", {}).get(pool_name, None)
+        if not pool_config:
+            raise ValueError(f"Invalid pool_config({pformat(pool_config)})")
+
+        guest_config = qemu_config.get("guests", {}).get(pool_config.get("guest"))
+        if not guest_config:
+            raise ValueError(f"Invalid guest_config({pformat(guest_config)})")
+
+        path = pool_config.get("path", None)
+        size = int(pool_config.get("size", 0))
+        transport_name = pool_config.get("transport", None)
+        if not (path and size > 0 and transport_name):
+            log.error(f"invalid pool_config({pformat(pool_config)})")
+            raise ValueError("Invalid configuration")
+
+        self.cijoe = cijoe
+        self.config = config
+        self.pool_name = pool_name
+        self.pool_config = pool_config
+        self.guest_config = guest_config
+        self.size = size
+
+        self.transport_name = transport_name
+        self.transport = (
+            config.options.get("cijoe", {}).get("transport", {}).get(transport_name, {})
+        )
+
+        self.host_port = pool_config.get("host_port", None)
+        self.recycle = bool(pool_config.get("recycle", True))
+        self.snapshot = bool(pool_config.get("snapshot", False))
+        self.stale_timeout = float(pool_config.get("stale_timeout", 600))
+
+        self.path = Path(path).resolve()
+        self.lock_path = self.path / "pool.lock"
+        self.state_path = self.path / "pool.yaml"
+        self.leases_path = self.path / "leases"
+
+    @contextmanager
+    def lock(self):
+        """Exclusive access to the state of the pool, among threads and processes"""
+
+        os.makedirs(self.leases_path, exist_ok=True)
+        with self.lock_path.open("a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def load_state(self) -> Dict[str, Any]:
+        """Returns the state of the pool, {} when it has not been started"""
+
+        try:
+            with self.state_path.open() as state_file:
+                return yaml.safe_load(state_file) or {}
+        except FileNotFoundError:
+            return {}
+
+    def dump_state(self, state: Dict[str, Any]):
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=".pool.")
+        with os.fdopen(fd, "w") as state_file:
+            yaml.dump(state, state_file)
+        os.replace(tmp, self.state_path)
+
+    def lease_path(self, nr: int) -> Path:
+        return self.leases_path / f"{nr:02d}.yaml"
+
+    def lease_config_path(self, nr: int) -> Path:
+        return self.leases_path / f"{nr:02d}.toml"
+
+    def leases(self) -> Dict[int, Dict[str, Any]]:
+        """Returns the leases, by member number; call with the lock held"""
+
+        leases = {}
+        for path in sorted(self.leases_path.glob("*.yaml")):
+            with path.open() as lease_file:
+                lease = yaml.safe_load(lease_file)
+            leases[int(lease["member"])] = lease
+
+        return leases
+
+    def set_lease(self, nr: int, state: str, **kwargs):
+        lease = {
+            "member": nr,
+            "state": state,
+            "changed": time.time(),
+            "holder": f"{socket.gethostname()}:{os.getpid()}",
+            **kwargs,
+        }
+        with self.lease_path(nr).open("w") as lease_file:
+            yaml.dump(lease, lease_file)
+
+        return lease
+
+    def is_stale(self, lease: Dict[str, Any], now: float) -> bool:
+        """Returns True when the given lease is left behind, see reclaim()"""
+
+        if lease["state"] == "leased":
+            return (lease.get("expires") or now) < now
+
+        host, _, pid = str(lease.get("holder", "")).rpartition(":")
+        if (
+            lease["state"] != "failed"
+            and host == socket.gethostname()
+            and pid.isdigit()
+            and not psutil.pid_exists(int(pid))
+        ):
+            return True
+
+        return now - lease.get("changed", now) > self.stale_timeout
+
+    def drop_lease(self, nr: int):
+        for path in [self.lease_path(nr), self.lease_config_path(nr)]:
+            path.unlink(missing_ok=True)
+
+    def member(self, nr: int, port: int) -> Guest:
+        """Returns the guest of member 'nr', forwarding the host 'port' to the guest"""
+
+        guest_config = copy.deepcopy(self.guest_config)
+        guest_config["path"] = str(self.path / f"{nr:02d}")
+
+        system_args = guest_config.setdefault("system_args", {})
+        tcp_forward = system_args.get("tcp_forward", None) or {"guest": 22}
+        system_args["tcp_forward"] = {**tcp_forward, "host": port}
+
+        return Guest(
+            self.cijoe, self.config, f"{self.pool_name}-{nr:02d}", guest_config
+        )
+
+    def members(self, state: Optional[Dict[str, Any]] = None) -> List[Guest]:
+        state = self.load_state() if state is None else state
+
+        return [self.member(nr, port) for nr, port in enumerate(state.get("ports", []))]
+
+    def boot(self, nr: int, state: Dict[str, Any], timeout=180) -> int:
+        """
+        (Re)start member 'nr' with a new overlay of the disk image of the pool, and
+        wait for it to be up. Returns 0 on success, errno on error.
+        """
+
+        guest = self.member(nr, state["ports"][nr])
+
+        err = guest.kill()
+        if err:
+            return err
+
+        err = guest.initialize(Path(state["image"]), overlay=True)
+        if err:
+            return err
+
+        if self.snapshot:
+            err, restored = guest.start_from_snapshot(timeout)
+            if err or restored:
+                return err
+
+        err = guest.start()
+        if err:
+            return err
+
+        if not guest.is_up(timeout):
+            log.error(f"member({nr}) is not up")
+            return errno.EAGAIN
+
+        if self.snapshot and guest.snapshot():
+            log.error(f"member({nr}) failed to snapshot; booting on recycle")
+
+        return 0
+
+    def start(self, diskimage_path: Path, timeout=180) -> int:
+        """
+        Start the pool with members booted from the given disk image, members of a
+        pool already started are killed. Returns 0 on success, errno on error.
+        """
+
+        err = self.stop()
+        if err:
+            return err
+
+        tcp_forward = self.guest_config.get("system_args", {}).get("tcp_forward", {})
+        address = (tcp_forward or {}).get("host_address", "127.0.0.1")
+        err, ports = allocate_ports(address, self.size, self.host_port)
+        if err:
+            return err
+
+        with self.lock():
+            state = {
+                "image": str(Path(diskimage_path).resolve()),
+                "ports": ports,
+                "started": time.time(),
+                "leases": 0,
+                "leased_seconds": 0.0,
+                "recycles": 0,
+                "recycle_seconds": 0.0,
+            }
+            self.dump_state(state)
+            for nr in range(self.size):
+                self.set_lease(nr, "booting")
+
+        def boot(nr):
+            err = self.boot(nr, state, timeout)
+            with self.lock():
+                if err:
+                    self.set_lease(nr, "failed", err=err)
+                else:
+                    self.drop_lease(nr)
+            return err
+
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            errs = list(executor.map(boot, range(self.size)))
+
+        failed = [nr for nr, err in enumerate(errs) if err]
+        if failed:
+            log.error(f"pool({self.pool_name}) members({failed}) failed to start")
+            return next(err for err in errs if err)
+
+        return 0
+
+    def stop(self) -> int:
+        """Kill the members of the pool and drop their leases"""
+
+        with self.lock():
+            state = self.load_state()
+            for nr, guest in enumerate(self.members(state)):
+                err = guest.kill()
+                if err:
+                    log.error(f"member({nr}) kill(); err({err})")
+                    return err
+                self.drop_lease(nr)
+
+            if state:
+                state["stopped"] = time.time()
+                self.dump_state(state)
+
+        return 0
+
+    def lease(
+        self, timeout=0, ttl: Optional[float] = None
+    ) -> Tuple[int, Optional[Dict[str, Any]]]:
+        """
+        Lease a member of the pool, waiting at most 'timeout' seconds for a member to
+        become free. With 'ttl', then the lease expires after 'ttl' seconds, and the
+        member is reclaimed. Returns (err, lease), with the configuration of the
+        transport of the leased member written to lease['config_path'].
+        """
+
+        deadline = time.time() + timeout
+        while True:
+            with self.lock():
+                state = self.load_state()
+                if not state.get("ports") or "stopped" in state:
+                    log.error(f"pool({self.pool_name}) is not started")
+                    return errno.ENODEV, None
+
+                leases = self.leases()
+                now = time.time()
+                reclaim = [
+                    nr for nr, lease in leases.items() if self.is_stale(lease, now)
+                ]
+                for nr, guest in enumerate(self.members(state)):
+                    if nr in leases:
+                        continue
+                    if not guest.is_running():
+                        reclaim.append(nr)
+                        continue
+
+                    transport = {**self.transport, "port": state["ports"][nr]}
+                    config_path = self.lease_config_path(nr)
+                    dict_to_tomlfile(
+                        {"cijoe": {"transport": {self.transport_name: transport}}},
+                        config_path,
+                    )
+                    lease = self.set_lease(
+                        nr,
+                        "leased",
+                        began=now,
+                        expires=now + ttl if ttl else None,
+                        config_path=str(config_path),
+                        transport=transport,
+                    )
+                    state["leases"] += 1
+                    self.dump_state(state)
+
+                    return 0, lease
+
+            for nr in reclaim:
+                self.reclaim(nr)
+
+            remaining = deadline - time.time()
+            if not reclaim and remaining <= 0:
+                log.error(f"pool({self.pool_name}) no free member within({timeout})")
+                return errno.EBUSY, None
+
+            time.sleep(min(max(remaining, 0), 1.0))
+
+    def release(self, nr: int, recycle: Optional[bool] = None, timeout=180) -> int:
+        """
+        Release the lease of member 'nr'. With 'recycle', defaulting to
+        'qemu.pools.POOL.recycle', then the member is restarted with a new overlay,
+        before it is leased again. Returns 0 on success, errno on error.
+        """
+
+        recycle = self.recycle if recycle is None else recycle
+
+        with self.lock():
+            state = self.load_state()
+            if nr not in range(len(state.get("ports", []))):
+                log.error(f"pool({self.pool_name}) has no member({nr})")
+                return errno.EINVAL
+
+            lease = self.leases().get(nr, None)
+            if lease and lease["state"] in ["booting", "recycling"]:
+                log.info(f"member({nr}) is {lease['state']}; nothing to release")
+                return 0
+            if lease and lease["state"] == "leased":
+                state["leased_seconds"] += time.time() - lease["began"]
+
+            if recycle:
+                self.set_lease(nr, "recycling")
+            else:
+                self.drop_lease(nr)
+            self.dump_state(state)
+
+        if not recycle:
+            return 0
+
+        return self.recycle_member(nr, state, timeout)
+
+    def reclaim(self, nr: int, timeout=180) -> int:
+        """
+        Recycle member 'nr' when its lease is left behind, see is_stale(), or when it
+        is free, but not running. Returns 0 on success, errno on error.
+        """
+
+        with self.lock():
+            state = self.load_state()
+            lease = self.leases().get(nr, None)
+            now = time.time()
+            if lease is None:
+                if self.member(nr, state["ports"][nr]).is_running():
+                    return 0
+            elif not self.is_stale(lease, now):
+                return 0
+            elif lease["state"] == "leased":
+                state["leased_seconds"] += now - lease["began"]
+
+            log.info(f"reclaiming member({nr}); lease({lease})")
+            self.set_lease(nr, "recycling")
+            self.dump_state(state)
+
+        return self.recycle_member(nr, state, timeout)
+
+    def recycle_member(self, nr: int, state: Dict[str, Any], timeout=180) -> int:
+        """Boot member 'nr', marked as recycling, and drop its lease when it is up"""
+
+        began = time.time()
+        err = self.boot(nr, state, timeout)
+
+        with self.lock():
+            state = self.load_state()
+            state["recycles"] += 1
+            state["recycle_seconds"] += time.time() - began
+            self.dump_state(state)
+
+            if err:
+                self.set_lease(nr, "failed", err=err)
+            else:
+                self.drop_lease(nr)
+
+        return err
+
+    @contextmanager
+    def leased(self, timeout=0, ttl: Optional[float] = None):
+        """Lease a member for the duration of the with-statement"""
+
+        err, lease = self.lease(timeout, ttl)
+        if err or lease is None:
+            raise RuntimeError(err, f"failed leasing from pool({self.pool_name})")
+        try:
+            yield lease
+        finally:
+            self.release(lease["member"])
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Returns the size of the pool, the number of members in each lease-state, and
+        which are free, the number of leases, and seconds leased and recycling, since
+        the pool was started. The 'utilization' is the fraction of member-seconds that
+        members have been leased.
+        """
+
+        with self.lock():
+            state = self.load_state()
+            leases = self.leases()
+
+        now = state.get("stopped", time.time())
+        size = len(state.get("ports", []))
+        leased_seconds = state.get("leased_seconds", 0.0) + sum(
+            now - lease["began"]
+            for lease in leases.values()
+            if lease["state"] == "leased"
+        )
+        uptime = now - state.get("started", now)
+
+        metrics: Dict[str, Any] = {"size": size, "free": size - len(leases)}
+        for lease_state in LEASE_STATES:
+            metrics[lease_state] = sum(
+                1 for lease in leases.values() if lease["state"] == lease_state
+            )
+        metrics.update(
+            {
+                "leases": state.get("leases", 0),
+                "leased_seconds": leased_seconds,
+                "recycles": state.get("recycles", 0),
+                "recycle_seconds": state.get("recycle_seconds", 0.0),
+                "utilization": (
+                    leased_seconds / (size * uptime) if size and uptime else 0
+                ),
+            }
+        )
+
+        return metrics
@@ -0,0 +1,204 @@
+"""
+    Client of the QEMU Machine Protocol (QMP)
+
+    QMP is a JSON-based protocol, exposed by the qemu guest, via the unix-socket
+    'qmp.sock' in the guest_path, see Guest.start(). It is used to query the status
+    of the guest, its block-device and CPU statistics, to request a shutdown, and to
+    be notified of events, such as the guest shutting down, without polling.
+
+    Every call of the client is bounded by a timeout; messages are awaited via a
+    selector, thus, without polling. Events received while waiting for the response
+    to a command are kept, and handed out by wait_event().
+
+    Errors are logged and returned as errno, as is the convention of the qemu
+    wrapper, e.g.::
+
+        with QMP(guest.qmp) as qmp:
+            err, status = qmp.query_status()
+"""
+
+import errno
+import json
+import logging as log
+import selectors
+import socket
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from cijoe.core.misc import ENCODING
+
+
+class QMP(object):
+    """QMP client of the guest listening on the unix-socket at 'path'"""
+
+    def __init__(self, path: Path, timeout: float = 10.0):
+        self.path = Path(path)
+        self.timeout = timeout
+
+        self.sock: Optional[socket.socket] = None
+        self.selector: Optional[selectors.BaseSelector] = None
+        self.buffer = b""
+        self.events: List[Dict[str, Any]] = []
+        self.greeting: Dict[str, Any] = {}
+
+    def __enter__(self):
+        err = self.connect()
+        if err:
+            raise ConnectionError(err, f"failed connecting to QMP({self.path})")
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self) -> int:
+        """Connect, and negotiate capabilities; returns 0 on success, errno on error"""
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(str(self.path))
+        except OSError as exc:
+            log.debug(f"QMP({self.path}) connect failed; {exc}")
+            sock.close()
+            return exc.errno or errno.ECONNREFUSED
+
+        self.sock = sock
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sock, selectors.EVENT_READ)
+
+        greeting = self._recv(time.time() + self.timeout)
+        if greeting is None or "QMP" not in greeting:
+            log.error(f"QMP({self.path}) invalid greeting({greeting})")
+            self.close()
+            return errno.EPROTO
+        self.greeting = greeting["QMP"]
+
+        err, _ = self.execute("qmp_capabilities")
+        if err:
+            self.close()
+
+        return err
+
+    def close(self):
+        if self.selector:
+            self.selector.close()
+            self.selector = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def is_connected(self) -> bool:
+        return self.sock is not None
+
+    def _recv(self, deadline: float) -> Optional[Dict[str, Any]]:
+        """Returns the next message, None on timeout or when the peer hung up"""
+
+        while b"\n" not in self.buffer:
+            if not (self.sock and self.selector):
+                return None
+
+            remaining = deadline - time.time()
+            if remaining <= 0 or not self.selector.select(remaining):
+                return None
+
+            try:
+                data = self.sock.recv(65536)
+            except OSError as exc:
+                log.debug(f"QMP({self.path}) recv failed; {exc}")
+                data = b""
+            if not data:
+                self.close()
+                return None
+
+            self.buffer += data
+
+        line, _, self.buffer = self.buffer.partition(b"\n")
+
+        return json.loads(line.decode(ENCODING))
+
+    def execute(
+        self,
+        command: str,
+        arguments: Optional[Dict[str, Any]] = None,
+        timeout: Optional[float] = None,
+    ) -> Tuple[int, Any]:
+        """Execute the given command, returns (err, result)"""
+
+        if not self.sock:
+            log.error(f"QMP({self.path}) is not connected")
+            return errno.ENOTCONN, None
+
+        request: Dict[str, Any] = {"execute": command}
+        if arguments:
+            request["arguments"] = arguments
+
+        try:
+            self.sock.sendall(json.dumps(request).encode(ENCODING) + b"\n")
+        except OSError as exc:
+            log.error(f"QMP({self.path}) execute({command}) failed; {exc}")
+            return exc.errno or errno.EIO, None
+
+        deadline = time.time() + (self.timeout if timeout is None else timeout)
+        while True:
+            message = self._recv(deadline)
+            if message is None:
+                log.error(f"QMP({self.path}) execute({command}); no response")
+                return errno.ETIMEDOUT, None
+            if "event" in message:
+                self.events.append(message)
+                continue
+            if "error" in message:
+                log.error(f"QMP({self.path}) execute({command}); {message['error']}")
+                return errno.EIO, message["error"]
+
+            return 0, message.get("return")
+
+    def wait_event(self, names: List[str], timeout: float) -> Optional[Dict[str, Any]]:
+        """
+        Wait at most 'timeout' seconds for an event with one of the given 'names',
+        returns the event, or None on timeout, or when the guest hung up.
+        """
+
+        deadline = time.time() + timeout
+        while True:
+            for event in self.events:
+                if event["event"] in names:
+                    self.events.remove(event)
+                    return event
+
+            message = self._recv(deadline)
+            if message is None:
+                return None
+            if "event" in message:
+                self.events.append(message)
+
+    def query_status(self) -> Tuple[int, Any]:
+        """Returns the run-state of the guest e.g. {'status': 'running', ...}"""
+
+        return self.execute("query-status")
+
+    def query_blockstats(self) -> Tuple[int, Any]:
+        """Returns the I/O statistics of the block-devices of the guest"""
+
+        return self.execute("query-blockstats")
+
+    def query_cpus(self) -> Tuple[int, Any]:
+        """Returns the virtual CPUs of the guest, along with their host thread-ids"""
+
+        return self.execute("query-cpus-fast")
+
+    def system_powerdown(self, timeout: float = 60.0) -> Tuple[int, bool]:
+        """
+        Request a graceful (ACPI) powerdown of the guest, and wait at most 'timeout'
+        seconds for it to shut down. Returns (err, shutdown).
+        """
+
+        err, _ = self.execute("system_powerdown")
+        if err:
+            return err, False
+
+        event = self.wait_event(["SHUTDOWN"], timeout)
+
+        return 0, event is not None or not self.is_connected()
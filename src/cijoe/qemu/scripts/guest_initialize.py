@@ -23,6 +23,13 @@ Configuration
   Name of the system image. This will be overwritten if also given as script
   argument.
 
+* ``qemu.guests.<GUEST NAME>.overlay``: bool
+
+  Create the boot drive as a thin qcow2 overlay, with the disk image as its
+  backing file, instead of a copy of the disk image. This will be overwritten if
+  also given as script argument. The disk image must not be modified while
+  guests are using it as backing file.
+
 * ``system-imaging.images.<SYSTEM IMAGE NAME>.disk``: dict
 
   A dictionary containing the path to the disk image and, if this path does not
@@ -33,7 +40,7 @@ Retargetable: False
 """
 import errno
 import logging as log
-from argparse import ArgumentParser
+from argparse import ArgumentParser, _StoreAction
 from pathlib import Path
 
 from cijoe.core.misc import download, download_and_verify
@@ -41,12 +48,23 @@ from cijoe.qemu.wrapper import Guest
 
 
 def add_args(parser: ArgumentParser):
+    class StringToBoolAction(_StoreAction):
+        def __call__(self, parser, namespace, values, option_string=None):
+            setattr(namespace, self.dest, values == "true")
+
     parser.add_argument("--guest_name", type=str, help="Name of the qemu guest.")
     parser.add_argument(
         "--system_image_name",
         type=str,
         help="Name of the system image. This will overwrite any system image name defined in the configuration file.",
     )
+    parser.add_argument(
+        "--overlay",
+        choices=["true", "false"],
+        default=None,
+        action=StringToBoolAction,
+        help="Create the boot image as a qcow2 overlay of the disk image.",
+    )
 
 
 def main(args, cijoe):
@@ -93,7 +111,7 @@ def main(args, cijoe):
             log.error(f"err({err}, path({path})")
             return err
 
-    err = guest.initialize(diskimage_path)
+    err = guest.initialize(diskimage_path, getattr(args, "overlay", None))
     if err:
         log.error(f"guest.initialize({diskimage_path}); err({err})")
         return err
@@ -6,6 +6,10 @@ Kill a qemu guest
 Shutdown qemu guests by killing the process using the pid associated with the
 given guest name. 
 
+With '--powerdown_timeout', then a graceful (ACPI) powerdown is requested first,
+via QMP, waiting at most the given amount of seconds for the guest to terminate,
+before killing it.
+
 Note: The script will not fail if the guest does not exist.
 
 Retargetable: False
@@ -19,6 +23,12 @@ from cijoe.qemu.wrapper import Guest
 
 def add_args(parser: ArgumentParser):
     parser.add_argument("--guest_name", type=str, help="Name of the qemu guest.")
+    parser.add_argument(
+        "--powerdown_timeout",
+        type=int,
+        default=0,
+        help="Seconds to wait for a graceful powerdown before killing the guest.",
+    )
 
 
 def main(args, cijoe):
@@ -30,4 +40,10 @@ def main(args, cijoe):
 
     guest = Guest(cijoe, cijoe.config, args.guest_name)
 
+    if getattr(args, "powerdown_timeout", 0) > 0:
+        err, terminated = guest.powerdown(args.powerdown_timeout)
+        if not err and terminated:
+            return 0
+        log.warning(f"Guest({args.guest_name}) not powered down; err({err})")
+
     return guest.kill()
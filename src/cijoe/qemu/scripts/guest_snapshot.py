@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Snapshot a qemu guest
+=====================
+
+Captures the state of the running qemu guest with the given guest name, its
+memory and devices, along with its boot drive. Subsequent starts, using
+``qemu.guest_start`` with ``--snapshot true``, then resume the guest from the
+snapshot instead of booting it. Use this after the first boot, and any
+provisioning, of the guest.
+
+The snapshot is stored in the guest_path, keyed on the digest of the disk image
+that the guest is initialized with, and on its system arguments. Thus, a change
+of either invalidates the snapshot.
+
+Retargetable: False
+-------------------
+"""
+import logging as log
+from argparse import ArgumentParser
+
+from cijoe.qemu.wrapper import Guest
+
+
+def add_args(parser: ArgumentParser):
+    parser.add_argument("--guest_name", type=str, help="Name of the qemu guest.")
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=600,
+        help="Amount of seconds to wait for the state of the guest to be captured.",
+    )
+
+
+def main(args, cijoe):
+    """Snapshot a qemu guest"""
+
+    if "guest_name" not in args:
+        log.error("missing argument: guest_name")
+        return 1
+
+    guest = Guest(cijoe, cijoe.config, args.guest_name)
+
+    err = guest.snapshot(args.timeout)
+    if err:
+        log.error(f"guest.snapshot() : err({err})")
+
+    return err
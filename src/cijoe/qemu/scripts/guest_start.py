@@ -4,20 +4,38 @@ Start a qemu guest
 ==================
 
 Starts the qemu guest with the given guest name. Fails if the guest is not up
-within 180 seconds.
+within 180 seconds. The guest is up when its serial output matches the regex
+``qemu.guests.<GUEST NAME>.ready_pattern``, defaulting to ``login:``. The
+seconds from start until the guest is up is recorded as the metric ``boot_time``
+of the step.
+
+With ``--snapshot true``, then the guest is resumed from its snapshot, taken via
+``qemu.guest_snapshot``, when there is one for the disk image and system
+arguments of the guest, otherwise it is booted.
 
 Retargetable: False
 -------------------
 """
 import errno
 import logging as log
-from argparse import ArgumentParser
+from argparse import ArgumentParser, _StoreAction
 
 from cijoe.qemu.wrapper import Guest
 
 
 def add_args(parser: ArgumentParser):
+    class StringToBoolAction(_StoreAction):
+        def __call__(self, parser, namespace, values, option_string=None):
+            setattr(namespace, self.dest, values == "true")
+
     parser.add_argument("--guest_name", type=str, help="Name of the qemu guest.")
+    parser.add_argument(
+        "--snapshot",
+        choices=["true", "false"],
+        default=False,
+        action=StringToBoolAction,
+        help="Resume the guest from its snapshot, when there is one.",
+    )
 
 
 def main(args, cijoe):
@@ -29,6 +47,16 @@ def main(args, cijoe):
 
     guest = Guest(cijoe, cijoe.config, args.guest_name)
 
+    if getattr(args, "snapshot", False):
+        err, restored = guest.start_from_snapshot(timeout=180)
+        if err:
+            log.error(f"guest.start_from_snapshot() : err({err})")
+            return err
+        if restored:
+            cijoe.metric("boot_time", guest.boot_time)
+            cijoe.metric("snapshot", True)
+            return 0
+
     err = guest.start()
     if err:
         log.error(f"guest.start() : err({err})")
@@ -39,4 +67,6 @@ def main(args, cijoe):
         log.error("guest.is_up() : False")
         return errno.EAGAIN
 
+    cijoe.metric("boot_time", guest.boot_time)
+
     return 0
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Lease a guest of a pool
+=======================
+
+Leases a member of the pool of qemu guests with the given pool name, waiting at
+most ``--timeout`` seconds for a member to become free. The lease is a
+configuration file, with the transport ``qemu.pools.<POOL NAME>.transport``
+forwarding to the leased member. It is written to the pool directory, and copied
+to the artifacts of the step as ``lease.toml``. Give it to cijoe along with the
+configuration of the task using the guest, e.g.::
+
+    cijoe -c task.toml -c lease.toml ...
+
+The leased member, and the utilization of the pool, are recorded as the metrics
+``member`` and ``pool`` of the step. Release the lease via ``qemu.pool_release``.
+
+Retargetable: False
+-------------------
+"""
+import errno
+import logging as log
+import shutil
+from argparse import ArgumentParser
+
+from cijoe.qemu.pool import GuestPool
+
+
+def add_args(parser: ArgumentParser):
+    parser.add_argument("--pool_name", type=str, help="Name of the pool of guests.")
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=0,
+        help="Amount of seconds to wait for a member to become free.",
+    )
+    parser.add_argument(
+        "--ttl",
+        type=int,
+        default=0,
+        help="Amount of seconds until the lease expires; 0 means never.",
+    )
+
+
+def main(args, cijoe):
+    """Lease a guest of a pool"""
+
+    if "pool_name" not in args:
+        log.error("missing argument: pool_name")
+        return errno.EINVAL
+
+    pool = GuestPool(cijoe, cijoe.config, args.pool_name)
+
+    err, lease = pool.lease(timeout=args.timeout, ttl=args.ttl or None)
+    if err:
+        log.error(f"pool.lease(); err({err})")
+        return err
+
+    shutil.copy(lease["config_path"], args.output / cijoe.output_ident / "lease.toml")
+    log.info(f"leased member({lease['member']}), config_path({lease['config_path']})")
+
+    cijoe.metric("member", lease["member"])
+    cijoe.metric("pool", pool.metrics())
+
+    return 0
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Release a guest of a pool
+=========================
+
+Releases the lease of the given member of the pool of qemu guests with the given
+pool name, as leased via ``qemu.pool_lease``. Unless ``--recycle false``, or
+``qemu.pools.<POOL NAME>.recycle = false``, then the member is restarted with a
+new overlay of the disk image, thus, reset to a clean state, before it is leased
+again.
+
+The utilization of the pool is recorded as the metric ``pool`` of the step.
+
+Retargetable: False
+-------------------
+"""
+import errno
+import logging as log
+from argparse import ArgumentParser, _StoreAction
+
+from cijoe.qemu.pool import GuestPool
+
+
+def add_args(parser: ArgumentParser):
+    class StringToBoolAction(_StoreAction):
+        def __call__(self, parser, namespace, values, option_string=None):
+            setattr(namespace, self.dest, values == "true")
+
+    parser.add_argument("--pool_name", type=str, help="Name of the pool of guests.")
+    parser.add_argument("--member", type=int, help="Number of the leased member.")
+    parser.add_argument(
+        "--recycle",
+        choices=["true", "false"],
+        default=None,
+        action=StringToBoolAction,
+        help="Restart the member with a new overlay of the disk image.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=180,
+        help="Amount of seconds to wait for a recycled member to be up.",
+    )
+
+
+def main(args, cijoe):
+    """Release a guest of a pool"""
+
+    if "pool_name" not in args or getattr(args, "member", None) is None:
+        log.error("missing argument: pool_name or member")
+        return errno.EINVAL
+
+    pool = GuestPool(cijoe, cijoe.config, args.pool_name)
+
+    err = pool.release(args.member, getattr(args, "recycle", None), args.timeout)
+    if err:
+        log.error(f"pool.release({args.member}); err({err})")
+
+    cijoe.metric("pool", pool.metrics())
+
+    return err
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Start a pool of qemu guests
+===========================
+
+Starts the pool of qemu guests with the given pool name, that is, ``size``
+members, each a copy of the guest ``qemu.pools.<POOL NAME>.guest``, with its own
+guest_path, a qcow2 overlay of the disk image as boot drive, and a unique
+``tcp_forward`` host port. The members are booted concurrently; fails if any is
+not up within the given timeout. Members of a pool already started are killed.
+
+The members are leased by tasks via ``qemu.pool_lease``, released via
+``qemu.pool_release`` and killed via ``qemu.pool_stop``. See
+:py:mod:`cijoe.qemu.pool` for the configuration of the pool.
+
+Configuration
+-------------
+
+* ``qemu.pools.<POOL NAME>.system_image_name``: str
+
+  Name of the system image, defaulting to the system image of the guest. This
+  will be overwritten if also given as script argument.
+
+* ``system-imaging.images.<SYSTEM IMAGE NAME>.disk``: dict
+
+  A dictionary containing the path to the disk image and, if this path does not
+  exist, a URL from where the disk image can be downloaded.
+
+Retargetable: False
+-------------------
+"""
+import errno
+import logging as log
+from argparse import ArgumentParser
+from pathlib import Path
+
+from cijoe.core.misc import download, download_and_verify
+from cijoe.qemu.pool import GuestPool
+
+
+def add_args(parser: ArgumentParser):
+    parser.add_argument("--pool_name", type=str, help="Name of the pool of guests.")
+    parser.add_argument(
+        "--system_image_name",
+        type=str,
+        help="Name of the system image. This will overwrite any system image name defined in the configuration file.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=180,
+        help="Amount of seconds to wait for each member to be up.",
+    )
+
+
+def main(args, cijoe):
+    """Start a pool of qemu guests"""
+
+    if "pool_name" not in args:
+        log.error("missing argument: pool_name")
+        return errno.EINVAL
+
+    pool = GuestPool(cijoe, cijoe.config, args.pool_name)
+
+    system_image_name = pool.pool_config.get(
+        "system_image_name", pool.guest_config.get("system_image_name", None)
+    )
+    if getattr(args, "system_image_name", None):
+        system_image_name = args.system_image_name
+
+    if system_image_name is None:
+        log.error("qemu.pools.THIS.system_image_name is not set")
+        return errno.EINVAL
+
+    if (
+        disk := cijoe.getconf(f"system-imaging.images.{system_image_name}.disk", None)
+    ) is None:
+        log.error(f"system-imaging.images.{system_image_name}.disk is not set")
+        return errno.EINVAL
+
+    if not (diskimage_path := Path(disk.get("path"))).exists():
+        if (disk_url := disk.get("url", None)) is None:
+            log.error(
+                f"Cannot download; no 'url' in configuration-file for disk({disk})"
+            )
+            return errno.EINVAL
+
+        diskimage_path.parent.mkdir(exist_ok=True, parents=True)
+
+        disk_url_checksum = disk.get("url_checksum", None)
+        err, path = (
+            download_and_verify(disk_url, disk_url_checksum, diskimage_path)
+            if disk_url_checksum
+            else download(disk_url, diskimage_path)
+        )
+        if err:
+            log.error(f"err({err}, path({path})")
+            return err
+
+    err = pool.start(diskimage_path, timeout=args.timeout)
+    if err:
+        log.error(f"pool.start({diskimage_path}); err({err})")
+
+    cijoe.metric("pool", pool.metrics())
+
+    return err
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Stop a pool of qemu guests
+==========================
+
+Kills the members of the pool of qemu guests with the given pool name, and drops
+their leases. The utilization of the pool, over the time it was started, is
+recorded as the metric ``pool`` of the step.
+
+Retargetable: False
+-------------------
+"""
+import errno
+import logging as log
+from argparse import ArgumentParser
+
+from cijoe.qemu.pool import GuestPool
+
+
+def add_args(parser: ArgumentParser):
+    parser.add_argument("--pool_name", type=str, help="Name of the pool of guests.")
+
+
+def main(args, cijoe):
+    """Stop a pool of qemu guests"""
+
+    if "pool_name" not in args:
+        log.error("missing argument: pool_name")
+        return errno.EINVAL
+
+    pool = GuestPool(cijoe, cijoe.config, args.pool_name)
+
+    err = pool.stop()
+    if err:
+        log.error(f"pool.stop(); err({err})")
+
+    cijoe.metric("pool", pool.metrics())
+
+    return err
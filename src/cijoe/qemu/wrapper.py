@@ -9,15 +9,31 @@
     machine to serve as a 'target' for tests.
 """
 
+import codecs
 import errno
+import hashlib
+import json
 import logging as log
 import os
+import re
+import shlex
+import shutil
+import sys
+import tempfile
+import threading
 import time
 from pathlib import Path
 from pprint import pformat
 from typing import Optional
 
 import psutil
+import yaml
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+from cijoe.qemu.qmp import QMP
+
+READY_PATTERN = r"login:"
 
 
 def qemu_img(cijoe, args=""):
@@ -37,6 +53,39 @@ def qemu_img(cijoe, args=""):
     return cijoe.run_local(f"{qemu_img_bin} {args}")
 
 
+def copy_image(cijoe, src: Path, dst: Path):
+    """
+    Copy the image at 'src' to 'dst'; on Linux, as a reflink (copy-on-write clone)
+    when the filesystem supports it, e.g. btrfs and xfs, a regular copy otherwise
+    """
+
+    reflink = ["--reflink=auto"] if sys.platform.startswith("linux") else []
+
+    return cijoe.run_local(" ".join(["cp", *reflink, str(src), str(dst)]))
+
+
+def image_digest(path: Path) -> str:
+    """
+    Returns a digest identifying the image at 'path'. This is the checksum in
+    '<path>.sha256', as produced by system_imaging, when it exists. Otherwise, then
+    it is a digest of the path, size and modification time of the image, as hashing
+    the content of a multi-GB image is slow.
+    """
+
+    path = Path(path).resolve()
+
+    checksum_path = path.with_name(f"{path.name}.sha256")
+    if checksum_path.exists():
+        checksum = checksum_path.read_text().split()
+        if checksum:
+            return checksum[0]
+
+    stat = path.stat()
+    identity = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
 def qemu_system(cijoe, system_label, args=""):
     """Resolves and invokes the qemu-system by its system_label e.g. 'x86_64'"""
 
@@ -48,16 +97,63 @@ def qemu_system(cijoe, system_label, args=""):
     return cijoe.run_local(f"{system_bin} {args}")
 
 
+class FileTail(object):
+    """
+    Reads the content appended to the file at 'path' since the previous read. The
+    text returned by read() is prefixed by the last 'window' characters of the
+    previous read, such that a pattern spanning two reads is still found.
+    """
+
+    def __init__(self, path: Path, window: int = 4096):
+        self.path = Path(path)
+        self.window = window
+        self.offset = 0
+        self.text = ""
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    def read(self) -> str:
+        try:
+            with self.path.open("rb") as tailfile:
+                if os.fstat(tailfile.fileno()).st_size < self.offset:
+                    self.offset = 0  # truncated; e.g. a restarted guest
+                tailfile.seek(self.offset)
+                data = tailfile.read()
+        except FileNotFoundError:
+            data = b""
+
+        self.offset += len(data)
+        text = self.text + self.decoder.decode(data)
+        self.text = text[-self.window :]
+
+        return text
+
+
+class FileModified(FileSystemEventHandler):
+    """Sets the given 'event' when the file at 'path' is created or modified"""
+
+    def __init__(self, path: Path, event: threading.Event):
+        self.path = str(path)
+        self.event = event
+
+    def on_any_event(self, event):
+        if self.path in (event.src_path, getattr(event, "dest_path", None)):
+            self.event.set()
+
+
 class Guest(object):
-    def __init__(self, cijoe, config, guest_name):
-        """."""
+    def __init__(self, cijoe, config, guest_name, guest_config=None):
+        """
+        The guest is configured by 'qemu.guests.<guest_name>', or by the given
+        'guest_config', e.g. a member of a GuestPool.
+        """
 
         qemu_config = config.options.get("qemu", {})
         qemu_guests = qemu_config.get("guests", [])
         if not (qemu_config and qemu_guests):
             raise ValueError(f"Invalid qemu_config({pformat(qemu_config)})")
 
-        guest_config = qemu_guests.get(guest_name, None)
+        if guest_config is None:
+            guest_config = qemu_guests.get(guest_name, None)
         if not guest_config:
             raise ValueError(f"Invalid guest_config({pformat(guest_config)})")
 
@@ -75,7 +171,12 @@ class Guest(object):
         self.boot_img = self.guest_path / "boot.img"
         self.pid = self.guest_path / "guest.pid"
         self.monitor = self.guest_path / "monitor.sock"
+        self.qmp = self.guest_path / "qmp.sock"
         self.serial = self.guest_path / "serial.output"
+        self.image_digest = self.guest_path / "image.digest"
+        self.snapshots = self.guest_path / "snapshots"
+
+        self.boot_time: Optional[float] = None
 
     def image_create(self, filename, fmt="raw", size="8GB"):
         """
@@ -111,17 +212,38 @@ class Guest(object):
 
         return pid
 
-    def initialize(self, diskimage_path: Optional[Path] = None):
-        """Create a 'home' for the guest'"""
+    def initialize(
+        self, diskimage_path: Optional[Path] = None, overlay: Optional[bool] = None
+    ):
+        """
+        Create a 'home' for the guest'. With 'diskimage_path', then the boot-image is
+        a copy of the given qcow2 image, or with 'overlay', a thin qcow2 image with the
+        given image as its backing file. The default for 'overlay' is given by
+        'qemu.guests.GUEST.overlay'.
+        """
 
         os.makedirs(self.guest_path, exist_ok=True)
 
-        if diskimage_path:
-            err, _ = self.cijoe.run_local(f"cp {diskimage_path} {self.boot_img}")
+        if overlay is None:
+            overlay = self.guest_config.get("overlay", False)
+
+        if diskimage_path and overlay:
+            backing = Path(diskimage_path).resolve()
+            err, _ = qemu_img(
+                self.cijoe, f"create -f qcow2 -b {backing} -F qcow2 {self.boot_img}"
+            )
+            if err:
+                log.error(f"Failed creating overlay of({diskimage_path}); err({err})")
+                return err
+        elif diskimage_path:
+            err, _ = copy_image(self.cijoe, diskimage_path, self.boot_img)
             if err:
                 log.error(f"Failed copying diskimage({diskimage_path}); err({err})")
                 return err
 
+        if diskimage_path:
+            self.image_digest.write_text(image_digest(diskimage_path))
+
         if self.guest_config.get("system_label", None) != "aarch64":
             return 0
 
@@ -150,33 +272,56 @@ class Guest(object):
 
         return 0
 
-    def is_up(self, timeout=120):
-        """Wait at most 'timeout' seconds for the guest to print 'login' to serial"""
+    def is_up(self, timeout=120, pattern: Optional[str] = None):
+        """
+        Wait at most 'timeout' seconds for the guest to print a line matching the
+        regex 'pattern' to serial, defaulting to 'qemu.guests.GUEST.ready_pattern',
+        or 'login:'. The serial output is read incrementally, as it is written. On
+        success, then the seconds from start of the guest until it is up is
+        available as 'boot_time'.
+        """
 
         if not self.is_running():
             log.error("is_running(), check via pid, is False")
             return False
 
+        pattern = pattern or self.guest_config.get("ready_pattern", READY_PATTERN)
+        regex = re.compile(pattern)
+
+        # The guest started when it wrote its pid-file
+        try:
+            started = self.pid.stat().st_mtime
+        except OSError:
+            started = time.time()
+
         began = time.time()
-        while True:
-            enter = time.time()
-            try:
-                if "login:" in self.serial.read_text(
-                    encoding="utf-8", errors="replace"
-                ):
+        tail = FileTail(self.serial)
+        modified = threading.Event()
+
+        observer = Observer()
+        observer.schedule(FileModified(self.serial, modified), str(self.guest_path))
+        observer.start()
+        try:
+            while True:
+                modified.clear()
+                if regex.search(tail.read()):
+                    self.boot_time = time.time() - started
+                    log.info(f"guest is up; boot_time({self.boot_time:.3f}) seconds")
                     return True
-            except Exception as exc:
-                log.error(f"{exc}")
 
-            now = time.time()
-            elapsed_iter = now - enter
-            elapsed_total = now - began
+                if time.time() - began > timeout:
+                    log.error(f"System did not come up within timeout({timeout}) sec")
+                    return False
+
+                if not self.is_running():
+                    log.error("guest terminated before it was up")
+                    return False
 
-            if elapsed_iter < 5.0:
-                time.sleep(5.0 - elapsed_iter)
-            if elapsed_total > timeout:
-                log.error(f"System did not come up within timeout({timeout}) seconds")
-                return False
+                # Woken up on modification; the timeout covers missed notifications
+                modified.wait(1.0)
+        finally:
+            observer.stop()
+            observer.join()
 
     def start(self, daemonize=True, extra_args=[]):
         """."""
@@ -221,6 +366,7 @@ class Guest(object):
         # Process Management stuff
         args += ["-pidfile", str(self.pid)]
         args += ["-monitor", f"unix:{self.monitor},server,nowait"]
+        args += ["-qmp", f"unix:{self.qmp},server,nowait"]
 
         if daemonize:
             args += ["-display", "none"]
@@ -278,23 +424,107 @@ class Guest(object):
 
         return 0
 
-    def wait_for_termination(self, timeout=60):
+    def qmp_connect(self, timeout=10.0) -> Optional[QMP]:
+        """Returns a QMP client connected to the guest, None when not available"""
+
+        if not self.qmp.exists():
+            return None
+
+        qmp = QMP(self.qmp, timeout)
+        if qmp.connect():
+            return None
+
+        return qmp
+
+    def status(self):
+        """Returns (err, status) with the run-state of the guest via QMP"""
+
+        qmp = self.qmp_connect()
+        if qmp is None:
+            log.error("QMP is not available; is the guest running?")
+            return errno.ENOTCONN, None
+
+        try:
+            return qmp.query_status()
+        finally:
+            qmp.close()
+
+    def stats(self):
+        """Returns (err, stats) with the block-device and CPU statistics via QMP"""
+
+        qmp = self.qmp_connect()
+        if qmp is None:
+            log.error("QMP is not available; is the guest running?")
+            return errno.ENOTCONN, None
+
+        try:
+            err, blockstats = qmp.query_blockstats()
+            if err:
+                return err, None
+            err, cpus = qmp.query_cpus()
+            if err:
+                return err, None
+        finally:
+            qmp.close()
+
+        return 0, {"block": blockstats, "cpus": cpus}
+
+    def wait_for_termination(self, timeout=60, qmp: Optional[QMP] = None):
         """
         Wait for 'timeout' seconds for the qemu guest to terminate. This method does
         not itself terminate the qemu guest. Returns (err: int, terminated: bool) where
         'terminated' defines whether the qemu guest has been terminated or not.
+
+        The guest is waited for via QMP, notified when it shuts down, and then via
+        its process, until it exits.
         """
-        err = 0
 
-        start = time.time()
-        while True:
-            if not self.get_pid():
-                return 0, True
-            if time.time() - start > timeout:
-                break
-            time.sleep(1)
+        began = time.time()
+
+        pid = self.get_pid()
+        if not pid:
+            return 0, True
+
+        own = qmp is None
+        qmp = self.qmp_connect() if own else qmp
+        if qmp:
+            qmp.wait_event(["SHUTDOWN"], timeout)
+            if own:
+                qmp.close()
+
+        try:
+            psutil.Process(pid).wait(max(timeout - (time.time() - began), 0))
+        except psutil.NoSuchProcess:
+            pass
+        except psutil.TimeoutExpired:
+            return 0, False
+
+        return 0, True
+
+    def powerdown(self, timeout=60):
+        """
+        Request a graceful (ACPI) powerdown of the guest, via QMP, and wait at most
+        'timeout' seconds for it to terminate. Returns (err, terminated).
+        """
+
+        if not self.get_pid():
+            return 0, True
+
+        qmp = self.qmp_connect()
+        if qmp is None:
+            log.error("QMP is not available; cannot request powerdown")
+            return errno.ENOTCONN, False
+
+        began = time.time()
+        try:
+            err, _ = qmp.system_powerdown(timeout)
+            if err:
+                return err, False
 
-        return err, False
+            remaining = max(timeout - (time.time() - began), 0)
+            return self.wait_for_termination(remaining, qmp)
+        finally:
+            qmp.close()
 
     def kill(self):
         """Shutdown qemu guests by killing the process using the 'guest.pid'"""
@@ -318,3 +548,157 @@ class Guest(object):
             log.info("Got 'NoSuchProcess', that is OK, continue.")
 
         return err
+
+    def snapshot_key(self) -> Optional[str]:
+        """
+        Returns the key of snapshots of the guest, a digest of the disk image that
+        the guest is initialized with, and of the system and its arguments. None when
+        the guest is not initialized with a disk image.
+        """
+
+        if not self.image_digest.exists():
+            return None
+
+        system_label = self.guest_config.get("system_label", None)
+        inputs = {
+            "image": self.image_digest.read_text().strip(),
+            "system_label": system_label,
+            "system_bin": self.cijoe.getconf(f"qemu.systems.{system_label}.bin", None),
+            "system_args": self.guest_config.get("system_args", {}),
+        }
+        text = json.dumps(inputs, sort_keys=True, default=str)
+
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def snapshot_path(self) -> Optional[Path]:
+        """Returns the path to the snapshot of the guest, None when there is none"""
+
+        key = self.snapshot_key()
+        if key is None or not (self.snapshots / key / "state").exists():
+            return None
+
+        return self.snapshots / key
+
+    def snapshot(self, timeout=600):
+        """
+        Capture the state of the running guest, its memory and devices via migration
+        to file, along with a copy of its boot drive, such that start_from_snapshot()
+        can resume it instead of booting it. The guest is paused while captured.
+        Returns 0 on success, errno on error.
+        """
+
+        key = self.snapshot_key()
+        if key is None:
+            log.error("Cannot snapshot; guest is not initialized with a disk image")
+            return errno.EINVAL
+
+        qmp = self.qmp_connect()
+        if qmp is None:
+            log.error("QMP is not available; is the guest running?")
+            return errno.ENOTCONN
+
+        os.makedirs(self.snapshots, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=self.snapshots, prefix=f".{key}."))
+        try:
+            err, _ = qmp.execute(
+                "migrate-set-capabilities",
+                {"capabilities": [{"capability": "events", "state": True}]},
+            )
+            if err:
+                return err
+
+            err, _ = qmp.execute("stop")
+            if err:
+                return err
+
+            state = shlex.quote(str(tmp / "state"))
+            err, _ = qmp.execute("migrate", {"uri": f"exec:cat > {state}"})
+            if err:
+                return err
+
+            deadline = time.time() + timeout
+            while True:
+                event = qmp.wait_event(["MIGRATION"], deadline - time.time())
+                if event is None:
+                    log.error(f"Migration did not complete within timeout({timeout})")
+                    return errno.ETIMEDOUT
+
+                status = event.get("data", {}).get("status")
+                if status == "completed":
+                    break
+                if status in ["failed", "cancelled"]:
+                    log.error(f"Migration to file failed; status({status})")
+                    return errno.EIO
+
+            for img in [self.boot_img, self.bios_img]:
+                if not img.exists():
+                    continue
+                err, _ = copy_image(self.cijoe, img, tmp / img.name)
+                if err:
+                    log.error(f"Failed copying image({img}); err({err})")
+                    return err
+
+            with (tmp / "snapshot.yaml").open("w") as snapshot_file:
+                yaml.dump({"key": key, "created": time.time()}, snapshot_file)
+
+            shutil.rmtree(self.snapshots / key, ignore_errors=True)
+            os.rename(tmp, self.snapshots / key)
+        finally:
+            qmp.execute("cont")
+            qmp.close()
+            shutil.rmtree(tmp, ignore_errors=True)
+
+        log.info(f"snapshot({self.snapshots / key})")
+
+        return 0
+
+    def start_from_snapshot(self, timeout=120):
+        """
+        Start the guest, resuming it from its snapshot, when there is a snapshot for
+        the disk image and system arguments of the guest. Returns (err, restored),
+        with the seconds until the guest is running, available as 'boot_time'.
+        """
+
+        path = self.snapshot_path()
+        if path is None:
+            return 0, False
+
+        began = time.time()
+        for img in [self.boot_img, self.bios_img]:
+            if not (path / img.name).exists():
+                continue
+            err, _ = copy_image(self.cijoe, path / img.name, img)
+            if err:
+                log.error(f"Failed restoring image({img}); err({err})")
+                return err, False
+
+        incoming = shlex.quote(f"exec:cat {shlex.quote(str(path / 'state'))}")
+        err = self.start(extra_args=["-incoming", incoming])
+        if err:
+            return err, False
+
+        qmp = self.qmp_connect()
+        if qmp is None:
+            log.error("QMP is not available; did the guest start?")
+            return errno.ENOTCONN, False
+
+        try:
+            while True:
+                err, status = qmp.query_status()
+                if err:
+                    return err, False
+                if status.get("running"):
+                    break
+
+                remaining = timeout - (time.time() - began)
+                if remaining <= 0:
+                    log.error(f"Guest did not resume within timeout({timeout})")
+                    return errno.ETIMEDOUT, False
+                qmp.wait_event(["RESUME"], min(remaining, 1.0))
+        finally:
+            qmp.close()
+
+        self.boot_time = time.time() - began
+        log.info(f"guest resumed from snapshot; boot_time({self.boot_time:.3f})")
+
+        return 0, True
@@ -41,7 +41,7 @@ from pathlib import Path
 from pprint import pformat
 
 from cijoe.core.misc import decompress_file, download
-from cijoe.qemu.wrapper import Guest
+from cijoe.qemu.wrapper import Guest, copy_image
 
 
 def add_args(parser: ArgumentParser):
@@ -110,7 +110,7 @@ def diskimage_from_cloudimage(cijoe, image: dict):
 
     guest = Guest(cijoe, cijoe.config, guest_name)
     guest.kill()  # Ensure the guest is *not* running
-    guest.initialize(cloud_image_path)  # Initialize using the cloudimage
+    guest.initialize(cloud_image_path, overlay=False)  # A copy of the cloudimage
 
     # Create seed.img, with data and meta embedded
     guest_metadata_path = guest.guest_path / "meta-data"
@@ -154,7 +154,7 @@ def diskimage_from_cloudimage(cijoe, image: dict):
     # Copy to disk-location
     disk_path = Path(disk.get("path"))
     disk_path.parent.mkdir(parents=True, exist_ok=True)
-    err, _ = cijoe.run_local(f"cp {guest.boot_img} {disk_path}")
+    err, _ = copy_image(cijoe, guest.boot_img, disk_path)
     if err:
         log.error(f"Failed copying to {disk_path}")
         return err
@@ -2,6 +2,8 @@ import os
 from pathlib import Path
 
 from cijoe.cli.cli import SEARCH_PATHS, search_for_file
+from cijoe.core.command import Cijoe
+from cijoe.core.resources import Config
 
 
 def test_cli_example_emit_listing(cijoe):
@@ -63,25 +65,85 @@ def test_cli_environment_variables(cijoe):
     # This test needs to be run in a session since we set a environment
     # variable and it should not pollute.
     os.environ["HELLO_WORLD"] = "true"
+    cijoe.refresh()
     message = cijoe.getconf("hello.world", None)
     assert message
 
     os.environ["HELLO_WORLD"] = "1"
+    cijoe.refresh()
     message = cijoe.getconf("hello.world", None)
 
     os.environ["HELLO_WORLD"] = "0x1"
+    cijoe.refresh()
     message = cijoe.getconf("hello.world", None)
     assert message == 1
 
     os.environ["HELLO_WORLD"] = "Hello World!"
+    cijoe.refresh()
     message = cijoe.getconf("hello.world", None)
     assert message == "Hello World!"
 
     # This should fail since 0xg is not a valid hex value
     os.environ["HELLO_WORLD"] = "0xg"
+    cijoe.refresh()
     message = cijoe.getconf("hello.world", None)
 
 
+def test_cli_environment_variables_snapshot(cijoe):
+    # Environment overrides are captured when constructed, and on refresh()
+    os.environ["HELLO_SNAPSHOT"] = "before"
+    cijoe.refresh()
+    assert cijoe.getconf("hello.snapshot") == "before"
+
+    os.environ["HELLO_SNAPSHOT"] = "after"
+    assert cijoe.getconf("hello.snapshot") == "before"
+
+    cijoe.refresh()
+    assert cijoe.getconf("hello.snapshot") == "after"
+
+    del os.environ["HELLO_SNAPSHOT"]
+    cijoe.refresh()
+    assert cijoe.getconf("hello.snapshot", "default") == "default"
+
+
+def test_cli_getconf_effective(tmp_path, monkeypatch):
+    config_path = tmp_path / "config.toml"
+    config_path.write_text('[foo]\nbar = 1\n\n[foo.baz]\nqux-quux = "file"\n')
+
+    config = Config(config_path)
+    assert not config.load()
+
+    monkeypatch.setenv("FOO_BAZ_QUX_QUUX", "env")
+    cijoe = Cijoe(config, tmp_path / "output", False)
+
+    assert cijoe.getconf("foo.bar") == 1
+    assert cijoe.getconf("foo.baz") == {"qux-quux": "file"}
+    assert cijoe.getconf("foo.bar.nope", "default") == "default"
+    assert cijoe.getconf_effective() == {
+        "foo.bar": {"value": 1, "source": "file", "path": config_path},
+        "foo.baz.qux-quux": {"value": "env", "source": "env"},
+    }
+
+
+def test_cli_config_layers(tmp_path):
+    base = tmp_path / "base.toml"
+    base.write_text('[foo]\nbar = 1\nbaz = "{{ 40 + 2 }}"\n\n[foo.qux]\nquux = 1\n')
+    top = tmp_path / "top.toml"
+    top.write_text('[foo]\nbar = 2\nqux = "replaced"\n')
+
+    config = Config(tmp_path / "config.orig", layers=[base, top])
+    assert not config.load()
+
+    assert config.options == {"foo": {"bar": 2, "baz": "42", "qux": "replaced"}}
+    assert config.provenance == {"foo.bar": top, "foo.baz": base, "foo.qux": top}
+
+    config.to_tomlfile(config.path)
+    orig = Config(config.path)
+    assert not orig.load()
+    assert orig.orig == config.orig
+    assert orig.orig["foo"]["baz"] == "{{ 40 + 2 }}"
+
+
 def test_cli_search_for_file_exists():
     filename = "tmpfile.txt"
     file = (SEARCH_PATHS[0] / filename).resolve()
@@ -1,11 +1,12 @@
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import cijoe.core
-from cijoe.core.resources import Collector
+from cijoe.core.resources import Collector, CollectorCache, Script
 
 CORE_RESOURCE_COUNTS = {
     "configs": 4,
-    "templates": 2,
+    "templates": 6,
     "auxiliary": 2,
     "scripts": 9,
 }
@@ -75,3 +76,69 @@ def test_collect_from_empty_path():
     collector.collect_from_path("/tmp")
 
     assert len(collector.resources["scripts"]) == 0, "Did not expect to find any"
+
+
+def test_collector_cache(tmp_path, monkeypatch):
+    """A warm start must not need to analyse the content of scripts"""
+
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path))
+
+    collector = Collector()
+    collector.reset()
+    collector.collect()
+
+    assert (tmp_path / "cijoe" / CollectorCache.FILENAME).exists()
+    cold = {ident: r.analysis for ident, r in collector.resources["scripts"].items()}
+
+    def analyse(self):
+        raise AssertionError(f"analysed({self.path}) with a warm cache")
+
+    monkeypatch.setattr(Script, "analyse", analyse)
+
+    collector.reset()
+    collector.collect()
+
+    warm = {ident: r.analysis for ident, r in collector.resources["scripts"].items()}
+    assert warm == cold
+
+
+def test_script_analyse(tmp_path):
+    """Only top-level functions are entry-points, and the content is parsed once"""
+
+    path = tmp_path / "nested.py"
+    path.write_text(
+        '"""Docs"""\n'
+        "def outer():\n"
+        "    def main(args, cijoe):\n"
+        "        pass\n"
+        "def add_args(parser):\n"
+        "    pass\n"
+    )
+
+    script = Script(path)
+    analysis = script.analyse()
+    assert analysis == {"entry": None, "has_argparser": True, "docs": "Docs"}
+    assert script.analyse() is analysis
+    assert not script.content_has_script_func()
+    assert script.load() == ["Missing script_entry() function in ast"]
+
+
+def test_script_load_concurrent(tmp_path):
+    """Concurrent loads of a script import its module once"""
+
+    imports = tmp_path / "imports"
+    path = tmp_path / "loaded.py"
+    path.write_text(
+        "import time\n"
+        f"with open({str(imports)!r}, 'a') as imports:\n"
+        "    imports.write('imported\\n')\n"
+        "time.sleep(0.2)\n"
+        "def main(args, cijoe):\n"
+        "    pass\n"
+    )
+
+    script = Script(path)
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        assert list(executor.map(lambda _: script.load(), range(4))) == [[]] * 4
+
+    assert imports.read_text().splitlines() == ["imported"]
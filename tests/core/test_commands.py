@@ -1,3 +1,8 @@
+from cijoe.core.command import Tee
+from cijoe.core.misc import read_output
+from cijoe.core.processing import runlog_from_path
+
+
 def test_hello():
     assert True
 
@@ -12,3 +17,80 @@ def test_default_again(cijoe):
     err, state = cijoe.run("ls")
 
     assert err == 0
+
+
+def test_run_many(cijoe):
+    cmds = [f"echo cmd{nr}" for nr in range(1, 17)]
+
+    results = cijoe.run_many(cmds, max_workers=4)
+
+    assert len(results) == len(cmds)
+    for nr, (err, state) in enumerate(results, 1):
+        assert err == 0
+        assert state.output_fpath.name == f"cmd_{nr:02}.output"
+        assert state.output().strip() == f"cmd{nr}"
+
+
+def test_submit(cijoe):
+    futures = [cijoe.submit(f"echo {word}") for word in ["hello", "world"]]
+
+    assert [future.result()[1].output().strip() for future in futures] == [
+        "hello",
+        "world",
+    ]
+
+
+def test_output_bulk(cijoe):
+    """Large output, with multi-byte characters, must arrive intact"""
+
+    err, state = cijoe.run("python3 -c \"print('æøå' * 100000)\"")
+
+    assert err == 0
+    assert state.output().strip() == "æøå" * 100000
+
+
+def test_tee_binary(tmp_path, capsys):
+    """Output is captured as-is, and only the monitor-mirror is decoded"""
+
+    data = "æøå\n".encode("utf-8") + b"\xff\n"
+
+    with Tee(tmp_path / "cmd_01.output", True) as tee:
+        for nr in range(len(data)):
+            tee.write(data[nr : nr + 1])
+
+    assert (tmp_path / "cmd_01.output").read_bytes() == data
+    assert capsys.readouterr().out == "æøå\n�\n"
+
+
+def test_output_bounded_and_compressed(cijoe):
+    """Keep head and tail of the output, and the full output compressed"""
+
+    cijoe.output_head, cijoe.output_tail, cijoe.output_compress = 4, 4, True
+    try:
+        err, state = cijoe.run("printf 'headXXXXXXXXtail'")
+    finally:
+        cijoe.output_head, cijoe.output_tail, cijoe.output_compress = None, None, False
+
+    assert err == 0
+    assert state.output() == "head\n[cijoe: elided 8 bytes]\ntail"
+    assert read_output(state.output_fpath.with_suffix(".output.gz")) == (
+        "headXXXXXXXXtail"
+    )
+
+    runlog = runlog_from_path(state.output_dpath)
+    assert runlog[state.output_fpath.stem]["output"] == state.output()
+
+
+def test_runlog_lazy(cijoe):
+    """The runlog loads state and output on access, with a bounded preview"""
+
+    err, state = cijoe.run("printf 'headXXXXXXXXtail'")
+    assert err == 0
+
+    runlog = runlog_from_path(state.output_dpath, preview=4)[state.output_fpath.stem]
+    assert runlog["state"]["is_done"]
+    assert runlog._output is None
+
+    assert runlog["output"] == "head"
+    assert runlog["output_truncated"]
+    assert runlog.output_preview(64) == ("headXXXXXXXXtail", False)
@@ -1,12 +1,15 @@
 import copy
+import json
 import subprocess
 from argparse import Namespace
 from pathlib import Path
 
 import yaml
 
-from cijoe.core.processing import runlog_from_path
-from cijoe.core.resources import get_resources
+from cijoe.core import journal, processing
+from cijoe.core.command import Cijoe
+from cijoe.core.processing import process_task_output, runlog_from_path
+from cijoe.core.resources import Config, Substitution, Task, get_resources
 
 TASK_SKELETON = {
     "doc": "Some description",
@@ -119,6 +122,148 @@ def test_task_report_command_ordering(tmp_path):
         assert count == val
 
 
+def test_task_report_paginated(tmp_path):
+
+    config_path = (tmp_path / "test-config.toml").resolve()
+    config_path.write_text("[cijoe.report]\npaginate = true\npreview = 16\n")
+
+    data = copy.deepcopy(TASK_SKELETON)
+    data["steps"].append({"name": "cmdrunner", "run": "seq 1000"})
+
+    output_path = (tmp_path / "output").resolve()
+    task_file = (tmp_path / "task.yaml").resolve()
+    task_file.write_text(yaml.dump(data))
+
+    result = subprocess.run(
+        [
+            "cijoe",
+            str(task_file),
+            "--output",
+            str(output_path),
+            "--config",
+            str(config_path),
+            "--skip-report",
+        ],
+        cwd=str(tmp_path),
+    )
+    assert result.returncode == 0
+
+    index = (output_path / "report.html").read_text()
+    assert 'href="report/002_cmdrunner.html"' in index
+    assert "seq 1000" not in index
+
+    page = (output_path / "report" / "002_cmdrunner.html").read_text()
+    assert "Output truncated" in page
+    assert 'href="../002_cmdrunner/cmd_01.output"' in page
+    assert "\n999\n" not in page
+
+
+def test_task_process_output_jobs(tmp_path):
+    """Processing with multiple threads yields the same task-state"""
+
+    config_path = (tmp_path / "test-config-empty.toml").resolve()
+    config_path.write_text("")
+
+    data = copy.deepcopy(TASK_SKELETON)
+    data["steps"].append({"name": "cmdrunner", "run": "echo hello\necho world"})
+
+    output_path = (tmp_path / "output").resolve()
+    task_file = (tmp_path / "task.yaml").resolve()
+    task_file.write_text(yaml.dump(data))
+
+    result = subprocess.run(
+        [
+            "cijoe",
+            str(task_file),
+            "--output",
+            str(output_path),
+            "--config",
+            str(config_path),
+            "--no-report",
+        ],
+        cwd=str(tmp_path),
+    )
+    assert result.returncode == 0
+
+    step_path = output_path / "002_cmdrunner"
+    records = []
+    for nr in range(50):
+        nodeid = f"tests/test_foo.py::test_bar[{nr}]"
+        records.append(
+            {
+                "$report_type": "TestReport",
+                "nodeid": nodeid,
+                "outcome": "passed",
+                "duration": 0.1,
+                "longrepr": None,
+            }
+        )
+        node_path = step_path / f"tests_test_foo_py__test_bar_{nr}_"
+        node_path.mkdir()
+        (node_path / "cmd_01.output").write_text(f"node {nr}")
+    (step_path / "testreport.log").write_text(
+        "\n".join(json.dumps(record) for record in records)
+    )
+
+    args = Namespace(output=output_path)
+    cijoe = Namespace(config=Namespace(options={}))
+
+    serial = process_task_output(args, cijoe)
+    parallel = process_task_output(args, cijoe, jobs=8)
+
+    # The workers load the runlogs, rather than the renderer, on access
+    runlogs = [parallel["steps"][1]["extras"]["runlog"]] + [
+        test["runlog"]
+        for test in parallel["steps"][1]["extras"]["testreport"]["tests"].values()
+    ]
+    assert all(
+        cmd._output is not None and cmd._state is not None
+        for runlog in runlogs
+        for cmd in runlog.values()
+    )
+
+    assert serial == parallel
+
+    tests = parallel["steps"][1]["extras"]["testreport"]["tests"]
+    assert list(tests) == [record["nodeid"] for record in records]
+    assert [test["runlog"]["cmd_01"]["output"] for test in tests.values()] == [
+        f"node {nr}" for nr in range(50)
+    ]
+
+
+def test_testreport_index(tmp_path):
+    """The testreport is parsed once, then read from the index until modified"""
+
+    records = [
+        {"$report_type": "SessionStart", "pytest_version": "8.0.0"},
+        {
+            "$report_type": "TestReport",
+            "nodeid": "test_foo.py::test_bar",
+            "outcome": "passed",
+            "duration": 0.5,
+            "longrepr": None,
+        },
+        {"$report_type": "CollectReport", "nodeid": "", "outcome": "passed"},
+    ]
+    logpath = tmp_path / "testreport.log"
+    logpath.write_text("\n".join(json.dumps(record) for record in records))
+
+    testreport = processing.testreport_from_file(tmp_path)
+    assert testreport["status"]["passed"] == 1
+    assert list(testreport["tests"]) == ["test_foo.py::test_bar"]
+    assert testreport["tests"]["test_foo.py::test_bar"]["count"] == 1
+
+    idxpath = tmp_path / "testreport.idx"
+    idx = json.loads(idxpath.read_text())
+    idx["tests"][0]["outcome"] = ["skipped"]
+    idxpath.write_text(json.dumps(idx))
+    assert processing.testreport_from_file(tmp_path)["status"]["skipped"] == 1
+
+    records[1]["outcome"] = "failed"
+    logpath.write_text("\n".join(json.dumps(record) for record in records) + "\n")
+    assert processing.testreport_from_file(tmp_path)["status"]["failed"] == 1
+
+
 def test_task_run(tmp_path):
     config_path = (tmp_path / "test-config-empty.toml").resolve()
     config_path.write_text("")
@@ -198,3 +343,526 @@ def test_task_run_multiline(tmp_path):
 
     assert len(runlog) == 1
     assert "hello world" in runlog["cmd_01"]["output"]
+
+
+def test_task_run_journal(tmp_path):
+    """With state.format 'journal', the YAML state-files are restored on demand"""
+
+    config_path = (tmp_path / "test-config-journal.toml").resolve()
+    config_path.write_text('[cijoe.state]\nformat = "journal"\n')
+
+    data = copy.deepcopy(TASK_SKELETON)
+    data["steps"].append({"name": "cmdrunner", "run": "echo hello\necho world"})
+
+    output_path = (tmp_path / "output").resolve()
+    task_file = (tmp_path / "task.yaml").resolve()
+    task_file.write_text(yaml.dump(data))
+
+    result = subprocess.run(
+        [
+            "cijoe",
+            str(task_file),
+            "--output",
+            str(output_path),
+            "--config",
+            str(config_path),
+            "--no-report",
+        ],
+        cwd=str(tmp_path),
+    )
+    assert result.returncode == 0
+
+    assert (output_path / journal.FILENAME).exists()
+    assert not (output_path / "task.state").exists()
+    assert not list(output_path.glob("*/cmd_*.state"))
+
+    assert journal.restore(output_path)
+
+    state = yaml.safe_load((output_path / "task.state").read_text())
+    assert state["status"]["passed"] == 2
+    assert [step["status"]["passed"] for step in state["steps"]] == [1, 1]
+
+    runlog = runlog_from_path(output_path / "002_cmdrunner")
+    assert [cmd["state"]["is_done"] for cmd in runlog.values()] == [True, True]
+    assert "world" in runlog["cmd_02"]["output"]
+
+
+def test_journal_step_metrics(tmp_path):
+    """The metrics of a step are replayed along with its status"""
+
+    path = tmp_path / journal.FILENAME
+    steps = [{"id": "001_foo", "status": {"passed": 0}}]
+
+    jrnl = journal.Journal(path)
+    jrnl.task({"status": {"passed": 0}, "steps": steps})
+    step = {"status": {"passed": 1}, "metrics": {"boot_time": 1.5}}
+    jrnl.step(0, step, {"passed": 1})
+    jrnl.close()
+
+    task_state, _ = journal.replay(path)
+    assert task_state["steps"][0]["status"] == {"passed": 1}
+    assert task_state["steps"][0]["metrics"] == {"boot_time": 1.5}
+
+
+def test_state_journaled_by_task_runner_only(tmp_path):
+    """Cijoe-instances other than the task-runner, e.g. of tests, write YAML-files"""
+
+    config_path = tmp_path / "test-config-journal.toml"
+    config_path.write_text('[cijoe.state]\nformat = "journal"\n')
+
+    config = Config(config_path)
+    assert not config.load()
+
+    output_path = tmp_path / "output"
+    cijoe = Cijoe(config, output_path, False)
+    err, state = cijoe.run_local("echo hello")
+    assert not err
+
+    assert state.state_fpath.exists()
+    assert not (output_path / journal.FILENAME).exists()
+
+    cijoe = Cijoe(config, output_path, False, journaled=True)
+    assert cijoe.state_format == "journal"
+
+
+def test_task_run_lazy_import(tmp_path):
+    """Scripts are only imported when their step is executed"""
+
+    config_path = (tmp_path / "test-config-empty.toml").resolve()
+    config_path.write_text("")
+
+    (tmp_path / "broken.py").write_text(
+        '"""Fails on import"""\n'
+        "raise RuntimeError('imported')\n"
+        "def main(args, cijoe):\n"
+        "    return 0\n"
+    )
+
+    data = copy.deepcopy(TASK_SKELETON)
+    data["steps"].append({"name": "broken", "uses": "broken"})
+
+    task_file = (tmp_path / "task.yaml").resolve()
+    task_file.write_text(yaml.dump(data))
+
+    def run(output_path, *steps):
+        return subprocess.run(
+            [
+                "cijoe",
+                str(task_file),
+                *steps,
+                "--output",
+                str(output_path),
+                "--config",
+                str(config_path),
+                "--no-report",
+            ],
+            cwd=str(tmp_path),
+        )
+
+    result = run(tmp_path / "skipped", "foo")
+    assert result.returncode == 0
+
+    state = yaml.safe_load((tmp_path / "skipped" / "task.state").read_text())
+    assert state["steps"][1]["description"] == "Fails on import"
+    assert state["steps"][1]["status"]["skipped"] == 1
+
+    result = run(tmp_path / "failed")
+    assert result.returncode != 0
+
+    state = yaml.safe_load((tmp_path / "failed" / "task.state").read_text())
+    assert [step["status"]["passed"] for step in state["steps"]] == [1, 0]
+    assert state["steps"][1]["status"]["failed"] == 1
+
+
+def test_dict_substitute():
+    """Only strings with template-markers are rendered, and templates are reused"""
+
+    substitution = Substitution()
+    topic = {
+        "plain": "no markers\n",
+        "nested": [{"cmd": "echo {{ config.foo }}"}, ["{{ config.foo }}", 42]],
+    }
+    context = {"config": {"foo": "bar"}}
+
+    errors = substitution.substitute(topic, context)
+    assert not errors
+    assert topic == {
+        "plain": "no markers",
+        "nested": [{"cmd": "echo bar"}, ["bar", 42]],
+    }
+    assert list(substitution.templates) == ["echo {{ config.foo }}", "{{ config.foo }}"]
+
+    errors = substitution.substitute({"missing": "{{ config.nope.nope }}"}, context)
+    assert len(errors) == 1
+
+
+def test_task_run_needs(tmp_path):
+    """Steps with 'needs' run concurrently, and are blocked by failed needs"""
+
+    config_path = (tmp_path / "test-config-workers.toml").resolve()
+    config_path.write_text("[cijoe.task]\nmax_workers = 2\n")
+
+    data = copy.deepcopy(TASK_SKELETON)
+    data["steps"] += [
+        {"name": "slow", "run": "sleep 1\nfalse", "needs": []},
+        {"name": "fast", "run": "sleep 1", "needs": []},
+        {"name": "blocked", "run": "true", "needs": ["slow"]},
+        {"name": "barrier", "run": "true"},
+    ]
+
+    output_path = (tmp_path / "output").resolve()
+    task_file = (tmp_path / "task.yaml").resolve()
+    task_file.write_text(yaml.dump(data))
+
+    result = subprocess.run(
+        [
+            "cijoe",
+            str(task_file),
+            "--output",
+            str(output_path),
+            "--config",
+            str(config_path),
+            "--no-report",
+        ],
+        cwd=str(tmp_path),
+    )
+    assert result.returncode != 0
+
+    state = yaml.safe_load((output_path / "task.state").read_text())
+    statuses = {
+        step["name"]: [k for k in ["passed", "failed", "skipped"] if step["status"][k]]
+        for step in state["steps"]
+    }
+    assert statuses == {
+        "foo": ["passed"],
+        "slow": ["failed"],
+        "fast": ["passed"],
+        "blocked": ["skipped"],
+        "barrier": ["passed"],
+    }
+
+    slow = runlog_from_path(output_path / "002_slow")["cmd_01"]["state"]
+    fast = runlog_from_path(output_path / "003_fast")["cmd_01"]["state"]
+    assert fast["begin"] < slow["end"] and slow["begin"] < fast["end"]
+
+    barrier = runlog_from_path(output_path / "005_barrier")["cmd_01"]["state"]
+    assert barrier["begin"] >= max(slow["end"], fast["end"])
+
+
+def test_task_lint_needs(tmp_path):
+    """Steps can only need preceding steps"""
+
+    config_path = (tmp_path / "test-config-empty.toml").resolve()
+    config_path.write_text("")
+
+    data = copy.deepcopy(TASK_SKELETON)
+    data["steps"][0]["needs"] = ["bar"]
+    data["steps"].append({"name": "bar", "run": "true"})
+
+    task_file = (tmp_path / "task.yaml").resolve()
+    task_file.write_text(yaml.dump(data))
+
+    result = subprocess.run(
+        [
+            "cijoe",
+            str(task_file),
+            "--integrity-check",
+            "--config",
+            str(config_path),
+        ],
+        cwd=str(tmp_path),
+    )
+    assert result.returncode != 0
+
+
+def test_task_run_resume(tmp_path):
+    """A resumed task-run keeps the passed steps, and re-runs from the first failure"""
+
+    config_path = (tmp_path / "test-config-empty.toml").resolve()
+    config_path.write_text("")
+
+    marker = tmp_path / "marker"
+
+    data = copy.deepcopy(TASK_SKELETON)
+    data["steps"] += [
+        {"name": "first", "run": "date +%s%N"},
+        {"name": "second.step", "run": f"test -f {marker}"},
+        {"name": "third", "run": "true"},
+    ]
+
+    output_path = (tmp_path / "output").resolve()
+    task_file = (tmp_path / "task.yaml").resolve()
+    task_file.write_text(yaml.dump(data))
+
+    def run(*extra):
+        return subprocess.run(
+            [
+                "cijoe",
+                str(task_file),
+                "--output",
+                str(output_path),
+                "--config",
+                str(config_path),
+                "--no-report",
+                *extra,
+            ],
+            cwd=str(tmp_path),
+        )
+
+    assert run().returncode != 0
+    first = dict(runlog_from_path(output_path / "002_first")["cmd_01"])
+    (output_path / "003_second_step" / "stray").write_text("")
+
+    marker.write_text("")
+    assert run("--resume").returncode == 0
+
+    state = yaml.safe_load((output_path / "task.state").read_text())
+    assert state["status"]["passed"] == 4
+    assert state["status"]["failed"] == 0
+    assert runlog_from_path(output_path / "002_first")["cmd_01"] == first
+    assert len(runlog_from_path(output_path / "003_second_step")) == 1
+    assert not (output_path / "003_second_step" / "stray").exists()
+
+    # A modified task cannot be resumed
+    task_file.write_text(yaml.dump(data) + "\n# modified\n")
+    assert run("--resume").returncode != 0
+
+
+def test_task_run_cache(tmp_path):
+    """A step opting into the cache is restored, rather than executed, on a hit"""
+
+    config_path = (tmp_path / "test-config-cache.toml").resolve()
+    config_path.write_text(f'[cijoe.cache]\npath = "{tmp_path / "cache"}"\n')
+
+    data = copy.deepcopy(TASK_SKELETON)
+    data["steps"].append({"name": "cached", "run": "date +%s%N", "cache": True})
+
+    task_file = (tmp_path / "task.yaml").resolve()
+    task_file.write_text(yaml.dump(data))
+
+    def run(output_path):
+        result = subprocess.run(
+            [
+                "cijoe",
+                str(task_file),
+                "--output",
+                str(output_path),
+                "--config",
+                str(config_path),
+                "--no-report",
+            ],
+            cwd=str(tmp_path),
+        )
+        assert result.returncode == 0
+
+        state = yaml.safe_load((output_path / "task.state").read_text())
+        runlog = runlog_from_path(output_path / "002_cached")
+
+        return state["steps"][1]["status"], runlog["cmd_01"]["output"]
+
+    status, output = run(tmp_path / "cold")
+    assert status["passed"] and not status.get("cached")
+    assert len(list((tmp_path / "cache").iterdir())) == 1
+
+    status, cached = run(tmp_path / "warm")
+    assert status["passed"] and status["cached"]
+    assert cached == output
+
+
+def test_task_run_cache_unavailable(tmp_path):
+    """A step is executed, and passes, when the cache cannot be used"""
+
+    cache_path = tmp_path / "cache"
+    cache_path.write_text("not a directory")
+
+    config_path = (tmp_path / "test-config-cache.toml").resolve()
+    config_path.write_text(f'[cijoe.cache]\npath = "{cache_path}"\n')
+
+    data = copy.deepcopy(TASK_SKELETON)
+    data["steps"].append({"name": "cached.step", "run": "true", "cache": True})
+
+    output_path = (tmp_path / "output").resolve()
+    task_file = (tmp_path / "task.yaml").resolve()
+    task_file.write_text(yaml.dump(data))
+
+    result = subprocess.run(
+        [
+            "cijoe",
+            str(task_file),
+            "--output",
+            str(output_path),
+            "--config",
+            str(config_path),
+            "--no-report",
+        ],
+        cwd=str(tmp_path),
+    )
+    assert result.returncode == 0
+
+    state = yaml.safe_load((output_path / "task.state").read_text())
+    assert state["steps"][1]["status"]["passed"]
+    assert not state["steps"][1]["status"].get("cached")
+    assert len(runlog_from_path(output_path / "002_cached_step")) == 1
+
+
+def test_task_run_matrix(tmp_path):
+    """A step with a 'matrix' is expanded into concurrent instances"""
+
+    config_path = (tmp_path / "test-config-workers.toml").resolve()
+    config_path.write_text("[cijoe.task]\nmax_workers = 4\n")
+
+    data = copy.deepcopy(TASK_SKELETON)
+    data["steps"] += [
+        {
+            "name": "sleeper",
+            "uses": "core.cmdrunner",
+            "matrix": {"guest": ["a", "b"], "kernel": [5, 6]},
+            "with": {"commands": ["sleep 1", "echo {{ matrix.guest }}"]},
+        },
+        {"name": "after", "run": "true"},
+    ]
+
+    output_path = (tmp_path / "output").resolve()
+    task_file = (tmp_path / "task.yaml").resolve()
+    task_file.write_text(yaml.dump(data))
+
+    result = subprocess.run(
+        [
+            "cijoe",
+            str(task_file),
+            "--output",
+            str(output_path),
+            "--config",
+            str(config_path),
+            "--no-report",
+        ],
+        cwd=str(tmp_path),
+    )
+    assert result.returncode == 0
+
+    state = yaml.safe_load((output_path / "task.state").read_text())
+    instances = [step for step in state["steps"] if step.get("group") == "sleeper"]
+    assert [step["id"] for step in instances] == [
+        "002_sleeper-a-5",
+        "003_sleeper-a-6",
+        "004_sleeper-b-5",
+        "005_sleeper-b-6",
+    ]
+    assert [step["matrix"] for step in instances][-1] == {"guest": "b", "kernel": 6}
+
+    runlogs = [runlog_from_path(output_path / step["id"]) for step in instances]
+    assert [runlog["cmd_02"]["output"].strip() for runlog in runlogs] == list("aabb")
+
+    begins = [runlog["cmd_01"]["state"]["begin"] for runlog in runlogs]
+    ends = [runlog["cmd_01"]["state"]["end"] for runlog in runlogs]
+    assert max(begins) < min(ends)
+
+    after = runlog_from_path(output_path / "006_after")["cmd_01"]["state"]
+    assert after["begin"] >= max(ends)
+
+
+def test_task_matrix_expand_names():
+    """Instances are named by sanitized values, matching their output directory"""
+
+    step = {"name": "test", "matrix": {"guest": ["deb 12"], "kernel": ["6.6", 6.12]}}
+
+    assert [instance["name"] for instance in Task.matrix_expand(step)] == [
+        "test-deb_12-6_6",
+        "test-deb_12-6_12",
+    ]
+
+
+def test_task_run_needs_matrix(tmp_path):
+    """A step can need a matrix step by its name, that is, all of its instances"""
+
+    config_path = (tmp_path / "test-config-workers.toml").resolve()
+    config_path.write_text("[cijoe.task]\nmax_workers = 2\n")
+
+    data = copy.deepcopy(TASK_SKELETON)
+    data["steps"] += [
+        {
+            "name": "build",
+            "uses": "core.cmdrunner",
+            "matrix": {"cmd": ["true", "false"]},
+            "with": {"commands": ["{{ matrix.cmd }}"]},
+        },
+        {"name": "deploy", "run": "true", "needs": ["foo"]},
+        {"name": "test", "run": "true", "needs": ["build"]},
+    ]
+
+    output_path = (tmp_path / "output").resolve()
+    task_file = (tmp_path / "task.yaml").resolve()
+    task_file.write_text(yaml.dump(data))
+
+    result = subprocess.run(
+        [
+            "cijoe",
+            str(task_file),
+            "--output",
+            str(output_path),
+            "--config",
+            str(config_path),
+            "--no-report",
+        ],
+        cwd=str(tmp_path),
+    )
+    assert result.returncode != 0
+
+    state = yaml.safe_load((output_path / "task.state").read_text())
+    statuses = {
+        step["name"]: [k for k in ["passed", "failed", "skipped"] if step["status"][k]]
+        for step in state["steps"]
+    }
+    assert statuses == {
+        "foo": ["passed"],
+        "build-true": ["passed"],
+        "build-false": ["failed"],
+        "deploy": ["passed"],
+        "test": ["skipped"],
+    }
+
+
+def test_task_run_needs_deselected(tmp_path):
+    """A step is blocked when a step it needs is not selected"""
+
+    config_path = (tmp_path / "test-config-empty.toml").resolve()
+    config_path.write_text("")
+
+    data = copy.deepcopy(TASK_SKELETON)
+    data["steps"] += [
+        {"name": "provision", "run": "true"},
+        {"name": "test", "run": "true", "needs": ["provision"]},
+        {"name": "collect", "run": "true"},
+    ]
+
+    output_path = (tmp_path / "output").resolve()
+    task_file = (tmp_path / "task.yaml").resolve()
+    task_file.write_text(yaml.dump(data))
+
+    result = subprocess.run(
+        [
+            "cijoe",
+            str(task_file),
+            "test",
+            "collect",
+            "--output",
+            str(output_path),
+            "--config",
+            str(config_path),
+            "--no-report",
+        ],
+        cwd=str(tmp_path),
+    )
+    assert result.returncode == 0
+
+    state = yaml.safe_load((output_path / "task.state").read_text())
+    statuses = {
+        step["name"]: [k for k in ["passed", "failed", "skipped"] if step["status"][k]]
+        for step in state["steps"]
+    }
+    assert statuses == {
+        "foo": ["skipped"],
+        "provision": ["skipped"],
+        "test": ["skipped"],
+        "collect": ["passed"],
+    }
@@ -1,8 +1,14 @@
 import filecmp
 import os
 import tempfile
+from unittest import mock
+
+import paramiko
 
 from cijoe.core.misc import ENCODING
+from cijoe.core.resources import Config
+from cijoe.core import transport
+from cijoe.core.transport import SSH
 
 
 def test_push_pull(cijoe):
@@ -21,3 +27,67 @@ def test_push_pull(cijoe):
         pulled = os.path.join(cijoe.output_path, cijoe.output_ident, "bar")
 
         assert filecmp.cmp(test_file.name, pulled, shallow=False), "Failed cmp()"
+
+
+def test_ssh_transport_options(tmp_path):
+    """The cijoe-specific transport keys must not be passed on to paramiko"""
+
+    config = Config(tmp_path / "config.toml")
+    config.options = {
+        "cijoe": {
+            "transport": {
+                "ssh": {"hostname": "foo", "persistent": True, "keepalive": 10}
+            }
+        }
+    }
+
+    ssh = SSH(config, tmp_path, "ssh")
+
+    assert ssh.persistent
+    assert ssh.options["keepalive"] == 10
+    assert ssh.ssh_params == {"hostname": "foo"}
+    assert not ssh.is_connected()
+
+    ssh.close()
+
+
+def test_ssh_transport_persistent(tmp_path, monkeypatch):
+    """A persistent connection is re-used across calls, re-connected when inactive"""
+
+    clients = []
+
+    def client():
+        ssh = mock.MagicMock()
+        ssh.get_transport.return_value.is_active.return_value = True
+        stdout = mock.MagicMock()
+        stdout.channel.recv_exit_status.return_value = 0
+        ssh.exec_command.return_value = (None, stdout, None)
+        clients.append(ssh)
+        return ssh
+
+    monkeypatch.setattr(paramiko, "SSHClient", client)
+    monkeypatch.setattr(transport, "pump", lambda source, read, cmd_output: None)
+
+    config = Config(tmp_path / "config.toml")
+    config.options = {
+        "cijoe": {"transport": {"ssh": {"hostname": "foo", "persistent": True}}}
+    }
+    ssh = SSH(config, tmp_path, "ssh")
+
+    for _ in range(3):
+        assert ssh.run("true", None, {}, None) == 0
+    assert len(clients) == 1
+    assert clients[0].connect.call_count == 1
+    assert clients[0].exec_command.call_count == 3
+    assert not clients[0].close.called
+
+    clients[0].get_transport.return_value.is_active.return_value = False
+    assert ssh.run("true", None, {}, None) == 0
+    assert len(clients) == 2
+    assert clients[0].close.called
+    assert clients[1].connect.call_count == 1
+
+    assert ssh in transport.PERSISTENT
+    transport.close_persistent()
+    assert clients[1].close.called
+    assert not ssh.is_connected()
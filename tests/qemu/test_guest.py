@@ -0,0 +1,116 @@
+import os
+import shutil
+import threading
+import time
+from argparse import Namespace
+
+import pytest
+
+from cijoe.qemu.wrapper import FileTail, Guest
+
+
+def guest_from_path(cijoe, path, **guest_config):
+    config = Namespace(
+        options={"qemu": {"guests": {"test": {"path": str(path), **guest_config}}}}
+    )
+
+    return Guest(cijoe, config, "test")
+
+
+def test_file_tail(tmp_path):
+    """Only appended content is read, with a window of the previous read"""
+
+    path = tmp_path / "serial.output"
+    tail = FileTail(path, window=4)
+
+    assert tail.read() == ""
+
+    path.write_bytes(b"boot log\xc3")
+    assert tail.read() == "boot log"
+
+    with path.open("ab") as serial:
+        serial.write(b"\xa6 login:")
+    assert tail.read() == " logæ login:"
+
+
+def test_guest_is_up(cijoe, tmp_path):
+    """The guest is up once serial output matches the ready-pattern"""
+
+    guest = guest_from_path(cijoe, tmp_path, ready_pattern=r"ready-\d+")
+    guest.pid.write_text(f"{os.getpid()}")
+
+    def boot():
+        time.sleep(0.2)
+        with guest.serial.open("a") as serial:
+            serial.write("booting\n")
+        time.sleep(0.2)
+        with guest.serial.open("a") as serial:
+            serial.write("ready-42\n")
+
+    booter = threading.Thread(target=boot)
+    booter.start()
+    began = time.time()
+    assert guest.is_up(timeout=10)
+    booter.join()
+
+    assert time.time() - began < 1.0
+    assert 0.3 < guest.boot_time < 1.0
+
+    assert not guest.is_up(timeout=0.1, pattern="login:")
+
+
+def test_guest_initialize_copy(cijoe, tmp_path):
+    """Without overlay, then the boot-image is a copy of the disk image"""
+
+    diskimage = tmp_path / "disk.qcow2"
+    diskimage.write_bytes(b"QFI\xfb" + bytes(4096))
+
+    guest = guest_from_path(cijoe, tmp_path / "guest")
+    assert not guest.initialize(diskimage)
+    assert guest.boot_img.read_bytes() == diskimage.read_bytes()
+
+
+@pytest.mark.skipif(shutil.which("qemu-img") is None, reason="requires qemu-img")
+def test_guest_initialize_overlay(cijoe, tmp_path):
+    """With overlay, then the boot-image is backed by the disk image"""
+
+    diskimage = tmp_path / "disk.qcow2"
+    err, _ = cijoe.run_local(f"qemu-img create -f qcow2 {diskimage} 1G")
+    assert not err
+
+    guest = guest_from_path(cijoe, tmp_path / "guest", overlay=True)
+    assert not guest.initialize(diskimage)
+
+    err, state = cijoe.run_local(f"qemu-img info {guest.boot_img}")
+    assert not err
+    assert str(diskimage) in state.output()
+
+
+def test_guest_snapshot_key(cijoe, tmp_path):
+    """Snapshots are keyed on the disk image, and the system arguments"""
+
+    diskimage = tmp_path / "disk.qcow2"
+    diskimage.write_bytes(bytes(4096))
+
+    guest = guest_from_path(cijoe, tmp_path / "guest")
+    assert guest.snapshot_key() is None
+    assert guest.start_from_snapshot() == (0, False)
+
+    assert not guest.initialize(diskimage)
+    key = guest.snapshot_key()
+    assert key
+
+    guest.guest_config["system_args"] = {"kwa": {"m": "2G"}}
+    assert guest.snapshot_key() != key
+    guest.guest_config["system_args"] = {}
+    assert guest.snapshot_key() == key
+
+    diskimage.with_name("disk.qcow2.sha256").write_text("abc  disk.qcow2\n")
+    assert not guest.initialize(diskimage)
+    assert guest.image_digest.read_text() == "abc"
+    assert guest.snapshot_key() != key
+
+    assert guest.snapshot_path() is None
+    (guest.snapshots / guest.snapshot_key()).mkdir(parents=True)
+    (guest.snapshots / guest.snapshot_key() / "state").write_bytes(b"")
+    assert guest.snapshot_path() == guest.snapshots / guest.snapshot_key()
@@ -0,0 +1,174 @@
+import errno
+import os
+import socket
+import subprocess
+from argparse import Namespace
+
+import pytest
+
+from cijoe.core.resources import dict_from_tomlfile
+from cijoe.qemu.pool import GuestPool
+
+
+def pool_from_path(cijoe, path, **pool_config):
+    config = Namespace(
+        options={
+            "cijoe": {"transport": {"guest": {"hostname": "localhost", "port": 22}}},
+            "qemu": {
+                "guests": {
+                    "template": {
+                        "path": str(path / "template"),
+                        "system_args": {"tcp_forward": {"host": 4200, "guest": 22}},
+                    }
+                },
+                "pools": {
+                    "test": {
+                        "guest": "template",
+                        "transport": "guest",
+                        "path": str(path / "pool"),
+                        "size": 2,
+                        **pool_config,
+                    }
+                },
+            },
+        }
+    )
+
+    return GuestPool(cijoe, config, "test")
+
+
+@pytest.fixture
+def booted(monkeypatch):
+    """Members are 'booted' by writing the pid of this process as theirs"""
+
+    booted = []
+
+    def boot(pool, nr, state, timeout=180):
+        guest = pool.member(nr, state["ports"][nr])
+        os.makedirs(guest.guest_path, exist_ok=True)
+        guest.pid.write_text(f"{os.getpid()}")
+        booted.append(nr)
+        return 0
+
+    monkeypatch.setattr(GuestPool, "boot", boot)
+    monkeypatch.setattr("cijoe.qemu.wrapper.Guest.kill", lambda guest: 0)
+
+    return booted
+
+
+def test_pool_members(cijoe, tmp_path):
+    """Members have a guest_path, and a tcp_forward host port, of their own"""
+
+    pool = pool_from_path(cijoe, tmp_path, host_port=4300)
+    members = pool.members({"ports": [4300, 4301]})
+
+    assert [guest.guest_path for guest in members] == [
+        tmp_path / "pool" / "00",
+        tmp_path / "pool" / "01",
+    ]
+    assert [guest.guest_config["system_args"]["tcp_forward"] for guest in members] == [
+        {"host": 4300, "guest": 22},
+        {"host": 4301, "guest": 22},
+    ]
+    assert pool.guest_config["system_args"]["tcp_forward"]["host"] == 4200
+
+
+def test_pool_lease_release(cijoe, tmp_path, booted):
+    """Members are leased until released, and recycled on release"""
+
+    pool = pool_from_path(cijoe, tmp_path)
+    assert pool.lease() == (errno.ENODEV, None)
+
+    assert not pool.start(tmp_path / "disk.qcow2")
+    assert sorted(booted) == [0, 1]
+    ports = pool.load_state()["ports"]
+    assert len(set(ports)) == 2
+
+    err, first = pool.lease()
+    assert not err
+    err, second = pool.lease()
+    assert not err
+    assert pool.lease() == (errno.EBUSY, None)
+
+    assert {first["member"], second["member"]} == {0, 1}
+    config = dict_from_tomlfile(pool.lease_config_path(first["member"]))
+    assert config == {
+        "cijoe": {
+            "transport": {
+                "guest": {"hostname": "localhost", "port": ports[first["member"]]}
+            }
+        }
+    }
+
+    metrics = pool.metrics()
+    assert metrics["size"] == 2
+    assert metrics["leased"] == 2
+    assert metrics["free"] == 0
+    assert metrics["leases"] == 2
+    assert 0 < metrics["utilization"] <= 1
+
+    booted.clear()
+    assert not pool.release(first["member"])
+    assert booted == [first["member"]]
+    assert not pool.release(second["member"], recycle=False)
+    assert booted == [first["member"]]
+
+    metrics = pool.metrics()
+    assert metrics["leased"] == 0
+    assert metrics["free"] == 2
+    assert metrics["recycles"] == 1
+
+    with pool.leased():
+        assert pool.metrics()["leased"] == 1
+    assert pool.metrics()["free"] == 2
+    assert pool.metrics()["leases"] == 3
+
+    assert not pool.stop()
+    assert pool.lease() == (errno.ENODEV, None)
+
+
+def test_pool_lease_expires(cijoe, tmp_path, booted):
+    """Expired leases are reclaimed, and the member recycled, when leasing"""
+
+    pool = pool_from_path(cijoe, tmp_path, size=1)
+    assert not pool.start(tmp_path / "disk.qcow2")
+
+    err, _ = pool.lease(ttl=0.01)
+    assert not err
+
+    booted.clear()
+    err, lease = pool.lease(timeout=5)
+    assert not err
+    assert booted == [0]
+    assert pool.metrics()["leases"] == 2
+
+
+def test_pool_reclaim_stale(cijoe, tmp_path, booted):
+    """Leases left behind by a process that is gone, or long ago, are reclaimed"""
+
+    pool = pool_from_path(cijoe, tmp_path, size=1, stale_timeout=60)
+    assert not pool.start(tmp_path / "disk.qcow2")
+
+    gone = subprocess.Popen(["true"])
+    gone.wait()
+
+    with pool.lock():
+        pool.set_lease(0, "recycling", holder=f"{socket.gethostname()}:{gone.pid}")
+
+    booted.clear()
+    err, lease = pool.lease()
+    assert not err
+    assert booted == [0]
+    assert not pool.release(lease["member"], recycle=False)
+
+    with pool.lock():
+        pool.set_lease(0, "failed", err=errno.EAGAIN)
+    assert pool.lease() == (errno.EBUSY, None)
+
+    with pool.lock():
+        pool.set_lease(0, "failed", err=errno.EAGAIN, changed=0.0)
+
+    booted.clear()
+    err, lease = pool.lease()
+    assert not err
+    assert booted == [0]
@@ -0,0 +1,86 @@
+import json
+import os
+import socket
+import threading
+from argparse import Namespace
+
+from cijoe.qemu.qmp import QMP
+from cijoe.qemu.wrapper import Guest
+
+
+class FakeQEMU(threading.Thread):
+    """Serves a single QMP client, emitting SHUTDOWN on 'system_powerdown'"""
+
+    def __init__(self, path):
+        super().__init__()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(str(path))
+        self.server.listen(1)
+        self.commands = []
+
+    def run(self):
+        conn, _ = self.server.accept()
+        with conn, conn.makefile("rwb") as stream:
+
+            def send(message):
+                stream.write(json.dumps(message).encode() + b"\n")
+                stream.flush()
+
+            send({"QMP": {"version": {}, "capabilities": []}})
+            for line in stream:
+                command = json.loads(line)["execute"]
+                self.commands.append(command)
+                if command == "query-status":
+                    send({"event": "RESUME", "data": {}})
+                    send({"return": {"status": "running", "running": True}})
+                elif command == "system_powerdown":
+                    send({"return": {}})
+                    send({"event": "SHUTDOWN", "data": {"guest": True}})
+                    break
+                elif command == "nonsense":
+                    send({"error": {"class": "CommandNotFound", "desc": "nope"}})
+                else:
+                    send({"return": {}})
+        self.server.close()
+
+
+def test_qmp(tmp_path):
+    """Commands, errors and events are handled, the powerdown is awaited"""
+
+    qemu = FakeQEMU(tmp_path / "qmp.sock")
+    qemu.start()
+
+    with QMP(tmp_path / "qmp.sock", timeout=5) as qmp:
+        err, status = qmp.query_status()
+        assert not err
+        assert status["status"] == "running"
+        assert [event["event"] for event in qmp.events] == ["RESUME"]
+
+        err, _ = qmp.execute("nonsense")
+        assert err
+
+        assert qmp.system_powerdown(timeout=5) == (0, True)
+
+    qemu.join()
+    assert qemu.commands == [
+        "qmp_capabilities",
+        "query-status",
+        "nonsense",
+        "system_powerdown",
+    ]
+
+
+def test_guest_status_without_qmp(cijoe, tmp_path):
+    """Without a running guest, then QMP is not available"""
+
+    config = Namespace(options={"qemu": {"guests": {"test": {"path": str(tmp_path)}}}})
+    guest = Guest(cijoe, config, "test")
+
+    err, status = guest.status()
+    assert err
+    assert status is None
+
+    assert guest.wait_for_termination(timeout=1) == (0, True)
+
+    guest.pid.write_text(f"{os.getpid()}")
+    assert guest.wait_for_termination(timeout=0.1) == (0, False)